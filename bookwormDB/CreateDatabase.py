@@ -11,7 +11,15 @@ from bookwormDB.configuration import Configfile
 from configparser import NoOptionError
 import logging
 import warnings
+import threading
+import tempfile
+import time
+import queue
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .sqliteKV import KV
+from .multiprocessingHelp import mp_stats
+from .encodedCounts import format_rows, read_binary_counts, binary_chunks
 
 if logging.getLogger().isEnabledFor(logging.DEBUG):
     # Catch MYSQL warnings as errors if logging is set to debug.
@@ -98,8 +106,10 @@ class DB(object):
             if many_params is not None:
                 cursor.executemany(sql, many_params)
             else:
-                
-                cursor.execute(sql)
+                if params is None:
+                    cursor.execute(sql)
+                else:
+                    cursor.execute(sql, params)
         except:
             try:
                 self.connect()
@@ -117,6 +127,287 @@ class DB(object):
 
         return cursor
 
+    def local_infile(self):
+        """
+        Does the server accept LOAD DATA LOCAL INFILE?
+        """
+        value = self.query("SELECT @@GLOBAL.local_infile").fetchone()[0]
+        return str(value).upper() in ["1", "ON"]
+
+    def load_rows(self, tablename, columns, chunks):
+        """
+        Stream integer arrays into a table with LOAD DATA LOCAL INFILE,
+        passing them through a named pipe so nothing is staged on disk.
+
+        This doesn't go through `query`, because a retried LOAD DATA
+        would find the pipe already drained.
+        """
+        if self.conn is None:
+            self.connect()
+        fifodir = tempfile.mkdtemp(prefix="bookworm")
+        fifo = os.path.join(fifodir, "rows.tsv")
+        os.mkfifo(fifo)
+        errors = []
+
+        def feed():
+            try:
+                with open(fifo, "w") as fout:
+                    for chunk in chunks:
+                        fout.write(format_rows(chunk))
+            except Exception as e:
+                errors.append(e)
+
+        writer = threading.Thread(target=feed)
+        writer.start()
+        sql = ("LOAD DATA LOCAL INFILE '" + fifo + "' INTO TABLE " + tablename +
+               " CHARACTER SET utf8 (" + ",".join(columns) + ");")
+        logging.debug(" -- Preparing to execute SQL code -- " + sql)
+        try:
+            self.conn.cursor().execute(sql)
+        except:
+            # If the server never opened the pipe, open and close it
+            # ourselves so the writer fails instead of blocking forever.
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            raise
+        finally:
+            writer.join()
+            os.remove(fifo)
+            os.rmdir(fifodir)
+        if len(errors) > 0:
+            raise errors[0]
+
+def table_rows(db, tablename):
+    # Free for MyISAM tables, which keep their row count.
+    return db.query("SELECT COUNT(*) FROM " + tablename).fetchone()[0]
+
+def load_count_file(db, tablename, path, columns):
+    """
+    Load one encoded count file (.txt or .bin) into a table; if LOAD DATA
+    LOCAL INFILE fails before loading anything, as it does when the server
+    doesn't allow it, fall back on a slower insert.
+
+    If it fails partway, the rows it loaded stay in the table, which has
+    no transactions to roll them back: the error is raised, since
+    inserting the whole file again would count them twice.
+
+    `columns` gives the order of columns in a .txt file: .bin files name
+    their own.
+    """
+    if os.path.getsize(path) == 0:
+        # A batch in which no word was found (or no OOV word kept) leaves
+        # an empty .txt file, which pandas can't read.
+        return
+    before = table_rows(db, tablename)
+    try:
+        if path.endswith(".bin"):
+            columns, _ = read_binary_counts(path)
+            db.load_rows(tablename, columns, binary_chunks(path))
+        else:
+            # Not through `query`, which would run it again on an error.
+            if db.conn is None:
+                db.connect()
+            db.conn.cursor().execute("LOAD DATA LOCAL INFILE '" + path + "' INTO TABLE " + tablename +
+                                     " CHARACTER SET utf8 (" + ",".join(columns) + ");")
+        return
+    except KeyboardInterrupt:
+        raise
+    except:
+        if table_rows(db, tablename) != before:
+            logging.error("Loading %s into %s failed partway; the table must be emptied "
+                          "and loaded again" % (path, tablename))
+            raise
+        logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+    try:
+        if path.endswith(".bin"):
+            chunks = binary_chunks(path, INSERT_CHUNK_ROWS)
+        else:
+            import pandas as pd
+            chunks = (df.to_numpy() for df in
+                      pd.read_csv(path, sep='\t', header=None, chunksize=INSERT_CHUNK_ROWS))
+        insert_rows(db, tablename, columns, chunks)
+    except KeyboardInterrupt:
+        raise
+    except:
+        logging.exception("Error inserting %s into %s" % (path, tablename))
+
+# Rows to read at a time from HDF5 and Parquet files.
+COLUMNAR_CHUNK_ROWS = 2000000
+
+def columnar_chunks(path, key, columns, legacy_columns, chunksize=COLUMNAR_CHUNK_ROWS):
+    """
+    Yield the count rows of an HDF5 or Parquet file as (columns, array)
+    pairs, one chunk at a time.
+
+    For HDF5, `key` names the table in the file (e.g. /unigrams), which
+    must be stored in pandas' 'table' format. Columns are picked out by
+    name if the file has all of `columns` (as columns or index levels);
+    otherwise the first ones are taken to be `legacy_columns`, the order
+    older bookworms wrote them in.
+    """
+    import pandas as pd
+    if path.endswith(".h5"):
+        frames = pd.read_hdf(path, key, mode='r', chunksize=chunksize)
+    else:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            logging.exception("Ingesting parquet files requires pyarrow")
+            raise
+        frames = (batch.to_pandas() for batch in
+                  pq.ParquetFile(path).iter_batches(batch_size=chunksize))
+    try:
+        for frame in frames:
+            frame = frame.reset_index()
+            if all([column in frame.columns for column in columns]):
+                yield columns, frame[columns].to_numpy()
+            else:
+                yield legacy_columns, frame.iloc[:, :len(legacy_columns)].to_numpy()
+    finally:
+        if hasattr(frames, "close"):
+            frames.close()
+
+# The table that holds each level of counts, and the columns of its
+# rows in encoded files.
+BOOK_COUNT_TABLES = {
+    "unigrams": ("master_bookcounts", ["bookid", "wordid", "count"]),
+    "bigrams": ("master_bigrams", ["bookid", "word1", "word2", "count"]),
+}
+
+def legacy_columns(level):
+    """
+    The order older bookworms wrote a level's columns in HDF5 files.
+    """
+    if level == "unigrams":
+        return ["wordid", "bookid", "count"]
+    return BOOK_COUNT_TABLES[level][1]
+
+def book_counts_definition(level, reverse_index=True):
+    """
+    The columns and indexes of a table of counts: indexed words first for
+    searches and, with `reverse_index`, bookid first as well.
+    """
+    words = BOOK_COUNT_TABLES[level][1][1:-1]
+    definition = [word + " MEDIUMINT UNSIGNED NOT NULL" for word in words]
+    definition.append("INDEX(" + ",".join(words + ["bookid", "count"]) + ")")
+    definition.append("bookid INT UNSIGNED NOT NULL")
+    if reverse_index:
+        definition.append("INDEX(" + ",".join(["bookid"] + words + ["count"]) + ")")
+    definition.append("count MEDIUMINT UNSIGNED NOT NULL")
+    return ", ".join(definition)
+
+def load_columnar_file(db, tablenames, path, key):
+    """
+    Stream an HDF5 or Parquet file of counts at level `key` into MySQL.
+    Each chunk is loaded as soon as it is read, straight from memory
+    through a named pipe, cycling through `tablenames`.
+    """
+    chunks = columnar_chunks(path, key, BOOK_COUNT_TABLES[key][1], legacy_columns(key))
+    for j, (columns, chunk) in enumerate(chunks):
+        tablename = tablenames[j % len(tablenames)]
+        logging.debug("Loading %d rows from %s into %s" % (len(chunk), path, tablename))
+        before = table_rows(db, tablename)
+        try:
+            db.load_rows(tablename, columns, [chunk])
+        except KeyboardInterrupt:
+            raise
+        except:
+            # As in `load_count_file`, rows a failed LOAD left behind
+            # mustn't be inserted twice.
+            if table_rows(db, tablename) != before:
+                logging.error("Loading %s into %s failed partway; the table must be emptied "
+                              "and loaded again" % (path, tablename))
+                raise
+            logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
+            insert_rows(db, tablename, columns, [chunk])
+
+def count_chunks(path, key, columns=["bookid", "wordid", "count"]):
+    """
+    Yield the rows of any encoded count file (.txt, .bin, .h5 or .parquet)
+    at level `key` as integer arrays with the given columns, a chunk at a time.
+
+    .txt files have no header, so their columns must be `columns`.
+    """
+    if path.endswith(".txt"):
+        import pandas as pd
+        if os.path.getsize(path) == 0:
+            return
+        for df in pd.read_csv(path, sep='\t', header=None, chunksize=INSERT_CHUNK_ROWS):
+            yield df.to_numpy()
+        return
+    if path.endswith(".bin"):
+        file_columns, _ = read_binary_counts(path)
+        chunks = ((file_columns, chunk) for chunk in binary_chunks(path))
+    else:
+        chunks = columnar_chunks(path, key, columns, legacy_columns(key))
+    for file_columns, chunk in chunks:
+        yield chunk[:, [file_columns.index(column) for column in columns]]
+
+# Chunks waiting to be loaded into each table when routing rows by wordid.
+ROUTED_QUEUE_CHUNKS = 4
+
+# Past this many parts behind master_bookcounts, each append suggests a
+# rebuild: every search of the MERGE table opens all of them.
+MERGE_PARTS_WARNING = 16
+
+# For servers without LOAD DATA LOCAL INFILE: rows read from a file at a
+# time, rows per INSERT statement (at ~20 bytes a row, well under the
+# default max_allowed_packet), and connections to send statements over.
+INSERT_CHUNK_ROWS = 2**18
+INSERT_BATCH_ROWS = 10000
+INSERT_CONNECTIONS = 2
+
+def insert_rows(db, tablename, columns, chunks, connections=INSERT_CONNECTIONS):
+    """
+    Insert a stream of integer arrays into a table with multi-row INSERT
+    statements of at most INSERT_BATCH_ROWS rows.
+
+    Statements are built in this thread and sent by `connections` others,
+    each with its own connection, so building one overlaps with sending
+    the last. Only a few statements are ever waiting at once.
+    """
+    statements = queue.Queue(connections * 2)
+    errors = []
+
+    def send():
+        sender = DB(db.dbname)
+        try:
+            sender.connect()
+            cursor = sender.conn.cursor()
+            while True:
+                sql = statements.get()
+                if sql is None:
+                    return
+                cursor.execute(sql)
+        except Exception as e:
+            errors.append(e)
+            # Keep taking statements so the producer never blocks.
+            while statements.get() is not None:
+                pass
+        finally:
+            if sender.conn is not None:
+                sender.conn.close()
+
+    senders = [threading.Thread(target=send) for i in range(connections)]
+    for sender in senders:
+        sender.start()
+    prefix = "INSERT INTO " + tablename + " (" + ",".join(columns) + ") VALUES "
+    row = "(" + ",".join(["%d"] * len(columns)) + "),"
+    try:
+        for chunk in chunks:
+            if len(errors) > 0:
+                break
+            for start in range(0, len(chunk), INSERT_BATCH_ROWS):
+                rows = chunk[start:start + INSERT_BATCH_ROWS]
+                values = (row * len(rows)) % tuple(rows.ravel().tolist())
+                statements.put(prefix + values[:-1])
+    finally:
+        for sender in senders:
+            statements.put(None)
+        for sender in senders:
+            sender.join()
+    if len(errors) > 0:
+        raise errors[0]
+
 class BookwormSQLDatabase(object):
 
     """
@@ -173,6 +464,14 @@ class BookwormSQLDatabase(object):
             self.db.query("CREATE USER '%s'@'localhost' IDENTIFIED BY '%s'" % (username,password))
             self.db.query("GRANT SELECT ON %s.* TO '%s'@'localhost' IDENTIFIED BY '%s'" % (self.dbname,username,password))
             
+    def record_build_time(self):
+        """
+        Note in bookworm_information that the database has just changed, so
+        API servers stop answering from results cached before now.
+        """
+        self.db.query("CREATE TABLE IF NOT EXISTS bookworm_information (entry VARCHAR(255), PRIMARY KEY (entry), value VARCHAR(50000))")
+        self.db.query("REPLACE INTO bookworm_information VALUES ('build_time', '%f')" % time.time())
+
     def setVariables(self, originFile, anchorField="bookid",
                      jsonDefinition=".bookworm/metadata/field_descriptions_derived.json"):
         self.variableSet = variableSet(originFile=originFile, anchorField=anchorField, jsonDefinition=jsonDefinition,db=self.db)
@@ -250,23 +549,295 @@ class BookwormSQLDatabase(object):
         """
         self.variableSet.loadMetadata()
 
-    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1):
+    def load_count_files(self, assignments, columns, workers=None):
+        """
+        Load encoded count files into tables, several tables at once.
+
+        assignments: a dict from table names to lists of files to load into them.
+        columns: the column order of .txt files.
+        workers: how many tables to load at the same time, each on its own
+            connection; by default, one per table up to the number of cpus.
+            The files for any one table are loaded one after another,
+            because MyISAM locks the whole table for each load anyway.
+        """
+        tasks = [(tablename, paths) for tablename, paths in assignments.items() if len(paths) > 0]
+        if len(tasks) == 0:
+            return
+        if workers is None:
+            workers = min(len(tasks), mp_stats()[0])
+        total_files = sum([len(paths) for tablename, paths in tasks])
+        total_bytes = sum([os.path.getsize(path) for tablename, paths in tasks for path in paths])
+        logging.info("Loading %d files (%.1f MB) into %d tables with %d connections" % (
+            total_files, total_bytes / 1e6, len(tasks), workers))
+
+        t0 = time.time()
+        lock = threading.Lock()
+        progress = {"files": 0, "bytes": 0}
+
+        def load_table(db, tablename, paths):
+            for path in paths:
+                load_count_file(db, tablename, path, columns)
+                with lock:
+                    progress["files"] += 1
+                    progress["bytes"] += os.path.getsize(path)
+                    elapsed = time.time() - t0
+                    logging.info("Loaded %d/%d files, %.1f/%.1f MB (%.1f MB/s)" % (
+                        progress["files"], total_files, progress["bytes"] / 1e6,
+                        total_bytes / 1e6, progress["bytes"] / 1e6 / max(elapsed, 1e-6)))
+
+        self.run_concurrently([lambda db, t=tablename, p=paths: load_table(db, t, p)
+                               for tablename, paths in tasks], workers)
+        logging.info("Loaded %d files in %.2f s" % (total_files, time.time() - t0))
+
+    def run_concurrently(self, tasks, workers, setup=None):
+        """
+        Run a list of tasks, each a function of a `DB`, on `workers` threads
+        that each open their own connection to the database. `setup`, if
+        given, is called on each new connection.
+
+        Returns the results of the tasks, in order.
+        """
+        local = threading.local()
+        lock = threading.Lock()
+        connections = []
+
+        def run(task):
+            if not hasattr(local, "db"):
+                db = DB(self.dbname)
+                db.connect()
+                with lock:
+                    connections.append(db)
+                if setup is not None:
+                    setup(db)
+                local.db = db
+            return task(local.db)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(run, task) for task in tasks]
+                return [future.result() for future in futures]
+        finally:
+            for db in connections:
+                db.conn.close()
+
+    def enable_keys(self, tablenames, workers=None, sort_buffer_size=None):
+        """
+        Rebuild the indexes of tables loaded with their keys disabled,
+        several tables at once.
+
+        Each index build sorts in its own `myisam_sort_buffer_size` buffer,
+        so the memory used is `workers` times `sort_buffer_size` (in bytes;
+        by default, the server's global setting).
+        """
+        if len(tablenames) == 0:
+            return
+        if workers is None:
+            workers = min(len(tablenames), mp_stats()[0])
+        if sort_buffer_size is None:
+            sort_buffer_size = int(self.db.query("SELECT @@GLOBAL.myisam_sort_buffer_size").fetchone()[0])
+        logging.info("Enabling keys on %d tables with %d connections and %.0f MB sort buffers" % (
+            len(tablenames), workers, sort_buffer_size / 2**20))
+
+        def setup(db):
+            db.query("SET SESSION myisam_sort_buffer_size = %d" % sort_buffer_size)
+
+        def enable(db, tablename):
+            t0 = time.time()
+            db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+            elapsed = time.time() - t0
+            logging.info("Enabled keys on %s in %.2f s" % (tablename, elapsed))
+            return elapsed
+
+        t0 = time.time()
+        timings = self.run_concurrently([lambda db, t=tablename: enable(db, t) for tablename in tablenames],
+                                        workers, setup=setup)
+        logging.info("Indexes built in %.2f s; slowest was %s (%.2f s)" % (
+            time.time() - t0, tablenames[timings.index(max(timings))], max(timings)))
+
+    def wordid_partitions(self, table_count):
+        """
+        Split the wordids into `table_count` ranges holding roughly equal
+        numbers of tokens, using the counts in the wordlist. Wordids are
+        frequency ranks, so the low ranges are narrow and the high ones wide.
+
+        Returns a list of (first wordid, last wordid) pairs.
+        """
+        counts = []
+        for line in open(".bookworm/texts/wordlist/wordlist.txt"):
+            wordid, word, count = line.rstrip("\n").split("\t")
+            counts.append((int(wordid), int(count)))
+        counts.sort()
+        wordids = np.array([wordid for wordid, count in counts])
+        cumulative = np.cumsum([count for wordid, count in counts])
+        targets = cumulative[-1] * np.arange(1, table_count) / table_count
+        starts = [0]
+        for i in np.searchsorted(cumulative, targets, side="right"):
+            # Every range gets at least one wordid.
+            start = max(int(wordids[min(i, len(wordids) - 1)]), starts[-1] + 1)
+            starts.append(start)
+        # The last range runs to the top of the MEDIUMINT wordid column.
+        ends = [start - 1 for start in starts[1:]] + [2**24 - 1]
+        return list(zip(starts, ends))
+
+    def load_routed_files(self, paths, tablenames, partitions, level="unigrams"):
+        """
+        Load count files into tables by wordid: each row goes to the table
+        whose range in `partitions` holds its (first) wordid.
+
+        Every file is read once, here; its rows are split up and handed to
+        one loader per table, each streaming into MySQL on its own
+        connection, so all the tables load at the same time.
+        """
+        columns = BOOK_COUNT_TABLES[level][1]
+        firsts = np.array([first for first, last in partitions])
+        queues = [queue.Queue(ROUTED_QUEUE_CHUNKS) for tablename in tablenames]
+        use_infile = self.db.local_infile()
+
+        def drain(q):
+            while True:
+                chunk = q.get()
+                if chunk is None:
+                    return
+                yield chunk
+
+        def load(db, tablename, q):
+            try:
+                if use_infile:
+                    db.load_rows(tablename, columns, drain(q))
+                else:
+                    insert_rows(db, tablename, columns, drain(q))
+            except:
+                # Keep the router from blocking on this table.
+                for chunk in drain(q):
+                    pass
+                raise
+
+        tasks = [lambda db, t=tablename, q=q: load(db, t, q) for tablename, q in zip(tablenames, queues)]
+        errors = []
+
+        def run():
+            try:
+                self.run_concurrently(tasks, len(tasks))
+            except Exception as e:
+                errors.append(e)
+
+        loader = threading.Thread(target=run)
+        loader.start()
+        t0 = time.time()
+        try:
+            for i, path in enumerate(paths):
+                for chunk in count_chunks(path, level, columns):
+                    parts = np.searchsorted(firsts, chunk[:, 1], side="right") - 1
+                    order = np.argsort(parts, kind="stable")
+                    chunk = chunk[order]
+                    edges = np.searchsorted(parts[order], np.arange(len(tablenames) + 1))
+                    for j in range(len(tablenames)):
+                        if edges[j + 1] > edges[j]:
+                            queues[j].put(chunk[edges[j]:edges[j + 1]])
+                logging.info("Routed %d/%d %s files by wordid in %.2f s" % (i + 1, len(paths), level, time.time() - t0))
+        finally:
+            for q in queues:
+                q.put(None)
+            loader.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def write_partition_table(self, tablenames, partitions, level="unigrams"):
+        """
+        Record which wordids each part of a level's table holds (for
+        bigrams, by their first word), so that queries can go straight to
+        the right part. Rows for other levels are left alone.
+        """
+        self.db.query("""CREATE TABLE IF NOT EXISTS masterPartitionTable
+              (tablename VARCHAR(255), PRIMARY KEY (tablename),
+              min_wordid INT UNSIGNED NOT NULL,
+              max_wordid INT UNSIGNED NOT NULL) ENGINE=MYISAM;""")
+        self.clear_partitions(level)
+        self.db.query("INSERT INTO masterPartitionTable (tablename, min_wordid, max_wordid) VALUES (%s, %s, %s)",
+                      many_params=[(tablename, first, last) for tablename, (first, last) in zip(tablenames, partitions)])
+
+    def clear_partitions(self, level="unigrams"):
+        """
+        Forget how a level's table was partitioned, before it's rebuilt.
+        """
+        if len(self.db.query("SHOW TABLES LIKE 'masterPartitionTable'").fetchall()) > 0:
+            self.db.query("DELETE FROM masterPartitionTable WHERE tablename LIKE %s",
+                          (BOOK_COUNT_TABLES[level][0] + "\\_p%",))
+
+    def read_partitions(self, level="unigrams"):
+        """
+        The (tablename, min_wordid, max_wordid) of each part of a level's
+        table, in order, from `write_partition_table`; or [] if it
+        wasn't partitioned by wordid.
+        """
+        if len(self.db.query("SHOW TABLES LIKE 'masterPartitionTable'").fetchall()) == 0:
+            return []
+        return list(self.db.query("SELECT tablename, min_wordid, max_wordid FROM masterPartitionTable "
+                                  "WHERE tablename LIKE %s ORDER BY min_wordid",
+                                  (BOOK_COUNT_TABLES[level][0] + "\\_p%",)).fetchall())
+
+    def book_count_tablenames(self, level="unigrams", table_count=1):
+        """
+        The tables that hold a level's counts: master_bookcounts (or
+        master_bigrams) itself, or if it's split into `table_count` parts,
+        the parts behind its MERGE table.
+        """
+        tablenameroot = BOOK_COUNT_TABLES[level][0]
+        if table_count == 1:
+            return [tablenameroot]
+        elif table_count > 1:
+            return ["%s_p%d" % (tablenameroot, i) for i in range(1, table_count+1)]
+        else:
+            logging.error("You need a positive integer for table_count")
+            raise ValueError(table_count)
+
+    def index_book_counts(self, table_counts={"unigrams": 1}, workers=None, sort_buffer_size=None):
+        """
+        Enable keys on the tables of every level in `table_counts` (a dict
+        from levels to how many parts each is split into) concurrently,
+        then put a MERGE table over the parts of each level that has more
+        than one. See `enable_keys` for `workers` and `sort_buffer_size`.
+        """
+        tablenames = dict([(level, self.book_count_tablenames(level, table_count))
+                           for level, table_count in table_counts.items()])
+        self.enable_keys([tablename for level in tablenames for tablename in tablenames[level]],
+                         workers=workers, sort_buffer_size=sort_buffer_size)
+
+        for level, parts in tablenames.items():
+            if len(parts) > 1:
+                self.create_merge_table(BOOK_COUNT_TABLES[level][0], parts)
+
+    def create_merge_table(self, tablename, parts):
+        """
+        (Re)create `tablename` as a MERGE table over `parts`, with the
+        same columns and indexes as they have.
+        """
+        logging.info("Creating a merge table for " + ",".join(parts))
+        self.db.query("DROP TABLE IF EXISTS " + tablename)
+        self.db.query("CREATE TABLE %s LIKE %s" % (tablename, parts[0]))
+        self.db.query("ALTER TABLE %s ENGINE=MERGE UNION=(%s) INSERT_METHOD=LAST" % (tablename, ",".join(parts)))
+
+    def create_book_counts(self, level="unigrams", newtable=True, ingest=True, index=True, reverse_index=True, table_count=1, load_workers=None, index_workers=None, partition_by="file"):
+        """
+        Load the encoded counts at a level into master_bookcounts (for
+        unigrams) or master_bigrams (for bigrams).
+
+        table_count: split the table into this many parts, loaded at the
+            same time and joined by a MERGE table.
+        partition_by: with table_count > 1, how to split rows among the tables:
+            'file' spreads whole files round-robin; 'wordid' routes rows by
+            ranges of (first) wordids, so queries for a word can skip the other tables.
+        """
         import time
         t0 = time.time()
 
         db = self.db
-        ngramname = "unigrams"
-        tablenameroot = "master_bookcounts"
+        ngramname = level
+        columns = BOOK_COUNT_TABLES[level][1]
         # If you are splitting the input into multiple tables
         # to be joined as a merge table, come up with multiple 
         # table names and we'll cycle through.
-        if table_count == 1:
-            tablenames = [tablenameroot]
-        elif table_count > 1:
-            tablenames = ["%s_p%d" % (tablenameroot, i) for i in range(1, table_count+1)]
-        else:
-            logging.error("You need a positive integer for table_count")
-            raise
+        tablenames = self.book_count_tablenames(level, table_count)
 
         grampath =  ".bookworm/texts/encoded/%s" % ngramname
         tmpdir = "%s/tmp" % grampath
@@ -281,16 +852,15 @@ class BookwormSQLDatabase(object):
                 shutil.rmtree(tmpdir)
         
             logging.info("Dropping older %s table, if it exists" % ngramname)
+            db.query("DROP TABLE IF EXISTS " + BOOK_COUNT_TABLES[level][0])
             for tablename in tablenames:
                 db.query("DROP TABLE IF EXISTS " + tablename)
+            self.clear_partitions(level)
 
         logging.info("Making a SQL table to hold the %s" % ngramname)
-        reverse_index_sql = "INDEX(bookid,wordid,count), " if reverse_index else ""
         for tablename in tablenames:
-            db.query("CREATE TABLE IF NOT EXISTS " + tablename + " ("
-                "wordid MEDIUMINT UNSIGNED NOT NULL, INDEX(wordid,bookid,count), "
-                "bookid INT UNSIGNED NOT NULL, " + reverse_index_sql +
-                "count MEDIUMINT UNSIGNED NOT NULL);")
+            db.query("CREATE TABLE IF NOT EXISTS " + tablename + " (" +
+                     book_counts_definition(level, reverse_index) + ");")
 
         if ingest:
             for tablename in tablenames:
@@ -300,110 +870,172 @@ class BookwormSQLDatabase(object):
             logging.info("loading data using LOAD DATA LOCAL INFILE")
             
             files = os.listdir(grampath)
+            if partition_by == "wordid" and len(tablenames) > 1:
+                partitions = self.wordid_partitions(len(tablenames))
+                logging.info("Partitioning %s by wordid: " % ngramname + ", ".join(
+                    ["%s %d-%d" % (tablename, first, last) for tablename, (first, last) in zip(tablenames, partitions)]))
+                self.load_routed_files([grampath + "/" + filename for filename in files
+                                        if os.path.splitext(filename)[1] in [".txt", ".bin", ".h5", ".parquet"]],
+                                       tablenames, partitions, ngramname)
+                self.write_partition_table(tablenames, partitions, ngramname)
+                # Every file has been routed already.
+                files = []
+            # With each input file, cycle through each table in tablenames
+            assignments = dict([(tablename, []) for tablename in tablenames])
             for i, filename in enumerate(files):
-                if filename.endswith('.txt'):
-                    # With each input file, cycle through each table in tablenames
-                    tablename = tablenames[i % len(tablenames)]
-                    logging.debug("Importing txt file, %s (%d/%d)" % (filename, i, len(files)))
-                    try:
-                        db.query("LOAD DATA LOCAL INFILE '" + grampath + "/" + filename + "' INTO TABLE " + tablename +" CHARACTER SET utf8 (wordid,bookid,count);")
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                       logging.debug("Falling back on insert without LOCAL DATA INFILE. Slower.")
-                       try:
-                            import pandas as pd
-                            df = pd.read_csv(grampath + "/" + filename, sep='\t', header=None)
-                            to_insert = df.apply(tuple, axis=1).tolist()
-                            db.query(
-                                "INSERT INTO " + tablename + " (wordid,bookid,count) "
-                                "VALUES (%s, %s, %s);""",
-                                many_params=to_insert
-                                )
-                       except KeyboardInterrupt:
-                           raise
-                       except:
-                           logging.exception("Error inserting %s from %s" % (ngramname, filename))
-                           continue
-
-                elif filename.endswith('.h5'):
-                    logging.info("Importing h5 file, %s (%d/%d)" % (filename, i, len(files)))
+                if filename.endswith('.txt') or filename.endswith('.bin'):
+                    assignments[tablenames[i % len(tablenames)]].append(grampath + "/" + filename)
+            self.load_count_files(assignments, columns, workers=load_workers)
+
+            for i, filename in enumerate(files):
+                if filename.endswith('.h5') or filename.endswith('.parquet'):
+                    logging.info("Importing columnar file, %s (%d/%d)" % (filename, i, len(files)))
                     try:
-                        # When encountering an .h5 file, this looks for ngram information
-                        # in a /#{ngramnames} table (e.g. /unigrams) and writes it out to
-                        # temporary TSV files.
-                        # Dask is used here simply because it's a dead simple way to multithread
-                        # the TSV writing and lower the overhead versus having a TSV already staged.
-                        import csv
-                        import pandas as pd
-                        try:
-                            import dask.dataframe as dd
-                        except:
-                            logging.exception("Ingesting h5 files requires dask")
-                        try:
-                            os.makedirs(tmpdir)
-                        except OSError:
-                            if not os.path.isdir(tmpdir):
-                                raise
-                        # Dask will use #{n_cores-1} threads when saving CSVs.
-                        # Ingest and key reload times are identical to txt import, so the only
-                        # additional overhead is reading the file (small effect) and writing the csv.
-                        ddf = dd.read_hdf(grampath + "/" + filename,
-                                          ngramname, mode='r', chunksize=2000000)
-                        ddf.reset_index().to_csv(tmpdir + '/tmp.*.tsv',
-                                                 index=False, sep='\t', header=False,
-                                                 quoting=csv.QUOTE_NONNUMERIC)
-                        logging.info("CSV written from H5. Time passed: %.2f s" % (time.time() - t0))
-                        for j, tmpfile in enumerate(os.listdir(tmpdir)):
-                            # With each input file, cycle through each table in tablenames
-                            tablename = tablenames[j % len(tablenames)]
-                            path = "%s/%s" % (tmpdir, tmpfile)
-                            db.query("LOAD DATA LOCAL INFILE '" + path + "' "
-                                     "INTO TABLE " + tablename + " "
-                                     "CHARACTER SET utf8 (wordid,bookid,count);")
-                            try:
-                                os.remove(path)
-                            except:
-                                pass
-                        logging.info("CSVs input. Time passed: %.2f s" % (time.time() - t0))
+                        load_columnar_file(db, tablenames, grampath + "/" + filename, ngramname)
+                        logging.info("Columnar file loaded. Time passed: %.2f s" % (time.time() - t0))
                     except KeyboardInterrupt:
                        raise
                     except:
                        logging.exception("Error inserting %s from %s" % (ngramname, filename))
                        continue
-                else:
-                    continue
         if index:
-            logging.info("Creating Unigram Indexes. Time passed: %.2f s" % (time.time() - t0))
-            for tablename in tablenames:
-                db.query("ALTER TABLE " + tablename + " ENABLE KEYS")
+            logging.info("Creating %s indexes. Time passed: %.2f s" % (ngramname, time.time() - t0))
+            self.index_book_counts({level: table_count}, workers=index_workers)
 
-            if table_count > 1:
-                logging.info("Creating a merge table for " + ",".join(tablenames))
-                db.query("CREATE TABLE IF NOT EXISTS " + tablenameroot + " ("
-                    "wordid MEDIUMINT UNSIGNED NOT NULL, INDEX(wordid,bookid,count), "
-                    "bookid INT UNSIGNED NOT NULL, " + reverse_index_sql +
-                    "count MEDIUMINT UNSIGNED NOT NULL) "
-                    "ENGINE=MERGE UNION=(" + ",".join(tablenames) + ") INSERT_METHOD=LAST;")
+        logging.info("%s loaded in: %.2f s" % (ngramname, time.time() - t0))
+
+    def create_unigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1, load_workers=None, index_workers=None, partition_by="file"):
+        """
+        Load the unigram counts into master_bookcounts: see `create_book_counts`.
+        """
+        self.create_book_counts("unigrams", newtable, ingest, index, reverse_index, table_count,
+                                load_workers, index_workers, partition_by)
+
+    def create_bigram_book_counts(self, newtable=True, ingest=True, index=True, reverse_index=True, table_count=1, load_workers=None, index_workers=None, partition_by="file"):
+        """
+        Load the bigram counts into master_bigrams: see `create_book_counts`.
+        """
+        self.create_book_counts("bigrams", newtable, ingest, index, reverse_index, table_count,
+                                load_workers, index_workers, partition_by)
+
+    def merged_tablenames(self):
+        """
+        The tables behind master_bookcounts: the parts of its MERGE table,
+        or, if it isn't one, just itself.
+        """
+        create = self.db.query("SHOW CREATE TABLE master_bookcounts").fetchone()[1]
+        union = re.search(r"UNION=\((.*?)\)", create)
+        if union is None:
+            return ["master_bookcounts"]
+        return [tablename.strip().strip("`") for tablename in union.group(1).split(",")]
+
+    def append_unigram_book_counts(self, paths, workers=None):
+        """
+        Add the count files in `paths` to master_bookcounts.
 
-        logging.info("Unigram index created in: %.2f s" % ((time.time() - t0)))
+        If it's partitioned by wordid, each row goes to its part, with the
+        keys left on, as in `append_bigram_book_counts`. Otherwise the files
+        are loaded into a new table, which is indexed and added to the
+        MERGE table; if master_bookcounts is a single table, it's renamed
+        to be the first part of a new one.
 
-    def create_bigram_book_counts(self):
+        Nothing already loaded is read or re-indexed. Each append adds
+        another part, so a full rebuild now and then keeps their number down.
+
+        Returns the name of a table holding the new counts: the new part,
+        or master_bookcounts itself if they were routed.
+        """
         db = self.db
-        logging.info("Making a SQL table to hold the bigram counts")
-        db.query("""DROP TABLE IF EXISTS master_bigrams""")
-        db.query("""CREATE TABLE master_bigrams (
-        bookid INT UNSIGNED NOT NULL,
-        word1 MEDIUMINT UNSIGNED NOT NULL, INDEX (word1,word2,bookid,count),
-        word2 MEDIUMINT UNSIGNED NOT NULL,
-        count MEDIUMINT UNSIGNED NOT NULL);""")
-        db.query("ALTER TABLE master_bigrams DISABLE KEYS")
-        logging.info("loading data using LOAD DATA LOCAL INFILE")
-        for filename in os.listdir(".bookworm/texts/encoded/bigrams"):
-            db.query("LOAD DATA LOCAL INFILE '.bookworm/texts/encoded/bigrams/"+filename+"' INTO TABLE master_bigrams CHARACTER SET utf8 (bookid,word1,word2,count);")
+        parts = self.merged_tablenames()
+        partitions = self.read_partitions("unigrams")
+        if len(partitions) > 0 and set([tablename for tablename, first, last in partitions]) == set(parts):
+            logging.info("Routing the new counts into the parts of master_bookcounts by wordid")
+            self.load_routed_files(paths, [tablename for tablename, first, last in partitions],
+                                   [(first, last) for tablename, first, last in partitions], "unigrams")
+            return "master_bookcounts"
+
+        if parts == ["master_bookcounts"]:
+            numbers = [1]
+        else:
+            numbers = [int(part.rsplit("_p", 1)[1]) for part in parts]
+        newtable = "master_bookcounts_p%d" % (max(numbers) + 1)
+
+        # Anything under that name isn't in the MERGE table, so it's left
+        # over from an earlier build.
+        db.query("DROP TABLE IF EXISTS " + newtable)
+        db.query("CREATE TABLE %s LIKE %s" % (newtable, parts[0]))
+        db.query("ALTER TABLE " + newtable + " DISABLE KEYS")
+        self.load_count_files({newtable: paths}, ["bookid", "wordid", "count"], workers=workers)
+        self.enable_keys([newtable])
+
+        if parts == ["master_bookcounts"]:
+            logging.info("Moving master_bookcounts behind a merge table")
+            db.query("DROP TABLE IF EXISTS master_bookcounts_p1")
+            db.query("RENAME TABLE master_bookcounts TO master_bookcounts_p1")
+            self.create_merge_table("master_bookcounts", ["master_bookcounts_p1", newtable])
+        else:
+            logging.info("Adding %s to the merge table" % newtable)
+            db.query("ALTER TABLE master_bookcounts UNION=(" + ",".join(parts + [newtable]) + ")")
+        # The parts aren't split by wordid, so masterPartitionTable has
+        # nothing to say about them.
+        self.clear_partitions("unigrams")
+        if len(parts) + 1 > MERGE_PARTS_WARNING:
+            logging.warning("master_bookcounts now has %d parts, one more for each append; "
+                            "rebuild the bookworm to merge them" % (len(parts) + 1))
+        return newtable
+
+    def append_bigram_book_counts(self, paths):
+        """
+        Load the count files in `paths` into master_bigrams, with its
+        keys left on: there's too little to be worth rebuilding them for.
+        If it's partitioned by wordid, each row goes to its part.
+        """
+        partitions = self.read_partitions("bigrams")
+        if len(partitions) > 0:
+            self.load_routed_files(paths, [tablename for tablename, first, last in partitions],
+                                   [(first, last) for tablename, first, last in partitions], "bigrams")
+            return
+        for path in paths:
+            load_count_file(self.db, "master_bigrams", path, BOOK_COUNT_TABLES["bigrams"][1])
 
-        logging.info("Creating bigram indexes")
-        db.query("ALTER TABLE master_bigrams ENABLE KEYS")
+    def add_to_nwords(self, paths):
+        """
+        Add the counts in the unigram count files in `paths` to the word
+        totals of books already in nwords, and to the copies in catalog
+        and fastcat_.
+        """
+        totals = np.zeros(0, dtype=np.int64)
+        for path in paths:
+            for chunk in count_chunks(path, "unigrams"):
+                added = np.bincount(chunk[:, 0], weights=chunk[:, 2]).astype(np.int64)
+                if len(added) > len(totals):
+                    totals = np.pad(totals, (0, len(added) - len(totals)))
+                totals[:len(added)] += added
+        bookids = np.flatnonzero(totals)
+        if len(bookids) == 0:
+            return
+        self.db.query("DROP TABLE IF EXISTS nwords_added")
+        self.db.query("CREATE TABLE nwords_added (bookid INT UNSIGNED, PRIMARY KEY (bookid), added INT)")
+        insert_rows(self.db, "nwords_added", ["bookid", "added"],
+                    [np.column_stack([bookids, totals[bookids]])])
+        for tablename in ["nwords", "catalog", "fastcat_"]:
+            self.db.query("UPDATE %s JOIN nwords_added AS new USING (bookid) SET %s.nwords = %s.nwords + new.added" % (
+                tablename, tablename, tablename))
+        self.db.query("DROP TABLE nwords_added")
+
+    def add_words(self, rows, max_word_length=46, max_words=8271555):
+        """
+        Add (wordid, word, count) rows for new words to words and
+        wordsheap_, which otherwise are rebuilt from the whole wordlist.
+        """
+        if len(rows) == 0:
+            return
+        logging.info("Adding %d words to words and wordsheap_" % len(rows))
+        self.db.query("INSERT INTO words (wordid, word, count, casesens) VALUES (%s, %s, %s, %s)",
+                      many_params=[(wordid, word, count, word) for wordid, word, count in rows])
+        self.db.query("INSERT IGNORE INTO wordsheap_ SELECT wordid,word,casesens,LOWER(word) FROM words "
+                      "WHERE wordid >= %d AND CHAR_LENGTH(word) <= %d AND wordid <= %d ORDER BY wordid" % (
+                          rows[0][0], max_word_length, max_words))
 
     def loadVariableDescriptionsIntoDatabase(self):
         """
@@ -492,11 +1124,7 @@ class BookwormSQLDatabase(object):
             ", ".join(fastFieldsCreateList), engine)
 
         if engine == "MYISAM":
-            fastFields = ["bookid","nwords"] + [variable.fastField for variable in self.variableSet.uniques("fast")]
-            load_command = "INSERT INTO tmp SELECT "
-            load_command += ",".join(fastFields) + " FROM catalog USE INDEX () "
-            # LEFT JOIN fixes a bug where fields were being dropped
-            load_command += " ".join(["LEFT JOIN %(field)s__id USING (%(field)s ) " % variable.__dict__ for variable in self.variableSet.uniques("categorical")]) + ";"
+            load_command = "INSERT INTO tmp " + self.fastcat_select_SQL() + ";"
         elif engine == "MEMORY":
             load_command = "INSERT INTO tmp SELECT * FROM fastcat_;"
 
@@ -504,6 +1132,25 @@ class BookwormSQLDatabase(object):
         cleanup_command += "RENAME TABLE tmp TO {};".format(tbname)
         return create_command + load_command + cleanup_command;
 
+    def fastcat_select_SQL(self):
+        """
+        A SELECT of the fastcat_ columns for every book in the catalog.
+        """
+        fastFields = ["bookid","nwords"] + [variable.fastField for variable in self.variableSet.uniques("fast")]
+        select = "SELECT " + ",".join(fastFields) + " FROM catalog USE INDEX () "
+        # LEFT JOIN fixes a bug where fields were being dropped
+        select += " ".join(["LEFT JOIN %(field)s__id USING (%(field)s ) " % variable.__dict__ for variable in self.variableSet.uniques("categorical")])
+        return select
+
+    def append_fastcat_rows(self, first_bookid):
+        """
+        Add the books from `first_bookid` on to fastcat_, which otherwise
+        is rebuilt from the whole catalog.
+        """
+        logging.info("Adding new books to fastcat_")
+        self.db.query("INSERT INTO fastcat_ " + self.fastcat_select_SQL() +
+                      " WHERE catalog.bookid >= %d" % first_bookid)
+
     def create_fastcat_and_wordsheap_disk_tables(self):
         for q in self.fastcat_creation_SQL("MYISAM").split(";"):
             if q != "":
@@ -59,8 +59,13 @@ def ParseFieldDescs(write = False):
         
     return (fields_to_derive, fields)
 
-def parse_json_catalog(line_queue, processes, modulo):
+def parse_json_catalog(line_queue, processes, modulo, skip_registered = False):
     fields_to_derive, fields = ParseFieldDescs(write = False)
+
+    if skip_registered:
+        # Opened here, after the fork: each worker needs its own connection.
+        from .sqliteKV import KV
+        registered = KV(".bookworm/metadata/textids.sqlite")
     
     if os.path.exists("jsoncatalog.txt"):
         mode = "json"
@@ -84,6 +89,13 @@ def parse_json_catalog(line_queue, processes, modulo):
             except:
                 logging.warn("Couldn't parse catalog line {}".format(line))
                 continue
+
+        if skip_registered:
+            try:
+                registered[line["filename"]]
+                continue
+            except KeyError:
+                pass
             
         for field in fields:
             # Smash together misidentified lists
@@ -229,32 +241,51 @@ def parse_json_catalog(line_queue, processes, modulo):
     logging.debug("Metadata thread done after {} lines".format(i))
 
 
-def parse_catalog_multicore():
+# How many filenames to register with the textids DB in each transaction.
+REGISTER_BATCH_SIZE = 100000
+
+def parse_catalog_multicore(append = False):
+    """
+    Write the derived catalog and register every filename in it with
+    the textids DB.
+
+    With `append`, only entries whose filenames aren't registered yet are
+    parsed: they're added to the end of the derived catalog, and also
+    written on their own to jsoncatalog_appended.txt. Returns the number
+    of entries written.
+    """
     from .sqliteKV import KV
     cpus, _ = mp_stats()
     encoded_queue = Queue(10000)
     workers = []
     
     for i in range(cpus):
-        p = Process(target = parse_json_catalog, args = (encoded_queue, cpus, i))
+        p = Process(target = parse_json_catalog, args = (encoded_queue, cpus, i, append))
         p.start()
         workers.append(p)
-    output = open(".bookworm/metadata/jsoncatalog_derived.txt", "w")
+    if append:
+        output = open(".bookworm/metadata/jsoncatalog_derived.txt", "a")
+        appended = open(".bookworm/metadata/jsoncatalog_appended.txt", "w")
+    else:
+        output = open(".bookworm/metadata/jsoncatalog_derived.txt", "w")
 
     bookids = KV(".bookworm/metadata/textids.sqlite")
-    import sqlite3
+    # Filenames are registered in batches, each in one transaction.
+    batch = []
+    duplicates = 0
+    written = 0
     
     while True:
         try:
             filename, n = encoded_queue.get_nowait()
             output.write(n + "\n")
-            ids = set()
-            try:
-                bookids.register(filename)
-            except sqlite3.IntegrityError:
-                if filename in ids:
-                    logging.warning("Duplicate key insertion {}".format(filename))
-            ids.add(filename)
+            if append:
+                appended.write(n + "\n")
+            written += 1
+            batch.append(filename)
+            if len(batch) >= REGISTER_BATCH_SIZE:
+                duplicates += bookids.register_many(batch)
+                batch = []
                 
         except Empty:
             if running_processes(workers):
@@ -264,6 +295,12 @@ def parse_catalog_multicore():
             else:
                 # We're done!
                 break
-            
+
+    duplicates += bookids.register_many(batch)
+    if duplicates > 0:
+        logging.warning("Skipped {} duplicate filenames in the catalog".format(duplicates))
     bookids.close()
     output.close()
+    if append:
+        appended.close()
+    return written
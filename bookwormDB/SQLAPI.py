@@ -29,8 +29,8 @@ class DbConnect(object):
         
         self.dbname = database
         
-        import bookwormDB.configuration
-        conf = bookwormDB.configuration.Configfile("read_only").config
+        from .mariaDB import read_only_config
+        conf = read_only_config()
 
         if database is None:
             database = prefs['database']
@@ -39,8 +39,8 @@ class DbConnect(object):
             "db": database,
             "use_unicode": 'True',
             "charset": 'utf8',
-            "user": conf.get("client", "user"),
-            "password": conf.get("client", "password")
+            "user": conf["user"],
+            "password": conf["password"]
         }
 
         if host:
@@ -48,11 +48,10 @@ class DbConnect(object):
         # For back-compatibility:
         elif "HOST" in prefs:
             connargs['host'] = prefs['HOST']
+        elif conf["host"]:
+            connargs['host'] = conf["host"]
         else:
-            try:
-                connargs['host'] = conf.get("client", "host")
-            except:
-                connargs['host'] = "localhost"
+            connargs['host'] = "localhost"
             
         try:
             self.db = MySQLdb.connect(**connargs)
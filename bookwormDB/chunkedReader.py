@@ -0,0 +1,214 @@
+import os
+import gzip
+import struct
+import zlib
+import logging
+
+"""
+Split a bookworm input file among several worker processes so that
+each worker reads (and decompresses) only its own share of the file.
+
+Plain text files are split into byte ranges, and a worker owns every
+line that *starts* inside its range: so it skips the partial line it
+lands in, and reads past the end of its range to finish the last line
+it owns.
+
+bgzip files (as produced by `bgzip` from htslib) are a series of
+independently compressed gzip blocks, so they can be split the same way
+on block boundaries. Ordinary gzip files are a single compressed stream
+that can't be entered in the middle: for those, every worker has to
+decompress the whole file and keep every nth line.
+"""
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+# Large enough that a read will almost always contain a whole block header.
+BGZF_SEARCH_SIZE = 2**17
+
+
+def is_bgzf(path):
+    """
+    Is the file block-gzipped? bgzip sets the gzip FEXTRA flag and
+    stores the compressed block size in an extra subfield labelled 'BC'.
+    """
+    with open(path, "rb") as fin:
+        header = fin.read(18)
+    return len(header) == 18 and header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def _bgzf_block_size(header):
+    """
+    The size of a bgzip block, given at least its first 18 bytes,
+    or None if this isn't the start of a block.
+    """
+    if len(header) < 18 or header[:4] != BGZF_MAGIC:
+        return None
+    xlen, = struct.unpack("<H", header[10:12])
+    if xlen < 6 or header[12:14] != b"BC":
+        return None
+    bsize, = struct.unpack("<H", header[16:18])
+    return bsize + 1
+
+
+def _next_bgzf_block(fin, offset, filesize):
+    """
+    The offset of the first bgzip block at or after `offset`.
+
+    Candidate headers are confirmed by checking that another block (or the
+    end of the file) follows where the header says the block ends, which rules
+    out compressed bytes that happen to look like a header.
+    """
+    while offset < filesize:
+        fin.seek(offset)
+        data = fin.read(BGZF_SEARCH_SIZE + 18)
+        i = data.find(BGZF_MAGIC)
+        while i >= 0:
+            candidate = offset + i
+            fin.seek(candidate)
+            size = _bgzf_block_size(fin.read(18))
+            if size is not None:
+                end = candidate + size
+                if end == filesize:
+                    return candidate
+                fin.seek(end)
+                if end < filesize and _bgzf_block_size(fin.read(18)) is not None:
+                    return candidate
+            i = data.find(BGZF_MAGIC, i + 1)
+        offset += BGZF_SEARCH_SIZE
+    return filesize
+
+
+def _next_line(fin, offset, filesize):
+    """
+    The offset of the first line that starts after `offset`.
+    """
+    if offset == 0:
+        return 0
+    fin.seek(offset)
+    fin.readline()
+    return min(fin.tell(), filesize)
+
+
+def input_chunks(path, n):
+    """
+    Split `path` into `n` (start, end) byte ranges, one per worker.
+
+    For text files the ranges are newline-aligned; for bgzip files they
+    are aligned on compressed blocks. Returns None for an ordinary gzip file,
+    which can't be split.
+    """
+    filesize = os.path.getsize(path)
+    if path.endswith(".gz"):
+        if not is_bgzf(path):
+            logging.warning("{} is gzipped but not with bgzip: every worker will "
+                            "have to decompress the whole file. Recompress it with "
+                            "`bgzip` to let each worker read only its share.".format(path))
+            return None
+        boundary = _next_bgzf_block
+    else:
+        boundary = _next_line
+
+    starts = []
+    with open(path, "rb") as fin:
+        for i in range(n):
+            starts.append(boundary(fin, filesize * i // n, filesize))
+    ends = starts[1:] + [filesize]
+    return list(zip(starts, ends))
+
+
+def _read_text_chunk(path, start, end):
+    with open(path, "rb") as fin:
+        if start > 0:
+            # Back up a byte to find out whether we begin on a line boundary.
+            fin.seek(start - 1)
+            fin.readline()
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            yield line.decode("utf-8")
+
+
+def _bgzf_blocks(fin, start):
+    """
+    Yield the (offset, decompressed data) of every block from `start` onwards.
+    """
+    fin.seek(start)
+    offset = start
+    while True:
+        header = fin.read(18)
+        if len(header) < 18:
+            return
+        size = _bgzf_block_size(header)
+        if size is None:
+            raise IOError("Corrupt bgzip block at byte {}".format(offset))
+        block = header + fin.read(size - 18)
+        yield offset, zlib.decompress(block, 31)
+        offset += size
+
+
+def _read_bgzf_chunk(path, start, end):
+    """
+    Uncompressed offsets aren't known in advance, so the rule is shifted by
+    a byte: a chunk owns the lines that start after the beginning of its
+    first block and no later than the end of its last one. Every chunk but
+    the first skips the line it starts in, which the previous chunk owns.
+    """
+    with open(path, "rb") as fin:
+        skip_partial = start > 0
+        # The decompressed length of the chunk's own blocks; final once
+        # a block past the end has been read.
+        owned = 0
+        # The decompressed offset of the start of the current line.
+        position = 0
+        pending = []
+        for offset, data in _bgzf_blocks(fin, start):
+            if offset < end:
+                owned += len(data)
+            lines = data.split(b"\n")
+            pending.append(lines[0])
+            if len(lines) == 1:
+                continue
+            lines[0] = b"".join(pending)
+            pending = [lines.pop()]
+            for line in lines:
+                if position > owned:
+                    return
+                if skip_partial:
+                    skip_partial = False
+                else:
+                    yield (line + b"\n").decode("utf-8")
+                position += len(line) + 1
+        remainder = b"".join(pending)
+        if remainder and not skip_partial and position <= owned:
+            yield remainder.decode("utf-8")
+
+
+def chunk_lines(path, i, n, chunks=None):
+    """
+    Yield the lines of `path` that belong to worker `i` of `n`.
+
+    `chunks` should be the output of `input_chunks(path, n)`, computed once
+    in the parent process; if it's None, fall back on reading the whole
+    file and keeping every nth line.
+    """
+    if chunks is None:
+        if path.endswith(".gz"):
+            fin = gzip.open(path, 'rt')
+        else:
+            fin = open(path)
+        with fin:
+            for ii, line in enumerate(fin):
+                if ii % n == i:
+                    yield line
+        return
+
+    start, end = chunks[i]
+    if start >= end:
+        return
+    if path.endswith(".gz"):
+        lines = _read_bgzf_chunk(path, start, end)
+    else:
+        lines = _read_text_chunk(path, start, end)
+    for line in lines:
+        yield line
@@ -1,10 +1,17 @@
 import sys
 import os
 import bounter
+import heapq
+import shutil
+from itertools import groupby
 from collections import Counter
-from .tokenizer import Tokenizer, tokenBatches, PreTokenized
+from .tokenizer import Tokenizer, tokenBatches, PreTokenized, buildDictionaryTable, buildIDTable
+from .tokenizer import removeUncommittedBatches, getCompletedFilenames
+from .tokenizer import committedBatches, gram_lengths
 from multiprocessing import Process, Queue, Pool
 from .multiprocessingHelp import mp_stats, running_processes
+from .chunkedReader import input_chunks, chunk_lines
+from .encodedCounts import binary_chunks
 import multiprocessing as mp
 import psutil
 import queue
@@ -12,6 +19,7 @@ import logging
 import fileinput
 import time
 import csv
+import numpy as np
 
 cpus, memory = mp_stats()
 
@@ -30,7 +38,6 @@ QUEUE_POST_THRESH = max([100000, QUEUE_POST_THRESH])
 logging.info("Filling dicts to size {}".format(QUEUE_POST_THRESH))
 
 import random
-import gzip
 
 def flush_counter(counter, qout):
     for k in ['', '\x00']:
@@ -38,14 +45,49 @@ def flush_counter(counter, qout):
             del counter[k]
         except KeyError:
             continue
-        qout.put(counter)
-        
-def counter(qout, i, fin, mode = "count"):
+    qout.put(counter)
+
+def spill_counter(counter, path):
+    """
+    Write a counter to disk as a run of 'word\tcount' lines sorted by word,
+    to be merged later by `merge_runs`. Words that can't be stored in a
+    tab-separated wordlist are dropped.
+    """
+    with open(path, "w", encoding = "utf-8", newline = "\n") as fout:
+        for k in sorted(counter):
+            if k in ['', '\x00'] or "\t" in k or "\n" in k or "\r" in k:
+                continue
+            fout.write("{}\t{}\n".format(k, counter[k]))
+
+def read_run(path):
+    with open(path, encoding = "utf-8", newline = "\n") as fin:
+        for line in fin:
+            k, v = line[:-1].split("\t")
+            yield k, int(v)
+
+def merge_runs(paths):
+    """
+    K-way merge of sorted runs from `spill_counter`, yielding each word
+    once, in sorted order, with its total count.
+    """
+    runs = heapq.merge(*[read_run(path) for path in paths], key = lambda x: x[0])
+    for k, group in groupby(runs, key = lambda x: x[0]):
+        yield k, sum(v for _, v in group)
+
+def counter(qout, i, fin, mode = "count", chunks = None, output_format = "tsv", rundir = None, skip = frozenset(), keep_oov = False):
     """
     # Counts words exactly in a separate process.
     # It runs in place.
     If mode is 'encode', this is called for a side-effect of writing
     files to disk.
+
+    Each worker reads only its own chunk of the input: see
+    `chunkedReader.input_chunks`.
+
+    When counting, partial counts are posted to `qout` for the parent
+    to sum; or, if `rundir` is given, written there as sorted runs.
+    When encoding, filenames in `skip` have already been encoded, and
+    `keep_oov` keeps the counts that can't be encoded: see `tokenBatches`.
     """
 
     totals = 0
@@ -54,9 +96,18 @@ def counter(qout, i, fin, mode = "count"):
     if mode == "count":
         counter = Counter()
         encoder = tokenBatches(['words'])
+        runs = 0
+
+        def flush(counter):
+            nonlocal runs
+            if rundir is None:
+                flush_counter(counter = counter, qout = qout)
+            else:
+                spill_counter(counter, os.path.join(rundir, "{}-{}.txt".format(i, runs)))
+                runs += 1
         
     if mode == "encode":
-        encoder = tokenBatches(['unigrams', 'bigrams'])
+        encoder = tokenBatches(['unigrams', 'bigrams'], output_format, keep_oov = keep_oov)
         
     datatype = "raw"
     
@@ -65,24 +116,18 @@ def counter(qout, i, fin, mode = "count"):
         if signal in fin:
             datatype = signal.strip(".")
             if mode == "encode":
-                encoder = tokenBatches([datatype])            
+                encoder = tokenBatches([datatype], output_format, keep_oov = keep_oov)            
         
-    if (fin.endswith(".gz")):
-        fin = gzip.open(fin, 'rt')
-    else:
-        fin = open(fin)
-
-    
-    for ii, row in enumerate(fin):
-        if ii % cpus != i:
-            # Don't do anything on most lines.
-            continue
+    for row in chunk_lines(fin, i, cpus, chunks):
         totals += 1
         try:
             (filename, text) = row.rstrip().split("\t",1)
         except ValueError:
             errors += 1
             continue
+
+        if filename in skip:
+            continue
         
         if datatype == "raw":
             tokenizer = Tokenizer(text)
@@ -99,13 +144,13 @@ def counter(qout, i, fin, mode = "count"):
             
         # When the counter is long, post it to the master and clear it.
         if len(counter) > QUEUE_POST_THRESH:
-            flush_counter(counter=counter, qout = qout)
+            flush(counter)
             counter = Counter()
 
     # Cleanup.
     if mode == "count":
         logging.debug("Flushing leftover counts from thread {}".format(i))
-        flush_counter(counter=counter, qout = qout)
+        flush(counter)
         if totals > 0 and errors/totals > 0.01:
             logging.warning("Skipped {} rows without tabs".format(errors))
     if mode == "encode":
@@ -114,9 +159,10 @@ def counter(qout, i, fin, mode = "count"):
 def create_counts(input):
     qout = Queue(cpus * 2)
     workers = []
+    chunks = input_chunks(input, cpus)
     logging.info("Spawning {} count processes on {}".format(cpus, input))
     for i in range(cpus):
-        p = Process(target = counter, args = (qout, i, input, "count"))
+        p = Process(target = counter, args = (qout, i, input, "count", chunks))
         p.start()
         workers.append(p)
 
@@ -147,24 +193,194 @@ def create_counts(input):
         
     return wordcounter
 
-def create_wordlist(n, input, output):
-    
-    counter = create_counts(input)
-    counter = sorted(list(counter.iteritems()), key = lambda x: -1 * x[1])
-    output = open(output, "w")
-    for i, (k, v) in enumerate(counter):
-        output.write("{}\t{}\t{}\n".format(i, k, v))
-        if i >= n:
-            break
+def create_exact_counts(input, rundir):
+    """
+    Count every word exactly. Each worker spills sorted runs into `rundir`
+    whenever its counter grows past QUEUE_POST_THRESH, so memory use stays
+    bounded; the runs are then merged on disk.
+
+    Returns an iterator over (word, count) pairs in sorted order.
+    """
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    workers = []
+    chunks = input_chunks(input, cpus)
+    logging.info("Spawning {} exact count processes on {}".format(cpus, input))
+    for i in range(cpus):
+        p = Process(target = counter, args = (None, i, input, "count", chunks, "tsv", rundir))
+        p.start()
+        workers.append(p)
+
+    for p in workers:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError("Count process exited with code {}".format(p.exitcode))
+
+    paths = [os.path.join(rundir, f) for f in os.listdir(rundir)]
+    logging.info("Merging {} sorted runs of counts".format(len(paths)))
+    return merge_runs(paths)
+
+def create_wordlist(n, input, output, exact = False):
+    """
+    Write the `n` most common words to `output`, ranked by count; ties
+    are broken alphabetically so that ranks are stable between builds.
+
+    With `exact`, counts are true totals from an on-disk merge rather
+    than bounter's approximations.
+    """
+    n = int(n)
+    if exact:
+        rundir = os.path.join(os.path.dirname(output), "runs")
+        counts = create_exact_counts(input, rundir)
+    else:
+        counts = create_counts(input).iteritems()
+    top = heapq.nsmallest(n + 1, counts, key = lambda x: (-x[1], x[0]))
+    with open(output, "w") as fout:
+        for i, (k, v) in enumerate(top):
+            fout.write("{}\t{}\t{}\n".format(i, k, v))
+    if exact:
+        shutil.rmtree(rundir)
         
-def encode_words(wordlist, input = "input.txt"):
+def encode_words(wordlist, input = "input.txt", output_format = "tsv", resume = False, keep_oov = False):
+    """
+    Encode the input into batches of files under .bookworm/texts/encoded.
+
+    With `resume`, files from batches that never committed are removed,
+    and filenames from those that did are skipped. With `keep_oov`, the
+    counts of ngrams outside the wordlist are kept for `encode_oov`.
+    """
     qout = Queue(cpus * 2)
     workers = []
+    chunks = input_chunks(input, cpus)
+
+    skip = frozenset()
+    if resume:
+        removeUncommittedBatches()
+        level = "unigrams"
+        for signal in [".unigrams", ".bigrams", ".trigrams", ".quadgrams"]:
+            if signal in input:
+                level = signal.strip(".")
+        # Read once here: the workers inherit it when they fork.
+        skip = frozenset(getCompletedFilenames(level))
+        logging.info("Resuming: skipping {} files already encoded".format(len(skip)))
+
+    # Build the vocabulary and bookid tables once, for every worker to map.
+    logging.info("Building shared lookup tables for the wordlist and bookids")
+    buildDictionaryTable()
+    buildIDTable()
 
     for i in range(cpus):
-        p = Process(target = counter, args = (qout, i, input, "encode"))
+        p = Process(target = counter, args = (qout, i, input, "encode", chunks, output_format, None, skip, keep_oov))
         p.start()
         workers.append(p)
 
     while running_processes(workers):
         time.sleep(1/30)
+
+# Wordids are stored as MEDIUMINT UNSIGNED.
+MAX_WORDID = 2**24 - 1
+
+def oov_paths(level):
+    """
+    The out-of-vocabulary side files of every committed batch at a level.
+    """
+    folder = ".bookworm/texts/encoded/oov/" + level
+    if not os.path.exists(folder):
+        return []
+    batches = committedBatches()
+    return [folder + "/" + f for f in sorted(os.listdir(folder))
+            if not f.endswith(".tmp") and f.split(".")[0] in batches]
+
+def read_oov_words(path):
+    """
+    The words a batch numbered in its OOV side files, in order, and
+    their unigram counts.
+    """
+    words = []
+    counts = []
+    for line in open(path):
+        word, count = line.rstrip("\n").split("\t")
+        words.append(word)
+        counts.append(int(count))
+    return words, counts
+
+def extend_wordlist(wordlist, min_count = 2, max_words = None):
+    """
+    Add the most common words from the unigram OOV side files to the end
+    of `wordlist`, with wordids after the largest one already there.
+    Wordids already assigned don't change, so nothing encoded needs to be.
+
+    Only words seen at least `min_count` times are added, and no more
+    than `max_words` of them. Returns the (wordid, word, count) of each
+    word added.
+    """
+    known = set()
+    last = -1
+    for line in open(wordlist):
+        wordid, word, count = line.rstrip("\n").split("\t")
+        known.add(word)
+        last = max(last, int(wordid))
+
+    totals = Counter()
+    for path in oov_paths("words"):
+        words, counts = read_oov_words(path)
+        for word, count in zip(words, counts):
+            totals[word] += count
+    # Words added by an earlier extension are still in the side files.
+    candidates = [(word, count) for word, count in totals.items()
+                  if count >= min_count and word not in known]
+    limit = MAX_WORDID - last
+    if max_words is not None:
+        limit = min(limit, max_words)
+    if len(candidates) > limit:
+        logging.warning("Only adding {} of {} new words".format(limit, len(candidates)))
+    top = heapq.nsmallest(limit, candidates, key = lambda x: (-x[1], x[0]))
+
+    added = [(last + 1 + i, word, count) for i, (word, count) in enumerate(top)]
+    with open(wordlist, "a") as fout:
+        for wordid, word, count in added:
+            fout.write("{}\t{}\t{}\n".format(wordid, word, count))
+        fout.flush()
+        os.fsync(fout.fileno())
+    logging.info("Added {} words to the wordlist".format(len(added)))
+    return added
+
+def encode_oov(added, output_format = "tsv", levels = ["unigrams", "bigrams"]):
+    """
+    Encode the ngrams from the OOV side files that the words in `added`
+    complete: those whose words are now all in the wordlist, at least one
+    of them just added. (Any other ngram was either encoded already, or
+    still can't be.)
+
+    The counts are written as a committed batch of their own, with no
+    filenames in its completed list; its nwords file holds what they add
+    to each book's total. Returns the batch id.
+    """
+    new = set([word for wordid, word, count in added])
+    buildDictionaryTable()
+    batch = tokenBatches(levels, output_format)
+    batch.attachDictionaryAndID()
+    batch.createOutputFiles()
+    for level in levels:
+        n = gram_lengths[level]
+        for path in oov_paths(level):
+            # Translate the batch's numbering into wordids.
+            batch_id = os.path.basename(path).split(".")[0]
+            words, _ = read_oov_words(".bookworm/texts/encoded/oov/words/{}.txt".format(batch_id))
+            if len(words) == 0:
+                continue
+            wordids = batch.lookup(words)
+            added_here = np.array([word in new for word in words])
+            for chunk in binary_chunks(path):
+                grams = wordids[chunk[:, 1:n + 1]]
+                keep = (grams >= 0).all(axis=1) & added_here[chunk[:, 1:n + 1]].any(axis=1)
+                if not keep.any():
+                    continue
+                output = np.array(chunk[keep], dtype=np.uint32)
+                output[:, 1:n + 1] = grams[keep]
+                batch.writeRows(level, output)
+                if level == "unigrams":
+                    batch.writeNwords(output)
+    batch.commit()
+    return batch.id
@@ -0,0 +1,237 @@
+import os
+import logging
+from .mariaDB import Query, databaseSchema
+from .bwExceptions import BookwormException
+
+"""
+An embedded, columnar copy of a bookworm, to answer API queries on a
+single machine without a MySQL server.
+
+`export_duckdb` copies the tables that queries read from MySQL into a
+single DuckDB file. `DuckDBQuery` writes the same SQL as `mariaDB.Query`
+with the few changes DuckDB needs, and DuckDB runs it as vectorized
+scans over the columns: grouped aggregates over the whole catalog read
+only the columns they use.
+
+duckdb is only imported when it is used, so MySQL installations don't
+need it.
+"""
+
+DEFAULT_DIRECTORY = ".bookworm/duckdb"
+
+# The tables a query can read besides the on-disk copies of the memory
+# tables, which all end in "_".
+EXPORTED_TABLES = ["master_bookcounts", "master_bigrams", "catalog",
+                   "masterVariableTable", "masterTableTable"]
+
+# Sorting the counts by word lets DuckDB skip every row group that
+# can't hold the words searched for.
+SORT_KEYS = {
+    "master_bookcounts": "wordid, bookid",
+    "master_bigrams": "word1, word2, bookid"
+}
+
+
+def duckdb_path(database, directory=DEFAULT_DIRECTORY):
+    return os.path.join(directory, database + ".duckdb")
+
+
+def duckdb_type(data_type, column_type):
+    """
+    The DuckDB type to store a MySQL column in, from its DATA_TYPE and
+    COLUMN_TYPE in information_schema.
+    """
+    unsigned = "unsigned" in column_type
+    if data_type in ["tinyint", "smallint", "mediumint", "year"]:
+        return "INTEGER"
+    if data_type == "int":
+        return "BIGINT" if unsigned else "INTEGER"
+    if data_type == "bigint":
+        return "UBIGINT" if unsigned else "BIGINT"
+    if data_type in ["float", "double", "decimal"]:
+        return "DOUBLE"
+    if data_type == "date":
+        return "DATE"
+    if data_type in ["datetime", "timestamp"]:
+        return "TIMESTAMP"
+    return "VARCHAR"
+
+
+def exported_tables(cursor):
+    """
+    The MySQL tables that queries read.
+
+    Memory tables aren't copied: their on-disk copies, whose names end
+    in "_", are.
+    """
+    cursor.execute("SHOW TABLES")
+    tables = [row[0] for row in cursor.fetchall()]
+    return [table for table in tables
+            if table in EXPORTED_TABLES or table.endswith("_")]
+
+
+def copy_table(conn, out, table, chunksize=1000000):
+    """
+    Stream a MySQL table into a new table of the same name in `out`.
+    """
+    import pandas as pd
+    import MySQLdb.cursors
+
+    cursor = conn.cursor()
+    cursor.execute("""SELECT COLUMN_NAME, DATA_TYPE, COLUMN_TYPE
+                      FROM information_schema.COLUMNS
+                      WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
+                      ORDER BY ORDINAL_POSITION""", (table,))
+    columns = cursor.fetchall()
+    names = [name for (name, data_type, column_type) in columns]
+    definition = ", ".join('"{}" {}'.format(name, duckdb_type(data_type, column_type))
+                           for (name, data_type, column_type) in columns)
+
+    target = table
+    if table in SORT_KEYS:
+        target = table + "_unsorted"
+    out.execute('CREATE TABLE "{}" ({})'.format(target, definition))
+
+    # An unbuffered cursor, so the table is never all in memory.
+    cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    cursor.execute("SELECT {} FROM {}".format(", ".join("`{}`".format(name) for name in names), table))
+    rows = 0
+    while True:
+        chunk = cursor.fetchmany(chunksize)
+        if len(chunk) == 0:
+            break
+        out.register("chunk", pd.DataFrame.from_records(chunk, columns=names))
+        out.execute('INSERT INTO "{}" SELECT * FROM chunk'.format(target))
+        out.unregister("chunk")
+        rows += len(chunk)
+    cursor.close()
+
+    if table in SORT_KEYS:
+        out.execute('CREATE TABLE "{}" AS SELECT * FROM "{}" ORDER BY {}'.format(table, target, SORT_KEYS[table]))
+        out.execute('DROP TABLE "{}"'.format(target))
+    logging.info("Copied {} rows of {}".format(rows, table))
+
+
+def export_duckdb(conn, path):
+    """
+    Copy the tables a bookworm's queries read from the MySQL connection
+    `conn` into a DuckDB file at `path`.
+
+    Each on-disk table also gets a view under the name of its memory
+    table, so queries are written exactly as they are against MySQL.
+    The file is written under a temporary name and moved into place, so
+    a server never opens a partial copy.
+    """
+    import duckdb
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    out = duckdb.connect(tmp)
+    tables = exported_tables(conn.cursor())
+    for table in tables:
+        copy_table(conn, out, table)
+    for table in tables:
+        if table.endswith("_") and table[:-1] not in tables:
+            out.execute('CREATE VIEW "{}" AS SELECT * FROM "{}"'.format(table[:-1], table))
+    # Everything is in one table, however master_bookcounts was split.
+    out.execute("CREATE TABLE masterPartitionTable (tablename VARCHAR, min_wordid INTEGER, max_wordid INTEGER)")
+    out.execute("CHECKPOINT")
+    out.close()
+    os.replace(tmp, path)
+
+
+class DuckDBCursor(object):
+    """
+    The parts of a MySQLdb cursor that `Query` and `databaseSchema` use.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.result = None
+
+    def execute(self, query, args=None):
+        if args is None:
+            self.result = self.db.execute(query)
+        else:
+            self.result = self.db.execute(query.replace("%s", "?"), list(args))
+        return self.result
+
+    def fetchall(self):
+        return self.result.fetchall()
+
+
+class DuckDBConnect(object):
+    """
+    Stands in for `mariaDB.DbConnect`, with the same `db` and `cursor`
+    attributes, over a read-only copy from `export_duckdb`.
+    """
+
+    def __init__(self, database=None, directory=DEFAULT_DIRECTORY):
+        import duckdb
+
+        if database is None:
+            raise BookwormException("You must specify a database")
+        self.dbname = database
+        path = duckdb_path(database, directory)
+        if not os.path.exists(path):
+            raise BookwormException({"code": 404, "message": "There is no DuckDB copy of {} at {}".format(database, path)})
+        self.db = duckdb.connect(path, read_only=True)
+        self.cursor = DuckDBCursor(self.db)
+
+
+class DuckDBQuery(Query):
+    """
+    A `Query` written for DuckDB. Pass it a `DuckDBConnect` as `db`.
+    """
+
+    dialect = "duckdb"
+
+    def load_schema(self):
+        # Reading the schema from a local file is cheap enough not to cache.
+        return databaseSchema(self.db)
+
+    def make_group_query(self):
+        """
+        MySQL groups on the integer `__id` aliases while selecting the
+        names they stand for; DuckDB only selects columns that are
+        grouped on, so group on the names.
+        """
+        groups = self.query_object["groups"]
+        if len(groups) > 0:
+            return "GROUP BY {}".format(", ".join(groups))
+        else:
+            return " "
+
+    def anchor_depth(self, table):
+        """
+        How many tables lie between `table` and the catalog or words table
+        it hangs off.
+        """
+        depth = 0
+        anchors = self.databaseScheme.anchorFields
+        while table in anchors and anchors[table] != table and depth < 100:
+            table = self.databaseScheme.fallback_table(anchors[table])
+            depth += 1
+        return depth
+
+    def make_join_query(self):
+        """
+        MySQL takes a NATURAL JOIN of tables with no columns in common
+        as a cross join, and sorts it out with the joins that follow;
+        DuckDB refuses it. So join each table after the one it hangs off.
+        """
+        tables = self.full_query_tables()
+        tables = tables[:1] + sorted(tables[1:], key=self.anchor_depth)
+        return " NATURAL JOIN ".join(tables)
+
+    def outer_group_query(self, group_query):
+        # DuckDB won't select the ungrouped counts from the subquery.
+        return " "
+
+    def bibliography_query(self, limit="100"):
+        return Query.bibliography_query(self, limit).replace("RAND()", "random()")
@@ -0,0 +1,98 @@
+import os
+import struct
+import numpy as np
+
+"""
+Reading and writing the encoded count files under
+.bookworm/texts/encoded: each holds rows of unsigned integers
+like (bookid, wordid, count) for unigrams or
+(bookid, word1, word2, count) for bigrams.
+
+They come in two formats. '.txt' files are tab-separated text that
+MySQL can read directly with LOAD DATA INFILE. '.bin' files are a
+compact binary format: a short header, followed by fixed-width rows of
+little-endian unsigned 32-bit integers that can be memory-mapped
+without any parsing.
+
+The binary header is:
+
+    8 bytes   magic number, b"BWCOUNTS"
+    2 bytes   format version (uint16)
+    2 bytes   number of columns (uint16)
+    16 bytes  for each column, its name in ASCII, padded with nulls.
+
+(24-bit columns would save another quarter on wordids and counts, but
+numpy can't memory-map them, so every column is 32 bits wide.)
+"""
+
+MAGIC = b"BWCOUNTS"
+VERSION = 1
+NAME_WIDTH = 16
+DTYPE = np.dtype("<u4")
+
+# Rows per chunk when streaming a file.
+CHUNKSIZE = 2**20
+
+
+def format_rows(array):
+    """
+    Format an integer array as tab-separated lines: building a single format
+    string for the whole array is much faster than formatting row by row.
+    """
+    if len(array) == 0:
+        return ""
+    line = "\t".join(["%d"] * array.shape[1]) + "\n"
+    return (line * array.shape[0]) % tuple(array.ravel().tolist())
+
+
+def binary_header(columns):
+    header = MAGIC + struct.pack("<HH", VERSION, len(columns))
+    for column in columns:
+        header += column.encode("ascii").ljust(NAME_WIDTH, b"\x00")
+    return header
+
+
+def write_binary_rows(fout, array):
+    fout.write(np.ascontiguousarray(array, dtype=DTYPE).tobytes())
+
+
+def read_binary_header(fin):
+    """
+    Returns the column names and the length of the header in bytes.
+    """
+    start = fin.read(len(MAGIC) + 4)
+    if start[:len(MAGIC)] != MAGIC:
+        raise IOError("{} is not a bookworm binary count file".format(fin.name))
+    version, ncols = struct.unpack("<HH", start[len(MAGIC):])
+    if version != VERSION:
+        raise IOError("Unknown binary count file version {} in {}".format(version, fin.name))
+    columns = []
+    for i in range(ncols):
+        columns.append(fin.read(NAME_WIDTH).rstrip(b"\x00").decode("ascii"))
+    return columns, len(start) + NAME_WIDTH * ncols
+
+
+def read_binary_counts(path):
+    """
+    Memory-map a binary count file.
+
+    Returns a list of column names and a read-only (rows x columns)
+    uint32 array. A partly written last row (as from a crash) is ignored.
+    """
+    with open(path, "rb") as fin:
+        columns, offset = read_binary_header(fin)
+    nrows = (os.path.getsize(path) - offset) // (DTYPE.itemsize * len(columns))
+    if nrows == 0:
+        return columns, np.zeros((0, len(columns)), dtype=DTYPE)
+    array = np.memmap(path, dtype=DTYPE, mode="r", offset=offset,
+                      shape=(nrows, len(columns)))
+    return columns, array
+
+
+def binary_chunks(path, chunksize=CHUNKSIZE):
+    """
+    Yield successive blocks of rows from a binary count file.
+    """
+    _, array = read_binary_counts(path)
+    for start in range(0, len(array), chunksize):
+        yield array[start:start + chunksize]
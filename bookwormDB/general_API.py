@@ -2,18 +2,25 @@
 
 from pandas import merge
 from pandas import Series
+from pandas import DataFrame
 from pandas.io.sql import read_sql
 from pandas import merge
 from pandas import set_option
 from copy import deepcopy
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, Future
+from pandas import concat
 from .SQLAPI import DbConnect
 from .SQLAPI import userquery
 from .mariaDB import Query
+from .mariaDB import pool
+from .duckdbAPI import DuckDBConnect, DuckDBQuery, DEFAULT_DIRECTORY, duckdb_path
 from .bwExceptions import BookwormException
 import re
+import os
 import json
 import logging
+import threading
 import numpy as np
 import csv
 import io
@@ -26,10 +33,15 @@ bag-of-words summary statistics according to the API description.
 It is not bound to any particular backend: instead, a subset of 
 methods in the API must be supported by subclassing APICall().
 
-The only existing example of this is "SQLAPICall."
+The main example of this is "SQLAPICall"; "DuckDBAPIcall" answers the
+same calls from an embedded DuckDB copy of a bookworm.
 """
 
 # Some settings can be overridden here, if nowhere else.
+# 'duckdb_directory' is where DuckDBAPIcall looks for its copies;
+# 'result_cache' is a resultCache.ResultCache to answer repeated
+# queries from; 'multi_execute_workers' is how many of the searches in
+# one query run at once (4 by default).
 
 prefs = dict()
 
@@ -224,6 +236,32 @@ def base_count_types(list_of_final_count_types):
     return [list(subq), list(superq)]
 
 
+class SharedFrames(object):
+    """
+    The frames fetched for the searches of one multi_execute, by call.
+    Searches that differ only in their words have the same comparison
+    call, and it is fetched once, even when they ask for it at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = dict()
+
+    def get(self, call, fetch):
+        key = json.dumps(call, sort_keys = True, default = str)
+        with self.lock:
+            future = self.futures.get(key)
+            first = future is None
+            if first:
+                future = Future()
+                self.futures[key] = future
+        if first:
+            try:
+                future.set_result(fetch(call))
+            except Exception as error:
+                future.set_exception(error)
+        # Each search renames the columns of its copy.
+        return future.result().copy()
+
 def is_a_wordcount_field(string):
     if string in ["unigram", "bigram", "word"]:
         return True
@@ -357,7 +395,55 @@ class APIcall(object):
         self.call2 = call2
 
 
+    def build_time(self):
+        """
+        When the database was last built or changed, if the backend can
+        tell. Cached results from before then are never used, and nothing
+        is cached for a database that can't tell.
+        """
+        return None
+
     def get_data_from_source(self):
+        """
+        Retrieves data from the backend, or from the result cache if one is
+        set in prefs['result_cache'].
+        """
+        cache = prefs.get('result_cache')
+        if cache is None:
+            return self.fetch_data_from_source()
+
+        # Without a build time, a rebuild couldn't change the key.
+        build_time = self.build_time()
+        if build_time is None:
+            return self.fetch_data_from_source()
+
+        key = cache.key(self.query, self.__class__.__name__, build_time)
+        frame = cache.get(key)
+        if frame is None:
+            frame = self.fetch_data_from_source()
+            # Errors come back as a Series, and aren't kept.
+            if isinstance(frame, DataFrame):
+                cache.put(key, frame)
+            return frame
+
+        # Fetching also rewrites the query, and formatting reads the
+        # rewritten version.
+        self.validate_query()
+        if self.query['method'] not in ['schema', 'search']:
+            self.prepare_search_and_compare_queries()
+        return frame
+
+    def fetch_frame(self, call):
+        """
+        The frame for one call, shared with the other searches of a
+        multi_execute that make the same call.
+        """
+        shared = getattr(self, "shared_frames", None)
+        if shared is None:
+            return self.generate_pandas_frame(call)
+        return shared.get(call, self.generate_pandas_frame)
+
+    def fetch_data_from_source(self):
         """
         Retrieves data from the backend, and calculates totals.
 
@@ -379,15 +465,21 @@ class APIcall(object):
         """
 
         if not need_comparison_query(self.query['counttype']):
-            df1 = self.generate_pandas_frame(self.call1)
+            df1 = self.fetch_frame(self.call1)
 #            rename(df1, "x")
             return df1[self.query['groups'] + self.query['counttype']]
 
         try:
-            df1 = self.generate_pandas_frame(self.call1)
-            rename(df1, "x")
+            # The two frames don't depend on each other, so they're
+            # fetched at once, each on its own connection. An error in
+            # either is raised here by result().
             logging.debug(self.call2)
-            df2 = self.generate_pandas_frame(self.call2)
+            with ThreadPoolExecutor(max_workers = 2) as executor:
+                future1 = executor.submit(self.fetch_frame, self.call1)
+                future2 = executor.submit(self.fetch_frame, self.call2)
+                df1 = future1.result()
+                df2 = future2.result()
+            rename(df1, "x")
             rename(df2, "y")
             
         except Exception as error:
@@ -547,29 +639,40 @@ class APIcall(object):
         """
         Queries may define several search limits in an array
         if they use the return_json method.
+
+        The searches run at once, up to prefs['multi_execute_workers'],
+        and calls that several of them make, like the comparison counts
+        of searches for different words, are only made once.
         """
-        
+
+        shared = SharedFrames()
+
+        def child_call(limits):
+            child = deepcopy(self.query)
+            child['search_limits'] = limits
+            call = self.__class__(child)
+            call.shared_frames = shared
+            return call
+
+        all_limits = self.query['search_limits']
+        workers = max(1, min(len(all_limits), prefs.get('multi_execute_workers', 4)))
+
         if version <= 2:
-            returnable = []
-            for limits in self.query['search_limits']:
-                child = deepcopy(self.query)
-                child['search_limits'] = limits
-                q = self.__class__(child).return_json(raw_python_object=True,
-                                                  version=version)
-                returnable.append(q)
+            def run(limits):
+                return child_call(limits).return_json(raw_python_object=True,
+                                                      version=version)
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                returnable = list(executor.map(run, all_limits))
             return self._prepare_response(returnable, version)
         
         if version == 3:
-            for i, limits in enumerate(self.query['search_limits']):
-                child = deepcopy(self.query)
-                child['search_limits'] = limits
-                f = self.__class__(child).data()
+            def run(limits):
+                return child_call(limits).data()
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                frames = list(executor.map(run, all_limits))
+            for i, f in enumerate(frames):
                 f['Search'] = i
-                if i == 0:
-                    frame = f
-                else:
-                    frame = frame.append(f, ignore_index = True)
-            return frame
+            return concat(frames, ignore_index = True)
 
     
     def html(self, data):
@@ -736,10 +839,66 @@ class SQLAPIcall(APIcall):
 
         if call is None:
             call = self.query
-        con = DbConnect(prefs, self.query['database'])
-        q = Query(call).query()
-        logging.debug("Preparing to execute {}".format(q)) 
-        df = read_sql(q, con.db)
+
+        def fetch(con):
+            # The query and the schema it reads share the connection.
+            q = Query(call, db = con).query()
+            logging.debug("Preparing to execute {}".format(q))
+            return read_sql(q, con.db)
+
+        df = pool.run(self.query['database'], fetch)
         logging.debug("Query retrieved")
         return df
-    
+
+    def build_time(self):
+        """
+        The time recorded in bookworm_information by the last build.
+        """
+        import MySQLdb
+
+        def fetch(con):
+            try:
+                con.cursor.execute("SELECT value FROM bookworm_information WHERE entry='build_time'")
+                return con.cursor.fetchall()
+            except MySQLdb.ProgrammingError:
+                # Bookworms built before build times were recorded.
+                return []
+
+        rows = pool.run(self.query['database'], fetch)
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+
+class DuckDBAPIcall(APIcall):
+    """
+    Runs the same queries as SQLAPIcall against a DuckDB copy of the
+    bookworm, made with `bookworm prep export_duckdb`, instead of MySQL.
+    """
+
+    def generate_pandas_frame(self, call = None):
+        if call is None:
+            call = self.query
+        con = DuckDBConnect(self.query['database'],
+                            prefs.get('duckdb_directory', DEFAULT_DIRECTORY))
+        # Closed here rather than whenever it's collected: a multi-search
+        # query opens one for every call it makes.
+        try:
+            q = DuckDBQuery(call, db = con).query()
+            logging.debug("Preparing to execute {}".format(q))
+            df = con.db.execute(q).df()
+        finally:
+            con.db.close()
+        logging.debug("Query retrieved")
+        return df
+
+    def build_time(self):
+        """
+        The time the copy was exported: every export replaces the file.
+        """
+        path = duckdb_path(self.query['database'],
+                           prefs.get('duckdb_directory', DEFAULT_DIRECTORY))
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
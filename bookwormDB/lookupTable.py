@@ -0,0 +1,202 @@
+import os
+import mmap
+import struct
+import zlib
+import numpy as np
+from itertools import repeat
+
+"""
+A read-only table from strings to integers, stored in a single file
+that any number of processes can memory-map and share.
+
+Encoding needs the full vocabulary (and the full list of bookids) in
+every worker process; as Python dicts those cost hundreds of megabytes
+apiece. The table is built once by the parent, and each worker maps the
+file and keeps only a small dict of the keys it sees most.
+
+The file is:
+
+    8 bytes   magic number, b"BWLOOKUP"
+    8 bytes   format version, number of keys (uint32 each)
+    8 bytes   number of hash slots (uint64, a power of two)
+    values    one uint32 per key
+    offsets   uint64 byte offsets of each key in the strings section,
+              plus a final end offset
+    slots     open-addressed hash index: for each slot, the key number
+              stored there (int32), or -1
+    strings   the keys, utf-8 encoded and concatenated
+
+Keys are hashed with crc32 of their utf-8 bytes, and collisions are
+resolved by linear probing. Each section starts on an 8-byte boundary.
+"""
+
+MAGIC = b"BWLOOKUP"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+
+# Never a real value: values are unsigned.
+MISSING = -2**40
+
+
+def _align(n):
+    return (n + 7) // 8 * 8
+
+
+def _layout(nkeys, nslots):
+    """
+    The byte offsets of the values, offsets, slots, and strings sections.
+    """
+    values = HEADER.size
+    offsets = _align(values + 4 * nkeys)
+    slots = _align(offsets + 8 * (nkeys + 1))
+    strings = _align(slots + 4 * nslots)
+    return values, offsets, slots, strings
+
+
+def build_lookup_table(items, path):
+    """
+    Write a table from an iterable of (string, value) pairs to `path`.
+    If a key appears more than once, its first value is kept.
+
+    The file is written under a temporary name and moved into place, so
+    a reader never sees a partial table.
+    """
+    keys = []
+    values = []
+    seen = set()
+    for key, value in items:
+        if key in seen:
+            continue
+        seen.add(key)
+        keys.append(key.encode("utf-8"))
+        values.append(value)
+    del seen
+    nkeys = len(keys)
+    nslots = 1
+    while nslots < 2 * nkeys:
+        nslots *= 2
+    mask = nslots - 1
+
+    slots = np.full(nslots, -1, dtype="<i4")
+    for i, key in enumerate(keys):
+        slot = zlib.crc32(key) & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+
+    offsets = np.zeros(nkeys + 1, dtype="<u8")
+    np.cumsum([len(key) for key in keys], out=offsets[1:])
+
+    sections = zip(_layout(nkeys, nslots),
+                   [np.array(values, dtype="<u4").tobytes(), offsets.tobytes(), slots.tobytes()])
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fout:
+        fout.write(HEADER.pack(MAGIC, VERSION, nkeys, nslots))
+        for start, data in sections:
+            fout.write(b"\x00" * (start - fout.tell()))
+            fout.write(data)
+        fout.write(b"\x00" * (_layout(nkeys, nslots)[3] - fout.tell()))
+        for key in keys:
+            fout.write(key)
+    os.replace(tmp, path)
+
+
+class LookupTable(object):
+    """
+    A memory-mapped table from `build_lookup_table`, which behaves like a
+    read-only dict.
+
+    The `preload` first keys are read into a per-process dict when the
+    table is opened: for a wordlist, which is sorted by frequency, those
+    are the most common words. Other keys are cached as they are
+    looked up until the cache holds `cache_size` of them.
+    """
+
+    def __init__(self, path, preload=2**16, cache_size=2**18):
+        self.path = path
+        with open(path, "rb") as fin:
+            self.mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nkeys, nslots = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise IOError("{} is not a bookworm lookup table".format(path))
+        if version != VERSION:
+            raise IOError("Unknown lookup table version {} in {}".format(version, path))
+        self.nkeys = nkeys
+        self.mask = nslots - 1
+        values, offsets, slots, self.strings = _layout(nkeys, nslots)
+        self.view = view = memoryview(self.mmap)
+        self.values = view[values:values + 4 * nkeys].cast("I")
+        self.offsets = view[offsets:offsets + 8 * (nkeys + 1)].cast("Q")
+        self.slots = view[slots:slots + 4 * nslots].cast("i")
+        self.cache_size = cache_size
+        self.cache = dict()
+        for i in range(min(preload, nkeys)):
+            self.cache[self.key(i)] = self.values[i]
+
+    def key(self, i):
+        start = self.strings + self.offsets[i]
+        end = self.strings + self.offsets[i + 1]
+        return self.mmap[start:end].decode("utf-8")
+
+    def _find(self, key):
+        """
+        The value for a key from the hash index, or MISSING.
+        """
+        encoded = key.encode("utf-8")
+        slot = zlib.crc32(encoded) & self.mask
+        while True:
+            i = self.slots[slot]
+            if i < 0:
+                return MISSING
+            start = self.strings + self.offsets[i]
+            end = self.strings + self.offsets[i + 1]
+            if self.mmap[start:end] == encoded:
+                return self.values[i]
+            slot = (slot + 1) & self.mask
+
+    def _get(self, key):
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        value = self._find(key)
+        if len(self.cache) < self.cache_size:
+            self.cache[key] = value
+        return value
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value == MISSING:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self._get(key)
+        if value == MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._get(key) != MISSING
+
+    def __len__(self):
+        return self.nkeys
+
+    def lookup(self, keys, default=-1):
+        """
+        Translate a list of keys into an int64 array of values, with
+        `default` for keys not in the table.
+        """
+        output = np.fromiter(map(self.cache.get, keys, repeat(MISSING)),
+                             dtype=np.int64, count=len(keys))
+        for i in np.flatnonzero(output == MISSING):
+            output[i] = self._get(keys[i])
+        output[output == MISSING] = default
+        return output
+
+    def close(self):
+        self.values.release()
+        self.offsets.release()
+        self.slots.release()
+        self.view.release()
+        self.mmap.close()
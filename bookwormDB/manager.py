@@ -136,11 +136,16 @@ section'client'
         Run a query against the API from the command line.
         """
 
-        from bookwormDB.general_API import SQLAPIcall
+        from bookwormDB.general_API import SQLAPIcall, DuckDBAPIcall, prefs
         import json
 
         query = json.loads(args.APIcall)
-        caller = SQLAPIcall(query)
+        if args.backend == "duckdb":
+            if args.duckdb_directory is not None:
+                prefs['duckdb_directory'] = args.duckdb_directory
+            caller = DuckDBAPIcall(query)
+        else:
+            caller = SQLAPIcall(query)
         print(caller.execute())
 
     def serve(self,args):
@@ -150,7 +155,8 @@ section'client'
         """
 
         from bookwormDB.wsgi import run
-        run(args.bind, args.workers)
+        run(args.bind, args.workers, args.backend, args.duckdb_directory,
+            cache_megabytes = args.cache_megabytes, cache_file = args.cache_file)
 
         import http.server
         from http.server import HTTPServer
@@ -204,7 +210,7 @@ section'client'
         my_extension.make()
 
     def build(self, args):
-        self.prep(args)
+        getattr(self, args.target)(args)
 
     def prep(self, args):
         """
@@ -236,7 +242,46 @@ section'client'
             input = [a for a in args.feature_counts if 'unigrams' in a][0]
         create_wordlist(n = 1.5e06,
                         input = input,
-                        output = ".bookworm/texts/wordlist/wordlist.txt")
+                        output = ".bookworm/texts/wordlist/wordlist.txt",
+                        exact = getattr(args, "exact_counts", False))
+
+    def vocab(self, args):
+        """
+        Manage the vocabulary of a bookworm that's already built.
+        """
+        if args.process == "extend":
+            self.extend_vocabulary(args)
+
+    def extend_vocabulary(self, args):
+        """
+        Give wordids to common words that were left out of the wordlist,
+        and add their counts, kept aside when texts were encoded, to the
+        database, without re-encoding anything.
+        """
+        from .countManager import extend_wordlist, encode_oov, oov_paths
+        import bookwormDB.CreateDatabase
+
+        if len(oov_paths("words")) == 0:
+            logging.warning("No out-of-vocabulary counts were kept: encode with --keep-oov to extend the vocabulary later.")
+            return
+        added = extend_wordlist(".bookworm/texts/wordlist/wordlist.txt",
+                                min_count = args.min_count, max_words = args.max_words)
+        if len(added) == 0:
+            logging.warning("No new words to add to the wordlist.")
+            return
+        batch = encode_oov(added, getattr(args, "encoded_format", "tsv"))
+
+        def batch_files(level):
+            folder = ".bookworm/texts/encoded/" + level
+            return [folder + "/" + f for f in os.listdir(folder) if f.split(".")[0] == batch]
+
+        Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
+        Bookworm.add_words(added)
+        Bookworm.append_unigram_book_counts(batch_files("unigrams"))
+        Bookworm.add_to_nwords(batch_files("unigrams"))
+        Bookworm.append_bigram_book_counts(batch_files("bigrams"))
+        Bookworm.reloadMemoryTables(force = True, names = ["wordsheap", "fastcat"])
+        Bookworm.record_build_time()
 
     def pristine(self, args):
 
@@ -253,18 +298,23 @@ section'client'
         self.wordlist(args)
         self.derived_catalog(args)
 
-        for k in ['unigrams', 'bigrams', 'trigrams', 'quadgrams', 'completed']:
+        for k in ['unigrams', 'bigrams', 'trigrams', 'quadgrams', 'completed', 'nwords',
+                  'oov/unigrams', 'oov/bigrams', 'oov/trigrams', 'oov/quadgrams', 'oov/words']:
             try:
                 os.makedirs(".bookworm/texts/encoded/{}".format(k))
             except FileExistsError:
                 pass
         from .countManager import encode_words
 
+        output_format = getattr(args, "encoded_format", "tsv")
+        resume = getattr(args, "resume", False)
+        keep_oov = getattr(args, "keep_oov", False)
+
         if args.feature_counts:
             for feature in args.feature_counts:
-                encode_words(".bookworm/texts/wordlist/wordlist.txt", feature)
+                encode_words(".bookworm/texts/wordlist/wordlist.txt", feature, output_format, resume, keep_oov)
         else:
-            encode_words(".bookworm/texts/wordlist/wordlist.txt", "input.txt")
+            encode_words(".bookworm/texts/wordlist/wordlist.txt", "input.txt", output_format, resume, keep_oov)
 
     def all(self, args):
         self.preDatabaseMetadata(args)
@@ -272,6 +322,61 @@ section'client'
         self.database_wordcounts(args)
         self.database_metadata(args)
 
+    def append(self, args):
+        """
+        Add new texts to a bookworm that's already built, without rebuilding
+        it. Add their entries to jsoncatalog.txt and their text to input.txt
+        (or to the feature counts), and run this: only filenames that
+        aren't registered yet are encoded and loaded.
+        """
+        from bookwormDB.MetaParser import parse_catalog_multicore
+        from bookwormDB.sqliteKV import KV
+        from bookwormDB.tokenizer import committedBatches
+        import bookwormDB.CreateDatabase
+
+        ids = KV(".bookworm/metadata/textids.sqlite")
+        first_bookid = ids.last_id() + 1
+        ids.close()
+        added = parse_catalog_multicore(append = True)
+        if added == 0:
+            logging.warning("No new catalog entries to append.")
+            return
+        logging.info("Appending %d catalog entries, from bookid %d on" % (added, first_bookid))
+
+        levels = ["unigrams", "bigrams"]
+        before = dict([(level, committedBatches(level)) for level in levels])
+        # Everything encoded already is skipped.
+        args.resume = True
+        self.encoded(args)
+
+        new_files = dict()
+        for level in levels:
+            folder = ".bookworm/texts/encoded/" + level
+            batches = committedBatches(level) - before[level]
+            new_files[level] = [folder + "/" + f for f in sorted(os.listdir(folder))
+                                if f.split(".")[0] in batches]
+        new_batches = committedBatches("unigrams") - before["unigrams"]
+
+        Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
+        counts_table = "master_bookcounts"
+        if len(new_files["unigrams"]) > 0:
+            counts_table = Bookworm.append_unigram_book_counts(new_files["unigrams"])
+        Bookworm.append_bigram_book_counts(new_files["bigrams"])
+
+        Bookworm.variableSet.appendMetadata(".bookworm/metadata/jsoncatalog_appended.txt",
+                                            first_bookid, counts_table = counts_table,
+                                            batches = new_batches)
+        Bookworm.append_fastcat_rows(first_bookid)
+        # fastcat's stored code, too, may name a wider id type now.
+        Bookworm.addFilesToMasterVariableTable()
+
+        # The wordlist is unchanged, so wordsheap is the one memory table
+        # that can be left as it is.
+        names = [row[0] for row in Bookworm.db.query("SELECT tablename FROM masterTableTable").fetchall()
+                 if row[0] != "wordsheap"]
+        Bookworm.reloadMemoryTables(force = True, names = names)
+        Bookworm.record_build_time()
+
     def preDatabaseMetadata(self, args=None, **kwargs):
         import os
         if not os.path.exists("field_descriptions.json"):
@@ -325,6 +430,17 @@ section'client'
             """)
             sys.exit()
 
+    def export_duckdb(self, args):
+        """
+        Copy the tables that API queries read into an embedded DuckDB file
+        at .bookworm/duckdb/<database>.duckdb, to serve with '--backend duckdb'.
+        """
+        import bookwormDB.CreateDatabase
+        from bookwormDB.duckdbAPI import export_duckdb, duckdb_path
+        Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname, variableFile=None)
+        Bookworm.db.connect()
+        export_duckdb(Bookworm.db.conn, duckdb_path(self.dbname))
+
     def reload_memory(self,args):
         import bookwormDB.CreateDatabase
         dbnames = [self.dbname]
@@ -370,6 +486,7 @@ section'client'
         Bookworm.create_API_settings()
 
         Bookworm.grantPrivileges()
+        Bookworm.record_build_time()
 
     def add_metadata(self, args):
         import bookwormDB.CreateDatabase
@@ -387,6 +504,7 @@ section'client'
         bookworm.importNewFile(args.file,
                                anchorField=args.key,
                                jsonDefinition=args.field_descriptions)
+        bookworm.record_build_time()
 
 
     def database_wordcounts(self, args = None, **kwargs):
@@ -401,6 +519,15 @@ section'client'
         reverse_index = True
         ingest = True
         newtable = True
+        table_count = getattr(cmd_args, "table_count", 1)
+        bigram_table_count = getattr(cmd_args, "bigram_table_count", 1)
+        bigram_reverse_index = getattr(cmd_args, "bigram_reverse_index", False)
+        load_workers = getattr(cmd_args, "load_workers", None)
+        index_workers = getattr(cmd_args, "index_workers", None)
+        sort_buffer_size = None
+        if getattr(cmd_args, "sort_buffer_megabytes", None) is not None:
+            sort_buffer_size = cmd_args.sort_buffer_megabytes * 2**20
+        partition_by = getattr(cmd_args, "partition_by", "file")
 
         if cmd_args and hasattr(cmd_args, "index_only"):
             if cmd_args.index_only:
@@ -410,15 +537,24 @@ section'client'
                 index = not cmd_args.no_index
                 newtable = not cmd_args.no_delete
             reverse_index = not cmd_args.no_reverse_index
-            if not (newtable and ingest and index):
-                logging.warn("database_wordcounts args not supported for bigrams yet.")
 
         logging.debug("Creating a database named %s" % self.dbname)
         Bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
         logging.debug(Bookworm)
         Bookworm.load_word_list()
-        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=index, reverse_index=reverse_index)
-        Bookworm.create_bigram_book_counts()
+        # Indexes are built at the end, so that the unigram and bigram
+        # tables can all be indexed at the same time.
+        Bookworm.create_unigram_book_counts(newtable=newtable, ingest=ingest, index=False, reverse_index=reverse_index,
+                                            table_count=table_count, load_workers=load_workers,
+                                            partition_by=partition_by)
+        Bookworm.create_bigram_book_counts(newtable=newtable, ingest=ingest, index=False,
+                                           reverse_index=reverse_index and bigram_reverse_index,
+                                           table_count=bigram_table_count, load_workers=load_workers,
+                                           partition_by=partition_by)
+        if index:
+            Bookworm.index_book_counts({"unigrams": table_count, "bigrams": bigram_table_count},
+                                       workers=index_workers, sort_buffer_size=sort_buffer_size)
+        Bookworm.record_build_time()
 
 class Extension(object):
 
@@ -478,6 +614,15 @@ def run_arguments():
     parser.add_argument("--feature-counts", action='append',
                                  help="Use pre-calculated feature counts rather than tokenizing complete text on the fly. Supply any number of single files per count level like 'input.unigrams', 'input.bigrams', etc.")
 
+    parser.add_argument("--encoded-format", choices=["tsv", "binary"], default="tsv",
+                        help="The format for the encoded token counts written to .bookworm/texts/encoded. 'tsv' is plain text; 'binary' is a much smaller fixed-width format that skips formatting and parsing text, but must be streamed into MySQL rather than read directly.")
+
+    parser.add_argument("--keep-oov", action="store_true", default=False,
+                        help="When encoding, keep the counts of words left out of the wordlist in .bookworm/texts/encoded/oov, so that 'bookworm vocab extend' can add them later without re-encoding.")
+
+    parser.add_argument("--exact-counts", action="store_true", default=False,
+                        help="Build the wordlist from exact word counts, merged on disk, rather than the approximate in-memory counts from bounter. Slower, but word ranks are the same on every rebuild.")
+
     parser.add_argument("--ngrams",nargs="+",default=["unigrams","bigrams"],help="What levels to parse with. Multiple arguments should be unquoted in spaces. This option currently does nothing.")
 
 
@@ -494,8 +639,16 @@ def run_arguments():
 
     build_parser.add_argument("target", help="The make that you want to build. To build a full bookworm, type 'build all'.")
 
+    build_parser.add_argument("--resume", action="store_true", default=False, help="When encoding, keep the batches that earlier runs finished and encode only the files they didn't reach.")
+
     # Grep out all possible targets from the Makefile
 
+    ############# vocab #################
+    vocab_parser = subparsers.add_parser("vocab", help="Manage the vocabulary of an already-created Bookworm.")
+    vocab_parser.add_argument("process", choices=["extend"], help="'extend' gives wordids to words left out of the wordlist, and loads the counts for them kept aside during encoding with --keep-oov.")
+    vocab_parser.add_argument("--min-count", type=int, default=2, help="Only add words seen at least this many times.")
+    vocab_parser.add_argument("--max-words", type=int, default=None, help="Add at most this many words, the most common first.")
+
     ############# supplement #################
     supplement_parser = subparsers.add_parser("add_metadata",help="""Supplement the\
     metadata for an already-created Bookworm with new items. They can be keyed to any field already in the database.""")
@@ -542,6 +695,8 @@ def run_arguments():
     ########## Clone and run extensions
     query_parser = subparsers.add_parser("query", help="Run a query using the Bookworm API")
     query_parser.add_argument("APIcall",help="The json-formatted query to be run.")
+    query_parser.add_argument("--backend", choices=["mysql", "duckdb"], default="mysql", help="Run the query against MySQL, or against the DuckDB copy made by 'bookworm prep export_duckdb'.")
+    query_parser.add_argument("--duckdb-directory", default=None, help="Where to find DuckDB copies, by default .bookworm/duckdb.")
 
 
     ########## Build components
@@ -562,6 +717,20 @@ def run_arguments():
 
     word_ingest_parser.add_argument("--index-only", action="store_true", help="Only re-enable keys. Supercedes other flags.")
 
+    word_ingest_parser.add_argument("--table-count", type=int, default=1, help="Split the unigram counts across this many MyISAM tables, joined by a MERGE table as master_bookcounts.")
+
+    word_ingest_parser.add_argument("--bigram-table-count", type=int, default=1, help="Like --table-count, for bigram counts in master_bigrams.")
+
+    word_ingest_parser.add_argument("--bigram-reverse-index", action="store_true", help="Also index master_bigrams by bookid first, as master_bookcounts is unless --no-reverse-index. Off by default: it adds a second index to the largest table.")
+
+    word_ingest_parser.add_argument("--partition-by", choices=["file", "wordid"], default="file", help="With --table-count, how to split the counts among tables. 'file' spreads whole encoded files among them; 'wordid' gives each table a range of words, so that searches for a word only touch its table.")
+
+    word_ingest_parser.add_argument("--index-workers", type=int, default=None, help="How many tables to rebuild indexes on at once, each with its own sort buffer (see --sort-buffer-megabytes). By default, one per table up to the number of cpus.")
+
+    word_ingest_parser.add_argument("--sort-buffer-megabytes", type=int, default=None, help="The myisam_sort_buffer_size for each index rebuild; --index-workers of them may be in use at once. By default, the server's global setting.")
+
+    word_ingest_parser.add_argument("--load-workers", type=int, default=None, help="How many tables to load at once, each over its own MySQL connection. By default, one per table up to the number of cpus.")
+
     metadata_generate_parser = prep_subparsers.add_parser('database_metadata',
                                                             help=getattr(BookwormManager, "database_metadata").__doc__)
 
@@ -594,6 +763,14 @@ def run_arguments():
 
     serve_parser.add_argument("--dir","-d",default="http_server",help="A filepath for a directory to serve from. Will be created if it does not exist.")
 
+    serve_parser.add_argument("--backend", choices=["mysql", "duckdb"], default="mysql", help="Answer queries from MySQL, or from the DuckDB copies made by 'bookworm prep export_duckdb'.")
+
+    serve_parser.add_argument("--cache-megabytes", type=int, default=0, help="How much memory each worker may use to keep the results of recent queries. Off (0) by default; only bookworms that record their build time are cached.")
+
+    serve_parser.add_argument("--cache-file", default=None, help="Also keep results in a sqlite file at this path, shared by every worker; it holds up to ten times --cache-megabytes.")
+
+    serve_parser.add_argument("--duckdb-directory", default=None, help="With '--backend duckdb', where to find the copies, by default .bookworm/duckdb in the current directory.")
+
 
 
     # Configure the global server.
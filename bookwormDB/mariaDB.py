@@ -6,10 +6,14 @@ from .bwExceptions import BookwormException
 
 import json
 import re
+import os
 import copy
+import time
 import MySQLdb
 import hashlib
 import logging
+import threading
+from collections import defaultdict
 
 
 
@@ -18,6 +22,27 @@ import logging
 # A different host and read_default_file will let you import things onto a
 # different server.
 
+_read_only_config = None
+
+def read_only_config():
+    """
+    The user, password and host of the read-only account. The
+    configuration files are only read the first time.
+    """
+    global _read_only_config
+    if _read_only_config is None:
+        import bookwormDB.configuration
+        conf = bookwormDB.configuration.Configfile("read_only").config
+        settings = {
+            "user": conf.get("client", "user"),
+            "password": conf.get("client", "password"),
+            "host": None
+        }
+        if conf.has_option("client", "host"):
+            settings["host"] = conf.get("client", "host")
+        _read_only_config = settings
+    return _read_only_config
+
 class DbConnect(object):
     # This is a read-only account
     def __init__(self, database=None,
@@ -25,8 +50,7 @@ class DbConnect(object):
         
         self.dbname = database
         
-        import bookwormDB.configuration
-        conf = bookwormDB.configuration.Configfile("read_only").config
+        conf = read_only_config()
 
         if database is None:
             raise BookwormException("You must specify a database")
@@ -35,12 +59,14 @@ class DbConnect(object):
             "db": database,
             "use_unicode": 'True',
             "charset": 'utf8',
-            "user": conf.get("client", "user"),
-            "password": conf.get("client", "password")
+            "user": conf["user"],
+            "password": conf["password"]
         }
 
         if host:
             connargs['host'] = host
+        elif conf["host"]:
+            connargs['host'] = conf["host"]
         # For back-compatibility:
         else:
             connargs['host'] = "localhost"
@@ -58,6 +84,108 @@ class DbConnect(object):
             
         self.cursor = self.db.cursor()
 
+# MySQL client errors that mean the connection is gone, not that the
+# query was bad: the server went away, or the connection dropped.
+CONNECTION_LOST = (2006, 2013, 2055)
+
+def connection_lost(error):
+    """
+    Was `error`, or the error it was raised from, a lost connection?
+    pandas wraps the errors from the connections it reads.
+    """
+    while error is not None:
+        if isinstance(error, MySQLdb.OperationalError) and len(error.args) > 0 \
+           and error.args[0] in CONNECTION_LOST:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+class ConnectionPool(object):
+    """
+    Read-only connections kept open between queries, one list per
+    database, so that a request doesn't open a new connection for each
+    query it runs. Safe to share across threads; after a fork, the child
+    starts with no connections rather than sharing its parent's.
+
+    A connection that has sat idle for more than `check_after` seconds
+    is pinged before it is handed out, and replaced if the server has
+    dropped it. At most `max_idle` connections per database are kept.
+    """
+    def __init__(self, max_idle=8, check_after=30):
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.pid = os.getpid()
+
+    def _forked(self):
+        if self.pid != os.getpid():
+            self.idle = defaultdict(list)
+            self.pid = os.getpid()
+
+    def get(self, database):
+        """
+        A DbConnect to `database`: an idle one if there is one, or new.
+        """
+        with self.lock:
+            self._forked()
+            idle = self.idle[database]
+            con, last_used = idle.pop() if len(idle) > 0 else (None, None)
+        if con is not None and time.time() - last_used > self.check_after:
+            try:
+                con.db.ping()
+            except MySQLdb.Error:
+                logging.info("Replacing a dropped connection to {}".format(database))
+                self.discard(con)
+                con = None
+        if con is None:
+            con = DbConnect(database)
+            # Without a transaction held open between queries, a reused
+            # connection sees a rebuild as soon as it's done.
+            con.db.autocommit(True)
+        return con
+
+    def put(self, con):
+        """
+        Return a connection from `get` to the pool.
+        """
+        with self.lock:
+            self._forked()
+            idle = self.idle[con.dbname]
+            if len(idle) < self.max_idle:
+                idle.append((con, time.time()))
+                return
+        self.discard(con)
+
+    def discard(self, con):
+        try:
+            con.db.close()
+        except MySQLdb.Error:
+            pass
+
+    def run(self, database, function):
+        """
+        Call `function` with a pooled connection to `database` and return
+        what it returns. If the server dropped the connection, try once
+        more on a new one. A connection that raised an error is closed
+        rather than returned to the pool.
+        """
+        for attempt in [1, 2]:
+            con = self.get(database)
+            try:
+                result = function(con)
+            except Exception as error:
+                self.discard(con)
+                if attempt == 1 and connection_lost(error):
+                    logging.warning("Lost the connection to {}; retrying".format(database))
+                    continue
+                raise
+            self.put(con)
+            return result
+
+# Shared by every query in this process.
+pool = ConnectionPool()
+
 def fail_if_nonword_characters_in_columns(input):
     keys = all_keys(input)
     for key in keys:
@@ -118,6 +246,10 @@ class Query(object):
     """
     The base class for a bookworm search.
     """
+
+    # The SQL dialect that where clauses are written in.
+    dialect = "mysql"
+
     def __init__(self, query_object = {}, db = None, databaseScheme = None):
         # Certain constructions require a DB connection already available, so we just start it here, or use the one passed to it.
 
@@ -133,7 +265,7 @@ class Query(object):
             
         self.databaseScheme = databaseScheme
         if databaseScheme is None:
-            self.databaseScheme = databaseSchema(self.db)
+            self.databaseScheme = self.load_schema()
 
         self.cursor = self.db.cursor
 
@@ -150,6 +282,9 @@ class Query(object):
         
         self.derive_variables() # Derive some useful variables that the query will use.
 
+    def load_schema(self):
+        return schemas.get(self.db)
+
     def defaults(self, query_object):
         # these are default values;these are the only values that can be set in the query
         # search_limits is an array of dictionaries;
@@ -392,12 +527,39 @@ class Query(object):
             return " "
 
 
+    def outer_group_query(self, group_query):
+        """
+        The grouping around a subquery that is already grouped the same
+        way. It changes nothing but the order of the rows.
+        """
+        return group_query
+
     def main_table(self):
         if self.gram_size() == 1:
-            return 'master_bookcounts as main'
+            return self.unigram_table() + ' as main'
         if self.gram_size() == 2:
             return 'master_bigrams as main'
         
+    def unigram_table(self):
+        """
+        If master_bookcounts is partitioned by wordid and every word
+        searched for lies in the same part, search that part alone;
+        otherwise, the whole table.
+        """
+        # masterPartitionTable may list the parts of master_bigrams, too.
+        partitions = [partition for partition in self.databaseScheme.partitions
+                      if partition[0].startswith("master_bookcounts_p")]
+        if len(partitions) == 0 or not self.searched_wordids:
+            return 'master_bookcounts'
+        tables = set()
+        for wordid in self.searched_wordids:
+            for (tablename, min_wordid, max_wordid) in partitions:
+                if min_wordid <= wordid <= max_wordid:
+                    tables.add(tablename)
+        if len(tables) == 1:
+            return tables.pop()
+        return 'master_bookcounts'
+
     def full_query_tables(self):
         # Joins are needed to provide groups, but *not* to provide
         # provide evidence for wheres.
@@ -524,10 +686,12 @@ class Query(object):
 
             logging.info("'{}'".format(dicto['tables']))
 
+            wrapper_ops = []
             if "TextCount" in self.query_object['counttype']:
-                dicto['wrapper_op'] = "IFNULL(numerator.TextCount,0) as TextCount"
+                wrapper_ops.append("IFNULL(numerator.TextCount,0) as TextCount")
             if "WordCount" in self.query_object['counttype']:
-                dicto['wrapper_op'] = "IFNULL(numerator.WordCount,0) as WordCount"
+                wrapper_ops.append("IFNULL(numerator.WordCount,0) as WordCount")
+            dicto['wrapper_op'] = ", ".join(wrapper_ops)
 
             if len(dicto['group_query'].strip()) > 0:
                 confirmed_groups = []
@@ -548,6 +712,8 @@ class Query(object):
 
                 dicto['group_query'] = "GROUP BY " + ", ".join(confirmed_groups)
 
+            dicto['outer_group_query'] = self.outer_group_query(dicto['group_query'])
+
             basic_query = """
             SELECT {wrapper_op} {finalGroups}
             FROM (
@@ -558,7 +724,7 @@ class Query(object):
               AND 
               {wordid_where}
             {group_query} )
-            as numerator {group_query}
+            as numerator {outer_group_query}
             """.format(**dicto)
         elif dicto['catwhere'].strip() == 'TRUE' and ", " in dicto['group_query']:
             logging.info("Running query with wordid and multiple groups")
@@ -647,7 +813,7 @@ class Query(object):
                         del catlimits[key]
                 
         if len(list(catlimits.keys())) > 0:
-            catwhere = where_from_hash(catlimits)
+            catwhere = where_from_hash(catlimits, dialect=self.dialect)
         else:
             catwhere = "TRUE"
         if query == "sub":
@@ -669,6 +835,8 @@ class Query(object):
         
     def make_wordwheres(self):
         self.wordswhere = " TRUE "
+        # The unigram wordids searched for, if that's all that limits the words.
+        self.searched_wordids = []
         
         limits = []
         
@@ -713,13 +881,15 @@ class Query(object):
                     
                     for row in cursor.fetchall():
                         wordid = row[0]
+                        if search_key == "wordid":
+                            self.searched_wordids.append(wordid)
                         try:
                             locallimits[search_key] += [wordid]
                         except KeyError:
                             locallimits[search_key] = [wordid]
 
                 if len(locallimits) > 0:
-                    limits.append(where_from_hash(locallimits, comp = " = ", escapeStrings=False))
+                    limits.append(where_from_hash(locallimits, comp = " = ", escapeStrings=False, dialect=self.dialect))
                     
 
             self.wordswhere = "(" + ' OR '.join(limits) + ")"
@@ -739,7 +909,8 @@ class Query(object):
                 del self.limits[key]
 
         if len(list(wordlimits.keys())) > 0:
-            self.wordswhere = where_from_hash(wordlimits)
+            self.wordswhere = where_from_hash(wordlimits, dialect=self.dialect)
+            self.searched_wordids = []
 
         return self.wordswhere
 
@@ -931,7 +1102,7 @@ class Query(object):
             words = self.query_object['search_limits']['word']
             # Break bigrams into single words.
             words = ' '.join(words).split(' ')
-            q = "SELECT word FROM {} WHERE {}".format(self.wordsheap, where_from_hash({self.word_field:words}))
+            q = "SELECT word FROM {} WHERE {}".format(self.wordsheap, where_from_hash({self.word_field:words}, dialect=self.dialect))
             logging.debug(q)
             self.cursor.execute(q)
             self.actualWords = [item[0] for item in self.cursor.fetchall()]
@@ -1020,6 +1191,7 @@ class databaseSchema(object):
         # The aliases starts with a dummy alias for fully grouped queries.
         self.aliases = {}
         self.newStyle(db)
+        self.partitions = self.load_partitions()
 
 
     def newStyle(self, db):
@@ -1052,6 +1224,43 @@ class databaseSchema(object):
             
             self.aliases[dbname] = alias
 
+    def with_connection(self, db):
+        """
+        A copy of this schema that runs its queries on `db`. The copies
+        share everything they have learned about the tables.
+        """
+        schema = copy.copy(self)
+        schema.db = db
+        schema.cursor = db.cursor
+        return schema
+
+    def load_partitions(self):
+        """
+        The (tablename, min_wordid, max_wordid) of each part of
+        master_bookcounts, if it was built partitioned by wordid.
+
+        Unless the parts listed are every table behind master_bookcounts,
+        none of them are returned: a search of the listed ones alone would
+        miss counts in the rest.
+        """
+        try:
+            self.db.cursor.execute("SELECT tablename, min_wordid, max_wordid FROM masterPartitionTable")
+            partitions = list(self.db.cursor.fetchall())
+        except MySQLdb.ProgrammingError:
+            return []
+        unigrams = [partition for partition in partitions
+                    if partition[0].startswith("master_bookcounts_p")]
+        if len(unigrams) == 0:
+            return partitions
+        self.db.cursor.execute("SHOW CREATE TABLE master_bookcounts")
+        union = re.search(r"UNION=\((.*?)\)", self.db.cursor.fetchall()[0][1])
+        merged = [] if union is None else [tablename.strip().strip("`") for tablename in union.group(1).split(",")]
+        if set(merged) != set([partition[0] for partition in unigrams]):
+            logging.warning("masterPartitionTable doesn't cover the tables behind master_bookcounts; "
+                            "searching all of them")
+            return [partition for partition in partitions if partition not in unigrams]
+        return partitions
+
     def fallback_table(self,tabname):
         """
         Fall back to the saved versions if the memory tables are unpopulated.
@@ -1104,7 +1313,76 @@ class databaseSchema(object):
 
     
 
-def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_joiner = " OR "):
+def schema_version(db):
+    """
+    A cheap summary of everything a databaseSchema depends on: the time of
+    the last build, and which memory tables are loaded (an empty one is
+    read from its on-disk copy instead).
+    """
+    try:
+        db.cursor.execute("SELECT value FROM bookworm_information WHERE entry='build_time'")
+        build_time = db.cursor.fetchall()
+    except MySQLdb.ProgrammingError:
+        build_time = ()
+    db.cursor.execute("""SELECT TABLE_NAME FROM information_schema.TABLES
+                         WHERE TABLE_SCHEMA=DATABASE() AND ENGINE='MEMORY' AND TABLE_ROWS > 0""")
+    loaded = sorted(row[0] for row in db.cursor.fetchall())
+    return (tuple(build_time), tuple(loaded))
+
+class SchemaCache(object):
+    """
+    One databaseSchema per database for the whole process, rather than a
+    new one, with its round trips, for every query.
+
+    A schema is used as is for `ttl` seconds. After that, the next query
+    checks `schema_version`, and the schema is rebuilt only if it has
+    changed.
+    """
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # database name: (schema, version, time last checked)
+        self.schemas = dict()
+
+    def get(self, db):
+        """
+        The schema for the database `db` is connected to, bound to `db`.
+        """
+        with self.lock:
+            entry = self.schemas.get(db.dbname)
+        if entry is not None:
+            (schema, version, checked) = entry
+            if time.time() - checked < self.ttl:
+                return schema.with_connection(db)
+            if schema_version(db) == version:
+                with self.lock:
+                    self.schemas[db.dbname] = (schema, version, time.time())
+                return schema.with_connection(db)
+            logging.info("Rebuilding the schema for {}".format(db.dbname))
+        version = schema_version(db)
+        schema = databaseSchema(db)
+        with self.lock:
+            self.schemas[db.dbname] = (schema, version, time.time())
+        return schema
+
+    def invalidate(self, database=None):
+        """
+        Forget the schema for `database`, or for every database.
+        """
+        with self.lock:
+            if database is None:
+                self.schemas.clear()
+            else:
+                self.schemas.pop(database, None)
+
+# Shared by every query in this process.
+schemas = SchemaCache()
+
+def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_joiner = " OR ", dialect="mysql"):
+    """
+    `dialect` is "mysql" or "duckdb": they quote strings and match
+    regular expressions differently.
+    """
     whereterm = []
     # The general idea here is that we try to break everything in search_limits down to a list, and then create a whereterm on that joined by whatever the 'joiner' is ("AND" or "OR"), with the comparison as whatever comp is ("=",">=",etc.).
     # For more complicated bits, it gets all recursive until the bits are all in terms of list.
@@ -1121,11 +1399,11 @@ def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_
         if key == "$or" or key == "$OR":
             local_set = []
             for comparison in values:
-                local_set.append(where_from_hash(comparison, comp=comp))
+                local_set.append(where_from_hash(comparison, comp=comp, dialect=dialect))
             whereterm.append(" ( " + " OR ".join(local_set) + " )")
         elif key == '$and' or key == "$AND":
             for comparison in values:
-                whereterm.append(where_from_hash(comparison, joiner=" AND ", comp=comp))                
+                whereterm.append(where_from_hash(comparison, joiner=" AND ", comp=comp, dialect=dialect))                
         elif isinstance(values, dict):
             if joiner is None:
                 joiner = " AND "
@@ -1141,7 +1419,7 @@ def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_
                     subjoiner = " AND "
                 else:
                     subjoiner = " OR "
-                whereterm.append(where_from_hash({key:values[operation]}, comp=operations[operation], list_joiner=subjoiner))
+                whereterm.append(where_from_hash({key:values[operation]}, comp=operations[operation], list_joiner=subjoiner, dialect=dialect))
         elif isinstance(values, list):
             # and this is where the magic actually happens:
             # the cases where the key is a string, and the target is a list.
@@ -1152,7 +1430,7 @@ def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_
                 # catch post-1898 years except for 1899. Not that you
                 # should need to.
                 for entry in values:
-                    whereterm.append(where_from_hash(entry))
+                    whereterm.append(where_from_hash(entry, dialect=dialect))
             else:
                 # Note that about a third of the code is spent on escaping strings.
                 if escapeStrings:
@@ -1161,15 +1439,22 @@ def where_from_hash(myhash, joiner=None, comp = " = ", escapeStrings=True, list_
                     else:
                         quotesep = ""
 
-                    def escape(value):
-                        # NOTE: stringifying the escape from MySQL; hopefully doesn't break too much.                        
-                        return str(MySQLdb.escape_string(to_unicode(value)), 'utf-8')
+                    if dialect == "duckdb":
+                        def escape(value):
+                            return to_unicode(value).replace("'", "''")
+                    else:
+                        def escape(value):
+                            # NOTE: stringifying the escape from MySQL; hopefully doesn't break too much.
+                            return str(MySQLdb.escape_string(to_unicode(value)), 'utf-8')
                 else:
                     def escape(value):
                         return to_unicode(value)
                     quotesep = ""
 
-                joined = list_joiner.join([" ({}{}{}{}{}) ".format(key, comp, quotesep, escape(value), quotesep) for value in values])
+                if dialect == "duckdb" and comp == " REGEXP ":
+                    joined = list_joiner.join([" (regexp_matches({}, {}{}{})) ".format(key, quotesep, escape(value), quotesep) for value in values])
+                else:
+                    joined = list_joiner.join([" ({}{}{}{}{}) ".format(key, comp, quotesep, escape(value), quotesep) for value in values])
                 whereterm.append(" ( {} ) ".format(joined))
 
     if len(whereterm) > 1:
@@ -0,0 +1,165 @@
+import os
+import json
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+"""
+A cache of API results, so that the searches a front end sends over and
+over are answered without going back to the database.
+
+Results are the pandas frames from `APIcall.get_data_from_source`, keyed
+by the query with its keys sorted and the fields that only change how the
+frame is formatted left out. The key also holds the time the database
+was last built, so a rebuild makes every earlier result unreachable.
+
+Frames are kept in memory, in a least-recently-used list bounded by their
+size in bytes. If a path is given, they are also written to a sqlite
+file there, which every gunicorn worker on the machine shares.
+"""
+
+# Fields that change how a result is sent, but not the result.
+FORMATTING_KEYS = ["ip", "format", "time", "duration"]
+
+
+def cache_key(query, backend=None, build_time=None):
+    """
+    A hash of the parts of a query that determine its result.
+    """
+    canonical = dict([(key, value) for key, value in query.items()
+                      if key not in FORMATTING_KEYS])
+    text = json.dumps([backend, build_time, canonical], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def frame_size(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+class ResultCache(object):
+    """
+    An LRU cache of data frames holding at most `max_bytes` in memory
+    and, if `path` is given, `max_disk_bytes` on disk.
+
+    Frames are copied going in and coming out, so callers can change
+    them freely. The disk store is best-effort: if another process holds
+    it locked for too long, it is skipped.
+    """
+
+    def __init__(self, max_bytes=2**28, path=None, max_disk_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.path = path
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def key(self, query, backend=None, build_time=None):
+        return cache_key(query, backend, build_time)
+
+    def get(self, key):
+        """
+        The frame stored under `key`, or None.
+        """
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return self.frames[key][0].copy()
+        if self.path is None:
+            return None
+        frame = self.disk_get(key)
+        if frame is not None:
+            self.remember(key, frame)
+            return frame.copy()
+        return None
+
+    def put(self, key, frame):
+        frame = frame.copy()
+        self.remember(key, frame)
+        if self.path is not None:
+            self.disk_put(key, frame)
+
+    def remember(self, key, frame):
+        size = frame_size(frame)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.frames:
+                self.bytes -= self.frames.pop(key)[1]
+            self.frames[key] = (frame, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                (_, (_, evicted)) = self.frames.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+        if self.path is not None:
+            with self.connection() as conn:
+                conn.execute("DELETE FROM results")
+
+    def connection(self):
+        """
+        This thread's connection to the disk store. Connections aren't
+        shared across threads, or across the fork that starts each
+        gunicorn worker.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS results(
+                            key TEXT PRIMARY KEY,
+                            frame BLOB NOT NULL,
+                            size INTEGER NOT NULL,
+                            used REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results(used)")
+            conn.commit()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def disk_get(self, key):
+        try:
+            with self.connection() as conn:
+                row = conn.execute("SELECT frame FROM results WHERE key=?", (key, )).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE results SET used=? WHERE key=?", (time.time(), key))
+            return pickle.loads(row[0])
+        except sqlite3.OperationalError as error:
+            logging.warning("Skipping the result cache at {}: {}".format(self.path, error))
+            return None
+
+    def disk_put(self, key, frame):
+        data = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_disk_bytes:
+            return
+        try:
+            with self.connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                             (key, data, len(data), time.time()))
+                total = conn.execute("SELECT SUM(size) FROM results").fetchone()[0]
+                if total > self.max_disk_bytes:
+                    # Drop the least recently used until the rest fit.
+                    excess = total - self.max_disk_bytes
+                    doomed = []
+                    for (old_key, size) in conn.execute("SELECT key, size FROM results ORDER BY used"):
+                        if excess <= 0:
+                            break
+                        doomed.append((old_key, ))
+                        excess -= size
+                    conn.executemany("DELETE FROM results WHERE key=?", doomed)
+        except sqlite3.OperationalError as error:
+            logging.warning("Skipping the result cache at {}: {}".format(self.path, error))
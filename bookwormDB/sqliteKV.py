@@ -32,16 +32,19 @@ class KV:
         self.conn = None
         self.conn = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES)
         self.conn.row_factory = sqlite3.Row
+        # With a write-ahead log, a commit needs only one sync, and
+        # readers in other processes don't block the writer.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
 
         tables = [dict(r)['name'] for r in self.conn.execute(
             "SELECT name FROM sqlite_master WHERE type='table'")]
 
         if 'keys' not in tables:
+            # The UNIQUE constraint already indexes keys.
             self.conn.execute("""CREATE TABLE keys(
                               ID INTEGER PRIMARY KEY ASC,
                               key TEXT UNIQUE NOT NULL)""")
-            
-            self.conn.execute("CREATE UNIQUE INDEX idx_keys ON keys(key)")
 
 
     def close(self):
@@ -63,3 +66,25 @@ class KV:
         self.conn.execute("INSERT INTO keys(key) VALUES (?)",
                           (key, ))
 
+    def register_many(self, keys):
+        """
+        Register a list of keys in a single transaction, in order.
+
+        Keys that are already registered (or repeated in the list) are
+        skipped rather than raising an IntegrityError; returns the number
+        skipped.
+        """
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO keys(key) VALUES (?)",
+                                  ((key, ) for key in keys))
+        return len(keys) - (self.conn.total_changes - before)
+
+
+    def last_id(self):
+        """
+        The highest ID yet assigned, or 0 if there are no keys. Keys
+        registered afterwards all get higher IDs.
+        """
+        row = self.conn.execute("SELECT MAX(ID) FROM keys").fetchone()
+        return row[0] or 0
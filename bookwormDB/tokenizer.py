@@ -5,12 +5,18 @@ import random
 import sys
 import os
 from .sqliteKV import KV
+from .encodedCounts import format_rows, binary_header, write_binary_rows
+from .lookupTable import LookupTable, build_lookup_table
 import time
 import logging
 import numpy as np
 from pandas import read_csv
 from io import StringIO
-import re
+from itertools import repeat, islice
+from collections import Counter
+
+# The "regex" module is imported on first use.
+re = None
 
 """
 This section does a lot of work on tokenizing and aggregating wordcounts.
@@ -18,8 +24,14 @@ This section does a lot of work on tokenizing and aggregating wordcounts.
 
 # Likewise, store a thread-wise count on whether we've thrown a unicode encoding error.
 haveWarnedUnicode = False
+# The number of words in an ngram at each level of encoding.
+gram_lengths = {"unigrams": 1, "bigrams": 2, "trigrams": 3, "quadgrams": 4}
+# How many documents each batch of encoded files holds before it is
+# committed and a new one started.
+DOCS_PER_BATCH = 10000
 # And the default regex is generated by a function on demand.
 bigregex = None
+bigregex_findall = None
 
 
 def wordRegex():
@@ -29,6 +41,8 @@ def wordRegex():
     a unicode-decoded string: and that we have to use the "regex" module instead of the "re" module. Python3 will make this, perhaps, easier.
     """
     global re
+    if re is None:
+        import regex as re
     MasterExpression = r"\w+"
     possessive = MasterExpression + r"'s"
     numbers = r"(?:[\$])?\d+"
@@ -43,18 +57,130 @@ def wordRegex():
     return bigregex
 
 
+def fast_tokenize(string):
+    """
+    Tokenize a string exactly as `wordRegex` would, but faster.
+
+    No token can include a space, so the string is split on spaces first.
+    Most pieces are then plain words: if a piece is all letters, every
+    alternative in the big regex but the last fails on it, and the last
+    (\\w+) matches the whole piece, so it can be used as is. Only the
+    other pieces, with punctuation or digits, go through the regex.
+
+    tests/test_tokenizer.py checks this against the regex.
+    """
+    global bigregex, bigregex_findall
+    if bigregex_findall is None:
+        if bigregex is None:
+            bigregex = wordRegex()
+        bigregex_findall = bigregex.findall
+    findall = bigregex_findall
+    tokens = []
+    append = tokens.append
+    extend = tokens.extend
+    for piece in string.split(" "):
+        if piece.isalpha():
+            append(piece)
+        elif piece:
+            extend(findall(piece))
+    return tokens
+
+
 def readDictionaryFile(prefix=""):
+    """
+    Read the wordlist into a dictionary from words to integer wordids.
+    """
     look = dict()
     for line in open(prefix + ".bookworm/texts/wordlist/wordlist.txt"):
         line = line.rstrip("\n")
         v, k, _ = line.split("\t")
-        look[k] = v
+        look[k] = int(v)
     return look
 
+def buildDictionaryTable(prefix=""):
+    """
+    Build a memory-mapped lookup table from the wordlist, so that encode
+    workers can share a single copy of it: see `lookupTable`.
+    """
+    def words():
+        for line in open(prefix + ".bookworm/texts/wordlist/wordlist.txt"):
+            v, k, _ = line.rstrip("\n").split("\t")
+            yield k, int(v)
+    build_lookup_table(words(), prefix + ".bookworm/texts/wordlist/wordlist.lookup")
+
+def openDictionary(prefix=""):
+    """
+    The shared lookup table for the wordlist, if one has been built since
+    the wordlist last changed; otherwise, read the wordlist into a dict.
+    """
+    wordlist = prefix + ".bookworm/texts/wordlist/wordlist.txt"
+    table = prefix + ".bookworm/texts/wordlist/wordlist.lookup"
+    if os.path.exists(table) and os.path.getmtime(table) >= os.path.getmtime(wordlist):
+        return LookupTable(table)
+    return readDictionaryFile(prefix)
+
+def count_ngram_ids(wordids, n):
+    """
+    Count the ngrams of length n in an array of wordids in a single
+    vectorized pass, skipping any ngram that includes an unknown word (-1).
+
+    Bigrams are packed into a single 64-bit key apiece, so they can be
+    counted like unigrams without building a tuple for every one.
+
+    Returns a (ngrams x n) array of wordids and an array of their counts.
+    """
+    if len(wordids) < n:
+        return np.zeros((0, n), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if n == 1:
+        grams, counts = np.unique(wordids[wordids >= 0], return_counts=True)
+        return grams[:, np.newaxis], counts
+    if n == 2:
+        first, second = wordids[:-1], wordids[1:]
+        keep = (first >= 0) & (second >= 0)
+        keys, counts = np.unique((first[keep] << 32) | second[keep], return_counts=True)
+        return np.column_stack([keys >> 32, keys & 0xFFFFFFFF]), counts
+    windows = np.column_stack([wordids[i:len(wordids) - n + 1 + i] for i in range(n)])
+    windows = windows[(windows >= 0).all(axis=1)]
+    return np.unique(windows, axis=0, return_counts=True)
+
+def encoded_columns(level):
+    """
+    The columns of an encoded file at a given level, in the order written.
+    """
+    n = gram_lengths[level]
+    if n == 1:
+        words = ["wordid"]
+    else:
+        words = ["word{}".format(i + 1) for i in range(n)]
+    return ["bookid"] + words + ["count"]
+
+def buildIDTable(prefix=""):
+    """
+    Read every filename and bookid out of the textids DB into a
+    memory-mapped lookup table, so that encode workers don't need an SQL
+    query per document.
+    """
+    ids = KV(prefix + ".bookworm/metadata/textids.sqlite")
+    try:
+        build_lookup_table(ids.conn.execute("SELECT key, ID FROM keys"),
+                           prefix + ".bookworm/metadata/textids.lookup")
+    finally:
+        ids.close()
+
 def readIDfile(prefix=""):
+    """
+    The map from filenames to bookids: the lookup table from `buildIDTable`,
+    if it's been built since the textids DB last changed, and otherwise
+    the DB itself.
+    """
     if not os.path.exists(".bookworm/metadata/textids.sqlite"):
         raise FileNotFoundError("No textids DB: run `bookworm build textids`")
-    return KV(prefix + ".bookworm/metadata/textids.sqlite")
+    db = prefix + ".bookworm/metadata/textids.sqlite"
+    table = prefix + ".bookworm/metadata/textids.lookup"
+    if os.path.exists(table) and os.path.getmtime(table) >= os.path.getmtime(db):
+        # Each filename is looked up once, so there's nothing to cache.
+        return LookupTable(table, preload=0, cache_size=0)
+    return KV(db)
 
 class tokenBatches(object):
     """
@@ -68,39 +194,228 @@ class tokenBatches(object):
 
     It also has a method that encodes and writes its wordcounts into a tsv file appropriate for reading with mysql,
     with 3-byte integer encoding for wordid and bookid.
+
+    Ngrams with a word outside the wordlist can't be encoded. With
+    `keep_oov`, they're kept aside for `bookworm vocab extend` to add
+    later without re-encoding everything: each batch numbers the words
+    in them itself, and writes those words with their unigram counts to
+    .bookworm/texts/encoded/oov/words and the ngram counts, in the binary
+    format of `encodedCounts`, to .bookworm/texts/encoded/oov/<level>.
+
+    The number of words each text has in the wordlist is written to
+    .bookworm/texts/encoded/nwords, so that the nwords table can be
+    loaded without summing master_bookcounts.
     """
     
-    def __init__(self, levels=["unigrams","bigrams"]):
+    def __init__(self, levels=["unigrams","bigrams"], output_format="tsv",
+                 docs_per_batch=DOCS_PER_BATCH, keep_oov=False):
         """
         
         mode: 'encode' (write files out)
+        output_format: 'tsv' for tab-separated text files, or 'binary' for
+            the fixed-width format in `encodedCounts`.
+        docs_per_batch: commit the files and start a new batch after
+            this many documents.
+        keep_oov: write out the counts of ngrams that can't be encoded.
         """
-        self.id = '%030x' % random.randrange(16**30)
         self.levels=levels
+        self.output_format = output_format
+        self.docs_per_batch = docs_per_batch
+        self.keep_oov = keep_oov
+        self.dictionary = None
 
         # placeholder to alert that createOutputFiles must be run.
         self.completedFile = None
         
     def createOutputFiles(self):
-        self.completedFile = open(".bookworm/texts/encoded/completed/" + self.id,"w")
+        """
+        Start a new batch. Everything is written under temporary names
+        until `commit` moves it into place.
+        """
+        self.id = '%030x' % random.randrange(16**30)
+        self.docs = 0
+        self.paths = dict()
+        self.completedFile = open(".bookworm/texts/encoded/completed/" + self.id + ".tmp","w")
+        self.paths[self.completedFile] = ".bookworm/texts/encoded/completed/" + self.id
         self.outputFiles = dict()
         for level in self.levels:
-            self.outputFiles[level] = open(".bookworm/texts/encoded/{}/{}.txt".format(level, self.id),"w")
+            extension = "bin" if self.output_format == "binary" else "txt"
+            path = ".bookworm/texts/encoded/{}/{}.{}".format(level, self.id, extension)
+            if self.output_format == "binary":
+                fout = open(path + ".tmp","wb")
+                fout.write(binary_header(encoded_columns(level)))
+            else:
+                fout = open(path + ".tmp","w")
+            self.outputFiles[level] = fout
+            self.paths[fout] = path
+        self.nwordsFile = None
+        if "unigrams" in self.levels:
+            path = ".bookworm/texts/encoded/nwords/{}.txt".format(self.id)
+            self.nwordsFile = open(path + ".tmp", "w")
+            self.paths[self.nwordsFile] = path
+        self.oovFiles = dict()
+        # The batch's own numbering of the words in OOV ngrams, and the
+        # unigram count of each.
+        self.oovWords = dict()
+        self.oovCounts = Counter()
+        if self.keep_oov:
+            for level in self.levels:
+                path = ".bookworm/texts/encoded/oov/{}/{}.bin".format(level, self.id)
+                fout = open(path + ".tmp", "wb")
+                fout.write(binary_header(encoded_columns(level)))
+                self.oovFiles[level] = fout
+                self.paths[fout] = path
+
+    def commit(self):
+        """
+        Make the current batch permanent. The files are synced to disk and
+        renamed, with the list of completed filenames last: so a batch is
+        complete exactly when its list is in the completed folder, and any
+        other files from a crashed run can be removed with
+        `removeUncommittedBatches`.
+        """
+        if self.completedFile is None:
+            return
+        files = list(self.outputFiles.values()) + list(self.oovFiles.values())
+        if self.nwordsFile is not None:
+            files.append(self.nwordsFile)
+        if self.keep_oov:
+            files.append(self.writeOOVWords())
+        for fout in files + [self.completedFile]:
+            fout.flush()
+            os.fsync(fout.fileno())
+            fout.close()
+            os.replace(fout.name, self.paths[fout])
+        if self.keep_oov:
+            for level in self.levels + ["words"]:
+                syncDirectory(".bookworm/texts/encoded/oov/" + level)
+        if self.nwordsFile is not None:
+            syncDirectory(".bookworm/texts/encoded/nwords")
+        syncDirectory(".bookworm/texts/encoded/completed")
+        self.completedFile = None
         
     def attachDictionaryAndID(self):
-        self.dictionary = readDictionaryFile()
+        self.dictionary = openDictionary()
         self.IDfile = readIDfile()
 
+    def lookup(self, words):
+        """
+        Translate a list of words into an array of wordids, with -1 for
+        words that aren't in the dictionary.
+        """
+        if isinstance(self.dictionary, LookupTable):
+            return self.dictionary.lookup(words)
+        get = self.dictionary.get
+        return np.fromiter(map(get, words, repeat(-1)), dtype=np.int64, count=len(words))
+
+    def encodeCounts(self, textid, counts, n, oov=None):
+        """
+        Encode a dictionary of ngram counts for a single text as an
+        unsigned integer array with one row per ngram and columns
+        (bookid, wordid[, wordid2...], count).
+
+        If any of the words in an ngram is not in the dictionary,
+        we don't include the whole ngram in the counts; if `oov` is a
+        Counter, it's added there instead.
+        """
+        grams = list(counts.keys())
+        if len(grams) == 0:
+            return np.zeros((0, n + 2), dtype=np.uint32)
+        wordids = np.column_stack([self.lookup([gram[i] for gram in grams])
+                                   for i in range(n)])
+        keep = (wordids >= 0).all(axis=1)
+        if oov is not None:
+            for i in np.flatnonzero(~keep):
+                oov[grams[i]] += counts[grams[i]]
+        output = np.empty((keep.sum(), n + 2), dtype=np.uint32)
+        output[:, 0] = textid
+        output[:, 1:n + 1] = wordids[keep]
+        output[:, n + 1] = np.fromiter(counts.values(), dtype=np.int64, count=len(grams))[keep]
+        return output
+
+    def encodeIDs(self, textid, wordids, n):
+        """
+        Like `encodeCounts`, but counting ngrams directly from the array of
+        wordids for a whole text.
+        """
+        grams, counts = count_ngram_ids(wordids, n)
+        output = np.empty((len(counts), n + 2), dtype=np.uint32)
+        output[:, 0] = textid
+        output[:, 1:n + 1] = grams
+        output[:, n + 1] = counts
+        return output
+
+    def writeRows(self, level, output):
+        """
+        Write an array from `encodeCounts` or `encodeIDs` to the level's file.
+        """
+        try:
+            if self.output_format == "binary":
+                write_binary_rows(self.outputFiles[level], output)
+            else:
+                self.outputFiles[level].write(format_rows(output))
+        except IOError as e:
+            logging.exception(e)
+
+    def writeNwords(self, output):
+        """
+        Write the total count for each bookid in an array of unigram
+        counts to the batch's nwords file.
+        """
+        bookids, inverse = np.unique(output[:, 0], return_inverse=True)
+        totals = np.bincount(inverse, weights=output[:, -1], minlength=len(bookids))
+        self.nwordsFile.write("".join(["{}\t{}\n".format(bookid, int(total))
+                                       for bookid, total in zip(bookids, totals)]))
+
+    def countOOV(self, tokens, wordids, n):
+        """
+        Count the ngrams of length n that `encodeIDs` leaves out of a
+        text because they include a word not in the dictionary.
+        """
+        unknown = wordids < 0
+        if len(wordids) < n or not unknown.any():
+            return Counter()
+        if n > 1:
+            # The ngram starting at each token is out if any of its words are.
+            unknown = np.column_stack([unknown[i:len(unknown) - n + 1 + i] for i in range(n)]).any(axis=1)
+        return Counter(tuple(tokens[i:i + n]) for i in np.flatnonzero(unknown))
+
+    def writeOOV(self, textid, level, oov):
+        """
+        Write a text's out-of-vocabulary ngram counts to the side file
+        for the level, as rows of bookid, the batch's numbers for the
+        words, and count.
+        """
+        rows = []
+        for gram, count in oov.items():
+            # Tabs and newlines can't be in the wordlist anyway.
+            if any("\t" in word or "\n" in word for word in gram):
+                continue
+            ids = [self.oovWords.setdefault(word, len(self.oovWords)) for word in gram]
+            if level == "unigrams":
+                self.oovCounts[ids[0]] += count
+            rows.append([textid] + ids + [count])
+        if len(rows) > 0:
+            write_binary_rows(self.oovFiles[level], np.array(rows, dtype=np.uint32))
+
+    def writeOOVWords(self):
+        """
+        Write the words numbered by `writeOOV`, one per line in order
+        with their unigram counts, and return the (still open) file.
+        """
+        path = ".bookworm/texts/encoded/oov/words/{}.txt".format(self.id)
+        fout = open(path + ".tmp", "w")
+        self.paths[fout] = path
+        fout.write("".join(["{}\t{}\n".format(word, self.oovCounts[i])
+                            for word, i in self.oovWords.items()]))
+        return fout
 
     def close(self):
         """
         This test allows the creation of bookworms with fewer document than requested 
         threads, which happens to be the case in the tests.
         """
-        if self.completedFile is not None:
-            self.completedFile.close()
-            for v in self.outputFiles.values():
-                v.close()
+        self.commit()
         
     def encodeRow(self,
                   filename,
@@ -112,74 +427,49 @@ class tokenBatches(object):
         'tokenizer': a tokenizer object
 
         """
+        if self.dictionary is None:
+            self.attachDictionaryAndID()
         if self.completedFile is None:
             self.createOutputFiles()
-            self.attachDictionaryAndID()
             
         #The dictionary and ID lookup tables should be pre-attached.
-        dictionary = self.dictionary
         IDfile = self.IDfile
 
-        levels = None
-        """
-        if source=="raw_text":
-            parts = row.split("\t", 1)
-            filename = parts[0]
-            try:
-                tokens = tokenizer(parts[1])
-            except IndexError:
-                logging.warn("\nFound no tab in the input for '" + filename + "'...skipping row\n")
-            levels = self.levels
-
-        if source == "countfile":
-            try:
-                (filename, token, count) = row.split("\t")
-            except:
-                logging.error("Can't find tab\n***************")
-                logging.error(row)
-                raise
-            tokens = preTokenized(token, count, self.levels[0])
-        """
-        
         try:
             textid = IDfile[filename]
         except KeyError:
             logging.warn("Warning: file " + filename + " not found in jsoncatalog.txt, not encoding")
             return
 
+        # Raw text is looked up once, token by token, and every level is
+        # counted from the same wordids; pre-tokenized counts come as ngrams.
+        wordids = None
+        if isinstance(tokenizer, Tokenizer):
+            tokens = tokenizer.tokenize()
+            wordids = self.lookup(tokens)
+
         for level in self.levels:
-            outputFile = self.outputFiles[level]
-            output = []
-
-            counts = tokenizer.counts(level)
-
-            for wordset, count in counts.items():
-                skip = False
-                wordList = []
-                for word in wordset:
-                    try:
-                        wordList.append(dictionary[word])
-                    except KeyError:
-                        """
-                        if any of the words to be included is not in the dictionary,
-                        we don't include the whole n-gram in the counts.
-                        """
-                        skip = True                        
-                if not skip:
-                    wordids = "\t".join(wordList)
-                    output.append("{}\t{}\t{}".format(int(textid), wordids, count))
-
-            try:
-                if len(output) > 0:
-                    # The test is necessary because otherwise this prints a blank line.
-                    outputFile.write("\n".join(output) + "\n")
-                
-            except IOError as e:
-                logging.exception(e)
+            oov = Counter() if self.keep_oov else None
+            if wordids is not None:
+                output = self.encodeIDs(textid, wordids, gram_lengths[level])
+                if self.keep_oov:
+                    oov = self.countOOV(tokens, wordids, gram_lengths[level])
+            else:
+                output = self.encodeCounts(textid, tokenizer.counts(level), gram_lengths[level], oov)
+            if self.keep_oov:
+                self.writeOOV(textid, level, oov)
+            self.writeRows(level, output)
+            if level == "unigrams":
+                # Written even if it's zero, so every text has a total.
+                self.nwordsFile.write("{}\t{}\n".format(textid, int(output[:, -1].sum())))
 
         if write_completed:
             self.completedFile.write(filename + "\n")
 
+        self.docs += 1
+        if self.docs >= self.docs_per_batch:
+            self.commit()
+
 class Tokenizer(object):
     """
     A tokenizer is initialized with a single text string.
@@ -207,19 +497,17 @@ class Tokenizer(object):
         """
         if self.tokens is not None:
             return self.tokens
+        tokenization_regex=self.tokenization_regex
+        if tokenization_regex is None:
+            # by default, use the big regex, through the fast path.
+            self.tokens = fast_tokenize(self.string)
+            return self.tokens
         """
         For speed, don't import until here.
         """
-        tokenization_regex=self.tokenization_regex
         global re
         if re is None:
             import regex as re
-        if tokenization_regex is None:
-            # by default, use the big regex.
-            global bigregex
-            if bigregex==None:
-                bigregex = wordRegex()
-            tokenization_regex = bigregex
         self.tokens = re.findall(tokenization_regex, self.string)
         return self.tokens
 
@@ -229,11 +517,17 @@ class Tokenizer(object):
         copies of the text to itself.
         """
         
+        return list(self.iter_ngrams(n, collapse))
+
+    def iter_ngrams(self, n, collapse = False):
+        """
+        Like `ngrams`, but without building the list.
+        """
         self.tokenize()
-        l = list(zip(*[self.tokens[i:] for i in range(n)]))
+        grams = zip(*[islice(self.tokens, i, None) for i in range(n)])
         if collapse:
-            l = [" ".join(tupled) for tupled in l]
-        return l
+            grams = map(" ".join, grams)
+        return grams
 
     def unigrams(self):
         return self.ngrams(1)
@@ -258,14 +552,9 @@ class Tokenizer(object):
         return self.tokens
     
     def counts(self, whichType):
-        
-        count = dict()
-        for gram in getattr(self,whichType)():
-            try:
-                count[gram] += 1
-            except KeyError:
-                count[gram] = 1
-        return count
+        if whichType in gram_lengths:
+            return Counter(self.iter_ngrams(gram_lengths[whichType]))
+        return Counter(getattr(self, whichType)())
 
 
 class PreTokenized(object):
@@ -294,16 +583,63 @@ class PreTokenized(object):
         return self.output
 
     
-def getAlreadySeenList(folder):
+def syncDirectory(path):
+    """
+    Flush renames in a directory to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def committedBatches(level=None):
+    """
+    The ids of all committed batches; or, if a level is given, of those
+    with files at that level.
+    """
+    ids = set([f for f in os.listdir(".bookworm/texts/encoded/completed")
+               if not f.endswith(".tmp")])
+    if level is None:
+        return ids
+    folder = ".bookworm/texts/encoded/" + level
+    return ids & set([f.split(".")[0] for f in os.listdir(folder)])
+
+def removeUncommittedBatches(levels=gram_lengths.keys()):
+    """
+    Delete the files left by batches that never committed.
+    """
+    committed = committedBatches()
+    levels = list(levels)
+    for level in levels + ["oov/" + level for level in levels] + ["oov/words", "nwords", "completed"]:
+        folder = ".bookworm/texts/encoded/" + level
+        if not os.path.exists(folder):
+            continue
+        for f in os.listdir(folder):
+            path = folder + "/" + f
+            if os.path.isfile(path) and (f.endswith(".tmp") or f.split(".")[0] not in committed):
+                logging.info("Removing uncommitted encoded file " + path)
+                os.remove(path)
+
+def getAlreadySeenList(folder, ids=None):
     #Load in a list of what's already been translated for that level.
     #Returns a set.
     files = os.listdir(folder)
     seen = set([])
     for file in files:
+        if file.endswith(".tmp") or (ids is not None and file not in ids):
+            continue
         for line in open(folder + "/" + file):
             seen.add(line.rstrip("\n"))
     return seen
 
+def getCompletedFilenames(level):
+    """
+    The filenames already encoded at a level, from the lists of
+    committed batches.
+    """
+    return getAlreadySeenList(".bookworm/texts/encoded/completed", committedBatches(level))
+
 def encode_text_stream():
     seen = getAlreadySeenList(".bookworm/texts/encoded/completed")
     tokenBatch = tokenBatches()
@@ -33,6 +33,9 @@ def splitMySQLcode(string):
     return output
 
 
+# The types a categorical variable's ids can be stored in, narrowest first.
+INT_TYPES = ["TINYINT UNSIGNED", "SMALLINT UNSIGNED", "MEDIUMINT UNSIGNED", "INT UNSIGNED"]
+
 def guessBasedOnNameAndContents(metadataname,dictionary):
     """
     This makes a guess based on the data field's name and type.
@@ -206,6 +209,40 @@ class dataField(object):
         # cursor = db.query("""SELECT count(*) FROM """ + dfield.field + """Disk""")
         db.query("ALTER TABLE " + dfield.field + "Disk ENABLE KEYS")
 
+    def appendDiskTable(self, fileLocation):
+        """
+        Add rows for new texts to the disk table from `buildDiskTable`.
+        """
+        logging.info("Adding new rows to " + self.field + "Disk")
+        self.dbToPutIn.query("""LOAD DATA LOCAL INFILE '""" + fileLocation + """'
+               INTO TABLE """ + self.field + """Disk
+               FIELDS ESCAPED BY '';""")
+
+    def append_ID_and_lookup_tables(self, first_bookid):
+        """
+        Update the tables from `build_ID_and_lookup_tables` for texts
+        with bookids from `first_bookid` on.
+
+        Values already in the ID table keep their ids; new ones are
+        numbered after them. (Unlike in `buildIdTable`, there's no
+        minimum count: a handful of new texts can't be measured against
+        the whole catalog.)
+        """
+        db = self.dbToPutIn
+        self.first_bookid = first_bookid
+        self.widenIntType()
+        db.query("""INSERT INTO %(field)s__id (%(field)s,%(field)s__count)
+                    SELECT %(table)s.%(field)s,count(*) FROM %(table)s
+                    LEFT JOIN %(field)s__id USING (%(field)s)
+                    WHERE %(table)s.%(anchor)s >= %(first_bookid)s AND %(field)s__id.%(field)s__id IS NULL
+                    GROUP BY %(table)s.%(field)s ORDER BY count(*) DESC""" % self.__dict__)
+        for query in splitMySQLcode(self.fastLookupTableIfNecessary("MYISAM")):
+            db.query(query)
+        if not self.unique:
+            db.query("""INSERT INTO %(field)sheap_ SELECT %(anchor)s ,%(field)s__id
+                        FROM %(field)s__id JOIN %(field)sDisk USING (%(field)s)
+                        WHERE %(field)sDisk.%(anchor)s >= %(first_bookid)s""" % self.__dict__)
+
     def build_ID_and_lookup_tables(self):
         IDcode = self.buildIdTable()
         for query in splitMySQLcode(IDcode):
@@ -314,7 +351,9 @@ class dataField(object):
 
         return mydict
 
-    def setIntType(self):
+    def setIntType(self, recount=False):
+        if recount and hasattr(self, "intType"):
+            del self.intType
         try:
             alreadyExists = self.intType
         except AttributeError:
@@ -328,6 +367,29 @@ class dataField(object):
             if self.nCategories <= 255:
                 self.intType = "TINYINT UNSIGNED"
 
+    def widenIntType(self):
+        """
+        Make sure the ids of a categorical variable still fit after new
+        values were appended to its table: if there are now too many for
+        the integer type its `__id` columns were built with, widen them.
+        The lookup table is rebuilt from `__id` afterwards, so it
+        isn't altered here.
+        """
+        db = self.dbToPutIn
+        column = db.query("SHOW COLUMNS FROM %(field)s__id WHERE Field='%(field)s__id'" % self.__dict__).fetchall()[0][1]
+        current = column.split("(")[0].split(" ")[0].upper() + " UNSIGNED"
+        self.setIntType(recount=True)
+        if INT_TYPES.index(self.intType) <= INT_TYPES.index(current):
+            # Never narrow a column that already holds ids.
+            self.intType = current
+            return
+        logging.info("Widening %s__id from %s to %s" % (self.field, current, self.intType))
+        db.query("ALTER TABLE %(field)s__id MODIFY %(field)s__id %(intType)s NOT NULL AUTO_INCREMENT" % self.__dict__)
+        if self.unique:
+            db.query("ALTER TABLE %(fasttab)s_ MODIFY %(field)s__id %(intType)s" % self.__dict__)
+        else:
+            db.query("ALTER TABLE %(field)sheap_ MODIFY %(field)s__id %(intType)s" % self.__dict__)
+
     def buildIdTable(self, minimum_occurrence_rate = 1/100000):
 
         """
@@ -827,6 +889,42 @@ class variableSet(object):
             for query in splitMySQLcode(fileCommand):
                 db.query(query)
 
+    def appendMetadata(self, newFile, first_bookid, counts_table="master_bookcounts", batches=None):
+        """
+        Add the entries in `newFile`--new lines of the derived catalog,
+        whose bookids all start at `first_bookid`--to the tables
+        `loadMetadata` built, without rebuilding them.
+
+        Rows already loaded and the ids of categories already seen are
+        left as they are. Word counts for the new texts come from the
+        encoded `batches` they're in: see `createNwordsFile`.
+        """
+        if self.tableName != "catalog":
+            raise ValueError("Only the main catalog can be appended to")
+        db = self.db
+        self.originFile = newFile
+        self.catalogLocation = ".bookworm/metadata/catalog_appended.txt"
+        for variable in self.notUniques():
+            variable.outputloc = ".bookworm/metadata/%s_appended.txt" % variable.field
+        self.writeMetadata()
+
+        logging.info("Adding new rows to catalog")
+        loadingFields = ["bookid", "filename"] + [variable.field for variable in self.uniques()]
+        db.query("""LOAD DATA LOCAL INFILE '%s'
+                    INTO TABLE catalog FIELDS ESCAPED BY ''
+                    (%s)""" % (self.catalogLocation, ",".join(loadingFields)))
+        self.createNwordsFile(counts_table, batches)
+
+        for variable in self.notUniques():
+            variable.appendDiskTable(variable.outputloc)
+
+        for variable in self.variables:
+            if variable.datatype=="categorical":
+                variable.append_ID_and_lookup_tables(first_bookid)
+        # The stored code for the memory tables names the id types and
+        # the longest value, which the new rows may have changed.
+        self.updateMasterVariableTable()
+
     def uniqueVariableFastSetup(self,engine="MEMORY"):
         fileCommand = "DROP TABLE IF EXISTS tmp;"
         fileCommand += "CREATE TABLE tmp ({} INT UNSIGNED, PRIMARY KEY  ({}), ".format(
@@ -879,15 +977,59 @@ class variableSet(object):
             self.db.query('DELETE FROM masterTableTable WHERE masterTableTable.tablename="%s";' %self.fastName)
             self.db.query("INSERT INTO masterTableTable VALUES (%s, %s, %s)", (self.fastName,parentTab,escape_string(fileCommand)))
     
-    def createNwordsFile(self):
+    def loadNwordsFiles(self, batches=None):
+        """
+        Bulk-load the word totals for each book, written alongside the
+        encoded files, into nwords; books already there are skipped.
+        If `batches` is given, only the totals from those batches are loaded.
+
+        Returns False if some unigram counts have no totals to go with
+        them--because they were encoded before totals were kept, or are
+        pre-made feature counts--so that they still have to be summed.
+        """
+        from .tokenizer import committedBatches
+        import pandas as pd
+        folder = ".bookworm/texts/encoded/"
+        counted = set()
+        if os.path.exists(folder + "nwords"):
+            counted = committedBatches("nwords")
+        if batches is None:
+            batches = [f.split(".")[0] for f in os.listdir(folder + "unigrams")
+                       if os.path.splitext(f)[1] in [".txt", ".bin", ".h5", ".parquet"]]
+        batches = set(batches)
+        covered = len(batches - counted) == 0
+
+        paths = [folder + "nwords/" + batch + ".txt" for batch in sorted(batches & counted)]
+        paths = [path for path in paths if os.path.getsize(path) > 0]
+        if len(paths) == 0:
+            return covered
+        # A book may have totals in more than one batch, if `bookworm
+        # vocab extend` added counts for it.
+        totals = pd.concat([pd.read_csv(path, sep="\t", header=None, names=["bookid", "nwords"])
+                            for path in paths]).groupby("bookid")["nwords"].sum()
+        location = ".bookworm/metadata/nwords.txt"
+        totals.to_csv(location, sep="\t", header=False)
+        logging.info("Loading word totals for %d books" % len(totals))
+        self.db.query("""LOAD DATA LOCAL INFILE '%s'
+                         IGNORE INTO TABLE nwords (bookid, nwords)""" % location)
+        return covered
+
+    def createNwordsFile(self, counts_table="master_bookcounts", batches=None):
         """
         A necessary supplement to the `catalog` table.
+
+        The totals come from the files written at encoding (those of
+        `batches`, if given: see `loadNwordsFiles`). Only if some counts
+        have none is `counts_table` summed, for books that are still
+        missing from `nwords`; so it need only hold the new ones.
         """
         db = self.db
 
         db.query("CREATE TABLE IF NOT EXISTS nwords (bookid INT UNSIGNED, PRIMARY KEY (bookid), nwords INT);")
         db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
-        db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN master_bookcounts USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid")
+        if not self.loadNwordsFiles(batches):
+            logging.info("Summing %s for books encoded without word totals" % counts_table)
+            db.query("INSERT INTO nwords (bookid,nwords) SELECT catalog.bookid,sum(count) FROM catalog LEFT JOIN nwords USING (bookid) JOIN %s USING (bookid) WHERE nwords.bookid IS NULL GROUP BY catalog.bookid" % counts_table)
         db.query("UPDATE catalog JOIN nwords USING (bookid) SET catalog.nwords = nwords.nwords")
 
 
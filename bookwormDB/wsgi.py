@@ -1,4 +1,7 @@
 from bookwormDB.general_API import SQLAPIcall as SQLAPIcall
+from bookwormDB.general_API import DuckDBAPIcall
+from bookwormDB.general_API import prefs
+from bookwormDB.resultCache import ResultCache
 import json
 from urllib.parse import unquote
 import logging
@@ -7,6 +10,11 @@ import gunicorn.app.base
 from datetime import datetime
 from urllib.parse import parse_qs
 
+backends = {"mysql": SQLAPIcall, "duckdb": DuckDBAPIcall}
+
+# The class that answers queries; set by `run`.
+api_class = SQLAPIcall
+
 def content_type(query):
     try:
         format = query['format']
@@ -84,7 +92,7 @@ def application(environ, start_response, logfile = "bookworm_queries.log"):
         start_response(status, list(headers.items()))
         return [b'{"status":"error", "message": "You have passed invalid JSON to the Bookworm API"}']
 
-    process = SQLAPIcall(query)
+    process = api_class(query)
     response_body = process.execute()
 
     # It might be binary already.
@@ -131,7 +139,16 @@ class StandaloneApplication(gunicorn.app.base.BaseApplication):
     def load(self):
         return self.application
 
-def run(port = 10012, workers = number_of_workers()):
+def run(port = 10012, workers = number_of_workers(), backend = "mysql", duckdb_directory = None,
+        cache_megabytes = 0, cache_file = None):
+    global api_class
+    api_class = backends[backend]
+    if duckdb_directory is not None:
+        prefs['duckdb_directory'] = duckdb_directory
+    if cache_megabytes > 0:
+        prefs['result_cache'] = ResultCache(max_bytes = cache_megabytes * 2**20, path = cache_file,
+                                            max_disk_bytes = 10 * cache_megabytes * 2**20)
+
     if workers==0:
         workers = number_of_workers()
         
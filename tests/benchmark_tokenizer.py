@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tokenizer throughput on a single core, in MB of utf-8 text per second.
+
+    python tests/benchmark_tokenizer.py [input.txt] [repeats]
+
+The input is a bookworm input file (filename, tab, text), by default
+the federalist test set. Reports the fast default tokenizer against the
+plain regex it has to agree with, and tokenizing plus counting bigrams.
+"""
+
+import sys
+import os
+import time
+from bookwormDB.tokenizer import Tokenizer, wordRegex
+
+def load(path):
+    texts = []
+    for line in open(path, encoding="utf-8"):
+        try:
+            texts.append(line.rstrip("\n").split("\t", 1)[1])
+        except IndexError:
+            continue
+    return texts
+
+def timed(texts, repeats, f):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            f(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    default = os.path.join(os.path.dirname(__file__), "test_bookworm_files", "input.txt")
+    path = sys.argv[1] if len(sys.argv) > 1 else default
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    texts = load(path)
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) / 1e6
+    regex = wordRegex()
+
+    engines = [
+        ("regex", lambda text: regex.findall(text)),
+        ("fast", lambda text: Tokenizer(text).tokenize()),
+        ("fast + bigram counts", lambda text: Tokenizer(text).counts("bigrams")),
+    ]
+    print("{:.2f} MB in {} texts, best of {}".format(megabytes, len(texts), repeats))
+    for name, f in engines:
+        elapsed = timed(texts, repeats, f)
+        print("{:<22}{:>8.2f} MB/s per core".format(name, megabytes / elapsed))
+
+if __name__=="__main__":
+    main()
@@ -27,6 +27,30 @@ class Bookworm_SQL_Creation(unittest.TestCase):
         Then we test whether the API can make queries on that bookworm.
         """
         
+    def test_connection_pool(self):
+        from bookwormDB.mariaDB import ConnectionPool
+        pool = ConnectionPool(check_after=0)
+        first = pool.run("federalist_bookworm", lambda con: con)
+        self.assertIs(pool.run("federalist_bookworm", lambda con: con), first)
+        # A connection that has gone bad is replaced.
+        first.db.close()
+        second = pool.run("federalist_bookworm", lambda con: con)
+        self.assertIsNot(second, first)
+        second.cursor.execute("SELECT 1")
+        self.assertEqual(second.cursor.fetchall()[0][0], 1)
+
+    def test_schema_cache(self):
+        from bookwormDB.mariaDB import SchemaCache, pool
+        schemas = SchemaCache(ttl=0)
+        first = pool.run("federalist_bookworm", schemas.get)
+        second = pool.run("federalist_bookworm", schemas.get)
+        # Nothing changed in between, so the schema is reused.
+        self.assertIs(second.tableToLookIn, first.tableToLookIn)
+        schemas.invalidate("federalist_bookworm")
+        third = pool.run("federalist_bookworm", schemas.get)
+        self.assertIsNot(third.tableToLookIn, first.tableToLookIn)
+        self.assertEqual(third.aliases, first.aliases)
+
     def test_API(self):
         from bookwormDB.general_API import SQLAPIcall as SQLAPIcall
         import json
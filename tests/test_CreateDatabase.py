@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import threading
+import re
+import os
+from collections import defaultdict, Counter
+import numpy as np
+import pandas as pd
+import bookwormDB.CreateDatabase
+from bookwormDB.CreateDatabase import (load_count_file, insert_rows, columnar_chunks,
+                                       BookwormSQLDatabase)
+from bookwormDB.encodedCounts import binary_header, write_binary_rows
+
+"""
+Loading counts into MySQL, with the server replaced by a stub that keeps
+each table as a list of rows and understands just the statements the
+loaders send.
+"""
+
+try:
+    import tables
+except ImportError:
+    tables = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class StubCursor(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.result = []
+
+    def execute(self, sql, params = None):
+        server = self.server
+        with server.lock:
+            server.statements.append(sql)
+            if server.fail is not None and server.fail(sql):
+                raise RuntimeError("Stub server error")
+        if sql.startswith("SET ") or sql.startswith("ALTER TABLE "):
+            return
+        variable = re.match(r"SELECT @@GLOBAL\.(\w+)", sql)
+        if variable:
+            self.result = [(server.variables[variable.group(1)], )]
+            return
+        count = re.match(r"SELECT COUNT\(\*\) FROM (\w+)", sql)
+        if count:
+            self.result = [(len(server.tables[count.group(1)]), )]
+            return
+        insert = re.match(r"INSERT INTO (\w+) \((.*?)\) VALUES (.*)", sql, re.S)
+        if insert:
+            rows = [tuple(int(value) for value in row.split(","))
+                    for row in re.findall(r"\(([\d,\s]+)\)", insert.group(3))]
+            with server.lock:
+                server.tables[insert.group(1)].extend(rows)
+            return
+        raise ValueError("The stub doesn't understand " + sql)
+
+    def executemany(self, sql, many_params):
+        tablename = re.match(r"INSERT INTO (\w+)", sql).group(1)
+        with self.server.lock:
+            self.server.tables[tablename].extend(tuple(row) for row in many_params)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+class StubConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+
+    def cursor(self):
+        return StubCursor(self.server)
+
+    def close(self):
+        with self.server.lock:
+            self.server.closed += 1
+
+
+class StubServer(object):
+    """
+    What every connection to the stub sees.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = defaultdict(list)
+        self.variables = {"myisam_sort_buffer_size": 8 * 2**20}
+        self.statements = []
+        self.connections = 0
+        self.closed = 0
+        # A function of each statement: if it returns True, the statement fails.
+        self.fail = None
+        # Rows LOAD DATA takes before failing, or None for it to succeed.
+        self.load_fails_after = None
+
+
+class StubDB(object):
+    """
+    Stands in for `DB`, over the server in `StubDB.server`.
+    """
+    server = None
+
+    def __init__(self, dbname = None):
+        self.dbname = dbname
+        self.conn = None
+
+    def connect(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.conn = StubConnection(self.server)
+
+    def query(self, sql, params = None, many_params = None):
+        if self.conn is None:
+            self.connect()
+        cursor = self.conn.cursor()
+        if many_params is not None:
+            cursor.executemany(sql, many_params)
+        else:
+            cursor.execute(sql, params)
+        return cursor
+
+    def load_rows(self, tablename, columns, chunks):
+        rows = [tuple(row) for chunk in chunks for row in chunk.tolist()]
+        fails_after = self.server.load_fails_after
+        if fails_after is not None:
+            self.server.tables[tablename].extend(rows[:fails_after])
+            raise RuntimeError("LOAD DATA failed")
+        self.server.tables[tablename].extend(rows)
+
+
+class Stubbed(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = bookwormDB.CreateDatabase.DB
+        StubDB.server = StubServer()
+        bookwormDB.CreateDatabase.DB = StubDB
+        self.server = StubDB.server
+
+    def tearDown(self):
+        bookwormDB.CreateDatabase.DB = self.saved
+        shutil.rmtree(self.directory)
+
+    def bookworm(self):
+        bookworm = BookwormSQLDatabase.__new__(BookwormSQLDatabase)
+        bookworm.dbname = "test"
+        return bookworm
+
+    def write_bin(self, rows, columns = ["bookid", "wordid", "count"]):
+        path = os.path.join(self.directory, "counts.bin")
+        with open(path, "wb") as fout:
+            fout.write(binary_header(columns))
+            write_binary_rows(fout, np.array(rows).reshape(-1, len(columns)))
+        return path
+
+
+def count_rows(n):
+    return [(bookid, bookid * 7 % 13, bookid % 5 + 1) for bookid in range(1, n + 1)]
+
+
+class Load_Count_File(Stubbed):
+
+    def test_loaded(self):
+        path = self.write_bin(count_rows(50))
+        load_count_file(StubDB("test"), "master_bookcounts", path, ["bookid", "wordid", "count"])
+        self.assertEqual(self.server.tables["master_bookcounts"], count_rows(50))
+
+    def test_falls_back_when_nothing_loaded(self):
+        # As when the server doesn't allow LOAD DATA LOCAL INFILE.
+        self.server.load_fails_after = 0
+        path = self.write_bin(count_rows(50))
+        load_count_file(StubDB("test"), "master_bookcounts", path, ["bookid", "wordid", "count"])
+        self.assertEqual(sorted(self.server.tables["master_bookcounts"]), count_rows(50))
+
+    def test_raises_when_partly_loaded(self):
+        self.server.load_fails_after = 20
+        path = self.write_bin(count_rows(50))
+        with self.assertRaises(RuntimeError):
+            load_count_file(StubDB("test"), "master_bookcounts", path, ["bookid", "wordid", "count"])
+        # Nothing is inserted on top of what the LOAD left.
+        self.assertEqual(self.server.tables["master_bookcounts"], count_rows(20))
+
+    def test_empty_file(self):
+        path = os.path.join(self.directory, "counts.txt")
+        open(path, "w").close()
+        load_count_file(StubDB("test"), "master_bookcounts", path, ["bookid", "wordid", "count"])
+        self.assertEqual(self.server.statements, [])
+
+
+class Insert_Rows(Stubbed):
+
+    def setUp(self):
+        super(Insert_Rows, self).setUp()
+        self.batch_rows = bookwormDB.CreateDatabase.INSERT_BATCH_ROWS
+        bookwormDB.CreateDatabase.INSERT_BATCH_ROWS = 7
+
+    def tearDown(self):
+        bookwormDB.CreateDatabase.INSERT_BATCH_ROWS = self.batch_rows
+        super(Insert_Rows, self).tearDown()
+
+    def chunks(self, sizes):
+        rows = np.array(count_rows(sum(sizes))).reshape(-1, 3)
+        starts = np.cumsum([0] + sizes)
+        return [rows[start:end] for start, end in zip(starts[:-1], starts[1:])]
+
+    def inserts(self):
+        return [sql for sql in self.server.statements if sql.startswith("INSERT")]
+
+    def test_every_row_once(self):
+        insert_rows(StubDB("test"), "master_bookcounts", ["bookid", "wordid", "count"],
+                    iter(self.chunks([20, 0, 3, 7])), connections = 2)
+        self.assertEqual(Counter(self.server.tables["master_bookcounts"]), Counter(count_rows(30)))
+        sizes = [sql.count("(") - 1 for sql in self.inserts()]
+        # Statements never span chunks.
+        self.assertEqual(sorted(sizes), sorted([7, 7, 6, 3, 7]))
+        # Each sender opened and closed its own connection.
+        self.assertEqual((self.server.connections, self.server.closed), (2, 2))
+
+    def test_sender_error_raised(self):
+        sent = []
+
+        def fail(sql):
+            if sql.startswith("INSERT"):
+                sent.append(sql)
+                return len(sent) == 3
+            return False
+
+        self.server.fail = fail
+        with self.assertRaises(RuntimeError):
+            insert_rows(StubDB("test"), "master_bookcounts", ["bookid", "wordid", "count"],
+                        iter(self.chunks([100] * 50)), connections = 2)
+        # The senders stopped, and the producer with them.
+        self.assertLess(len(self.inserts()), 50 * 15)
+        self.assertEqual(self.server.closed, 2)
+
+
+class Run_Concurrently(Stubbed):
+
+    def test_results_in_order(self):
+        tasks = [lambda db, i=i: i * i for i in range(20)]
+        self.assertEqual(self.bookworm().run_concurrently(tasks, 4), [i * i for i in range(20)])
+        self.assertLessEqual(self.server.connections, 4)
+        self.assertEqual(self.server.closed, self.server.connections)
+
+    def test_error_raised(self):
+        def fail(db):
+            raise KeyError("part")
+        tasks = [lambda db: 1, fail, lambda db: 3]
+        with self.assertRaises(KeyError):
+            self.bookworm().run_concurrently(tasks, 2)
+        self.assertEqual(self.server.closed, self.server.connections)
+
+    def test_setup_on_each_connection(self):
+        def setup(db):
+            db.query("SELECT COUNT(*) FROM setup")
+        self.bookworm().run_concurrently([lambda db: None] * 10, 3, setup = setup)
+        setups = [sql for sql in self.server.statements if sql.endswith("setup")]
+        self.assertEqual(len(setups), self.server.connections)
+
+
+class Enable_Keys(Stubbed):
+
+    def enable_keys(self, **kwargs):
+        tablenames = ["master_bookcounts_p%d" % i for i in range(1, 5)]
+        bookworm = self.bookworm()
+        bookworm.db = StubDB("test")
+        bookworm.enable_keys(tablenames, workers = 2, **kwargs)
+        self.assertEqual(sorted(sql for sql in self.server.statements if sql.startswith("ALTER")),
+                         ["ALTER TABLE %s ENABLE KEYS" % tablename for tablename in tablenames])
+        return set(sql for sql in self.server.statements if sql.startswith("SET SESSION"))
+
+    def test_global_sort_buffer(self):
+        # Each connection gets the whole buffer, not a share of it.
+        self.assertEqual(self.enable_keys(), set(["SET SESSION myisam_sort_buffer_size = %d" % (8 * 2**20)]))
+
+    def test_sort_buffer_given(self):
+        self.assertEqual(self.enable_keys(sort_buffer_size = 64 * 2**20),
+                         set(["SET SESSION myisam_sort_buffer_size = %d" % (64 * 2**20)]))
+
+
+class Columnar_Chunks(unittest.TestCase):
+
+    columns = ["bookid", "wordid", "count"]
+    legacy = ["wordid", "bookid", "count"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rows = np.array(count_rows(25))
+        self.frame = pd.DataFrame(rows, columns = self.columns)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        chunks = list(columnar_chunks(path, "unigrams", self.columns, self.legacy, chunksize = 10))
+        self.assertEqual([len(chunk) for columns, chunk in chunks], [10, 10, 5])
+        columns = chunks[0][0]
+        rows = np.concatenate([chunk for columns, chunk in chunks])
+        # In the order `columns` asks for.
+        return rows[:, [columns.index(column) for column in self.columns]]
+
+    def frames(self):
+        expected = self.frame.to_numpy()
+        # Named, in any order, and with some as index levels.
+        yield self.frame[["count", "wordid", "bookid"]], expected
+        yield self.frame.set_index(["wordid", "bookid"]), expected
+        # Unnamed, as older bookworms wrote them: wordid and bookid as
+        # index levels, then the count.
+        legacy = self.frame[self.legacy].copy()
+        legacy.columns = ["a", "b", "c"]
+        yield legacy.set_index(["a", "b"]).rename_axis([None, None]), expected
+
+    @unittest.skipIf(tables is None, "PyTables is not installed")
+    def test_hdf5(self):
+        for frame, expected in self.frames():
+            path = os.path.join(self.directory, "counts.h5")
+            frame.to_hdf(path, key = "unigrams", format = "table", mode = "w")
+            self.assertEqual(self.read(path).tolist(), expected.tolist())
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet(self):
+        for frame, expected in self.frames():
+            path = os.path.join(self.directory, "counts.parquet")
+            frame.to_parquet(path)
+            self.assertEqual(self.read(path).tolist(), expected.tolist())
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+from subprocess import call
+from bookwormDB.MetaParser import parse_catalog_multicore
+from bookwormDB.sqliteKV import KV
+
+"""
+Appending texts to a built bookworm should leave it as if it had been
+built with them from the start.
+
+The catalog tests run anywhere. The database tests build a bookworm
+from the first federalist paragraphs, append the rest, and compare
+its answers with those of the federalist bookworm that setup.py builds
+from all of them. A categorical field with a value for every paragraph
+outgrows the TINYINT ids it starts with.
+"""
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+source = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_bookworm_files")
+
+passage_field = {"datatype": "categorical", "field": "passage", "unique": True, "type": "text"}
+
+
+def catalog_lines():
+    lines = []
+    for line in open(os.path.join(source, "jsoncatalog.txt"), encoding="utf-8"):
+        entry = json.loads(line)
+        entry["passage"] = entry["filename"]
+        lines.append(json.dumps(entry) + "\n")
+    return lines
+
+
+def input_lines(filenames):
+    return [line for line in open(os.path.join(source, "input.txt"), encoding="utf-8")
+            if line.split("\t", 1)[0] in filenames]
+
+
+def write_bookworm(directory, catalog):
+    """
+    Write the files a bookworm is built from for the entries in `catalog`.
+    """
+    filenames = set(json.loads(line)["filename"] for line in catalog)
+    with open(os.path.join(directory, "jsoncatalog.txt"), "w", encoding="utf-8") as fout:
+        fout.writelines(catalog)
+    with open(os.path.join(directory, "input.txt"), "w", encoding="utf-8") as fout:
+        fout.writelines(input_lines(filenames))
+    fields = json.load(open(os.path.join(source, "field_descriptions.json")))
+    with open(os.path.join(directory, "field_descriptions.json"), "w") as fout:
+        json.dump(fields + [passage_field], fout)
+
+
+class Catalog_Append(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.makedirs(".bookworm/metadata")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_skip_registered(self):
+        catalog = catalog_lines()
+        write_bookworm(self.directory, catalog[:100])
+        self.assertEqual(parse_catalog_multicore(), 100)
+
+        write_bookworm(self.directory, catalog[:300])
+        self.assertEqual(parse_catalog_multicore(append=True), 200)
+        appended = [json.loads(line)["filename"]
+                    for line in open(".bookworm/metadata/jsoncatalog_appended.txt")]
+        self.assertEqual(sorted(appended), sorted(json.loads(line)["filename"] for line in catalog[100:300]))
+        derived = [json.loads(line)["filename"]
+                   for line in open(".bookworm/metadata/jsoncatalog_derived.txt")]
+        self.assertEqual(sorted(derived), sorted(json.loads(line)["filename"] for line in catalog[:300]))
+
+        ids = KV(".bookworm/metadata/textids.sqlite")
+        # New filenames are numbered after the old ones.
+        self.assertEqual(set(ids[filename] for filename in appended), set(range(101, 301)))
+        ids.close()
+
+        # Appending again finds nothing new.
+        self.assertEqual(parse_catalog_multicore(append=True), 0)
+
+
+@unittest.skipIf(MySQLdb is None, "MySQLdb is not installed")
+class Database_Append(unittest.TestCase):
+
+    dbname = "append_test_bookworm"
+    # Build options for the first part, before appending.
+    wordcount_options = None
+
+    @classmethod
+    def setUpClass(cls):
+        import bookwormDB.configuration
+        cls.cwd = os.getcwd()
+        cls.directory = tempfile.mkdtemp()
+        os.chdir(cls.directory)
+        catalog = catalog_lines()
+        write_bookworm(cls.directory, catalog[:200])
+        bookwormDB.configuration.create(ask_about_defaults=False, database=cls.dbname)
+        call(["bookworm --log-level warning build all"], shell=True, cwd=cls.directory)
+        if cls.wordcount_options is not None:
+            call(["bookworm --log-level warning prep database_wordcounts " + cls.wordcount_options],
+                 shell=True, cwd=cls.directory)
+        write_bookworm(cls.directory, catalog)
+        call(["bookworm --log-level warning build append"], shell=True, cwd=cls.directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        import bookwormDB.CreateDatabase
+        db = bookwormDB.CreateDatabase.DB(dbname="mysql")
+        db.query("DROP DATABASE IF EXISTS " + cls.dbname)
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory)
+
+    def query(self, database, query):
+        from bookwormDB.general_API import SQLAPIcall
+        query = dict(query, database=database, method="data", format="json")
+        return json.loads(SQLAPIcall(query).execute())['data']
+
+    def assertSameAsFullBuild(self, query):
+        self.assertEqual(self.query(self.dbname, query), self.query("federalist_bookworm", query))
+
+    def test_texts(self):
+        self.assertSameAsFullBuild({"search_limits": {}, "counttype": ["TextCount"], "groups": ["author"]})
+
+    def test_common_words(self):
+        # Words in the first part's wordlist are counted in every text.
+        for word in ["the", "of", "upon"]:
+            self.assertSameAsFullBuild({"search_limits": {"word": [word]},
+                                        "counttype": ["WordCount", "TextCount"], "groups": ["author"]})
+
+    def test_ids_widened(self):
+        data = self.query(self.dbname, {"search_limits": {}, "counttype": ["TextCount"], "groups": ["passage"]})
+        self.assertEqual(len(data), len(catalog_lines()))
+
+    def test_partitions_cover_merge_table(self):
+        import bookwormDB.CreateDatabase
+        bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
+        partitions = bookworm.read_partitions("unigrams")
+        if len(partitions) > 0:
+            self.assertEqual(set(tablename for tablename, first, last in partitions),
+                             set(bookworm.merged_tablenames()))
+
+
+class Partitioned_Database_Append(Database_Append):
+    """
+    The same, with master_bookcounts split by wordid before appending,
+    so the new counts are routed into its parts.
+    """
+    dbname = "append_partitioned_test_bookworm"
+    wordcount_options = "--table-count 3 --partition-by wordid"
+
+    def test_parts_kept(self):
+        import bookwormDB.CreateDatabase
+        bookworm = bookwormDB.CreateDatabase.BookwormSQLDatabase(self.dbname)
+        self.assertEqual(len(bookworm.read_partitions("unigrams")), 3)
+        self.assertEqual(len(bookworm.merged_tablenames()), 3)
+
+
+if __name__=="__main__":
+    unittest.main()
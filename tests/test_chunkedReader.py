@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import random
+import struct
+import zlib
+import gzip
+import os
+from bookwormDB.chunkedReader import input_chunks, chunk_lines, is_bgzf
+
+"""
+However a file is split among workers, every line should be read by
+exactly one of them, in order: these tests split text and bgzip files
+of awkward shapes every way and put the pieces back together.
+"""
+
+
+def bgzf_block(data):
+    """
+    One bgzip block holding `data`, as htslib writes them.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    bsize = 18 + len(compressed) + 8 - 1
+    header = (b"\x1f\x8b\x08\x04" + b"\x00" * 4 + b"\x00\xff" + struct.pack("<H", 6) +
+              b"BC" + struct.pack("<HH", 2, bsize))
+    return header + compressed + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def write_bgzf(path, data, blocksize):
+    with open(path, "wb") as fout:
+        for start in range(0, len(data), blocksize):
+            fout.write(bgzf_block(data[start:start + blocksize]))
+        # bgzip ends every file with an empty block.
+        fout.write(bgzf_block(b""))
+
+
+def random_text(rng):
+    lines = ["doc%d\t" % j + "x" * rng.choice([0, 1, 5, 50, 700, 3000]) + "\n"
+             for j in range(rng.randint(0, 300))]
+    text = "".join(lines)
+    if text and rng.random() < 0.3:
+        # No newline at the end of the file.
+        text = text[:-1]
+    return text
+
+
+class Chunked_Reader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSplitsCleanly(self, path, expected):
+        for n in [1, 2, 3, 7, 16]:
+            chunks = input_chunks(path, n)
+            self.assertIsNotNone(chunks)
+            got = []
+            for i in range(n):
+                got.extend(chunk_lines(path, i, n, chunks))
+            self.assertEqual(got, expected, (path, n))
+
+    def test_text_byte_ranges(self):
+        rng = random.Random(1)
+        path = os.path.join(self.directory, "input.txt")
+        for trial in range(40):
+            text = random_text(rng)
+            with open(path, "w") as fout:
+                fout.write(text)
+            self.assertSplitsCleanly(path, text.splitlines(keepends=True))
+
+    def test_bgzf_blocks(self):
+        rng = random.Random(2)
+        path = os.path.join(self.directory, "input.txt.gz")
+        for trial in range(40):
+            text = random_text(rng)
+            # Blocks smaller and larger than a line, so that lines
+            # straddle block boundaries and blocks fall inside lines.
+            write_bgzf(path, text.encode("utf-8"), rng.choice([7, 64, 500, 4096]))
+            self.assertTrue(is_bgzf(path))
+            self.assertSplitsCleanly(path, text.splitlines(keepends=True))
+
+    def test_plain_gzip(self):
+        path = os.path.join(self.directory, "input.txt.gz")
+        with open(path, "wb") as fout:
+            fout.write(gzip.compress(b"a\tb\nc\td\ne\tf\n"))
+        self.assertFalse(is_bgzf(path))
+        self.assertIsNone(input_chunks(path, 2))
+        got = [list(chunk_lines(path, i, 2, None)) for i in range(2)]
+        self.assertEqual(got, [["a\tb\n", "e\tf\n"], ["c\td\n"]])
+
+
+if __name__=="__main__":
+    unittest.main()
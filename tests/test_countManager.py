@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+from collections import Counter
+import bookwormDB.countManager
+from bookwormDB.countManager import create_exact_counts, spill_counter, merge_runs
+from bookwormDB.tokenizer import Tokenizer
+
+"""
+Exact counts are spilled to disk in sorted runs and merged: however
+many runs there are, the merged totals should be what a single Counter
+over the whole input gives.
+"""
+
+input_path = os.path.join(os.path.dirname(__file__), "test_bookworm_files", "input.txt")
+
+
+def expected_counts():
+    counts = Counter()
+    for line in open(input_path, encoding="utf-8"):
+        counts.update(Tokenizer(line.rstrip().split("\t", 1)[1]).counts("words"))
+    return dict((k, v) for k, v in counts.items()
+                if k not in ['', '\x00'] and not any(c in k for c in "\t\n\r"))
+
+
+class Exact_Counts(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (bookwormDB.countManager.cpus, bookwormDB.countManager.QUEUE_POST_THRESH)
+
+    def tearDown(self):
+        (bookwormDB.countManager.cpus, bookwormDB.countManager.QUEUE_POST_THRESH) = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_merge_runs(self):
+        runs = [Counter({"a": 1, "b": 2}), Counter({"b": 3, "c": 1}), Counter(), Counter({"a": 5, "\t": 9})]
+        paths = []
+        for i, run in enumerate(runs):
+            paths.append(os.path.join(self.directory, "%d.txt" % i))
+            spill_counter(run, paths[-1])
+        self.assertEqual(list(merge_runs(paths)), [("a", 6), ("b", 5), ("c", 1)])
+
+    def test_spilled_counts_match_counter(self):
+        # Several workers, each spilling a run every few documents.
+        bookwormDB.countManager.cpus = 3
+        bookwormDB.countManager.QUEUE_POST_THRESH = 500
+        rundir = os.path.join(self.directory, "runs")
+        merged = list(create_exact_counts(input_path, rundir))
+        self.assertGreater(len(os.listdir(rundir)), 3)
+        self.assertEqual([k for k, v in merged], sorted(k for k, v in merged))
+        self.assertEqual(dict(merged), expected_counts())
+
+
+if __name__=="__main__":
+    unittest.main()
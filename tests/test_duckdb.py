@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import json
+import bookwormDB.CreateDatabase
+from bookwormDB.general_API import SQLAPIcall, DuckDBAPIcall, prefs
+
+"""
+The DuckDB backend should give the same answers as MySQL. These tests
+copy the federalist bookworm built by setup.py into DuckDB and run each
+query against both.
+"""
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+queries = [
+    {"search_limits": {}, "counttype": ["WordCount", "TextCount"], "groups": ["author"]},
+    {"search_limits": {"word": ["the"]}, "counttype": ["WordCount", "TextCount"], "groups": ["author"]},
+    {"search_limits": {"word": ["on", "upon"]}, "counttype": ["TextPercent"], "groups": []},
+    {"search_limits": {"word": ["hOwEvEr"]}, "counttype": ["WordsPerMillion"], "groups": ["date_year"]},
+    {"search_limits": {"word": ["on"], "author": ["HAMILTON"]}, "counttype": ["WordsPerMillion", "TextCount"], "groups": ["date_year"]},
+    {"search_limits": {"author": {"$ne": ["HAMILTON", "MADISON"]}}, "counttype": ["TextPercent"], "groups": ["author"]},
+    {"search_limits": {"word": ["of the"]}, "counttype": ["WordCount"], "groups": ["author"]},
+    {"search_limits": {"word": ["upon"]}, "counttype": ["WordCount"], "groups": ["author", "date_year"]},
+]
+
+
+@unittest.skipIf(duckdb is None, "duckdb is not installed")
+class DuckDB_Parity(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from bookwormDB.duckdbAPI import export_duckdb, duckdb_path
+        cls.directory = tempfile.mkdtemp()
+        db = bookwormDB.CreateDatabase.DB(dbname="federalist_bookworm")
+        db.connect()
+        export_duckdb(db.conn, duckdb_path("federalist_bookworm", cls.directory))
+        prefs['duckdb_directory'] = cls.directory
+
+    @classmethod
+    def tearDownClass(cls):
+        del prefs['duckdb_directory']
+        shutil.rmtree(cls.directory)
+
+    def assertSameResults(self, mysql, duck):
+        if isinstance(mysql, dict):
+            self.assertEqual(sorted(mysql.keys()), sorted(duck.keys()))
+            for key in mysql:
+                self.assertSameResults(mysql[key], duck[key])
+        elif isinstance(mysql, list):
+            self.assertEqual(len(mysql), len(duck))
+            for a, b in zip(mysql, duck):
+                self.assertSameResults(a, b)
+        else:
+            self.assertAlmostEqual(mysql, duck)
+
+    def test_parity(self):
+        for query in queries:
+            query = dict(query, database="federalist_bookworm", method="data", format="json")
+            mysql = json.loads(SQLAPIcall(dict(query)).execute())
+            duck = json.loads(DuckDBAPIcall(dict(query)).execute())
+            self.assertEqual(duck['status'], "success", query)
+            self.assertSameResults(mysql['data'], duck['data'])
+
+    def test_missing_copy(self):
+        query = {"database": "not_a_bookworm", "method": "data", "format": "json",
+                 "search_limits": {}, "counttype": ["WordCount"], "groups": []}
+        self.assertEqual(json.loads(DuckDBAPIcall(query).execute())['status'], "error")
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+import pandas as pd
+from bookwormDB.encodedCounts import (format_rows, binary_header, write_binary_rows,
+                                      read_binary_counts, binary_chunks)
+
+"""
+The binary count files should hold exactly what the text ones do.
+"""
+
+
+def random_counts(rng, rows, ncols):
+    return rng.integers(0, 2**24, size=(rows, ncols), dtype=np.uint32)
+
+
+class Encoded_Counts(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, columns, chunks):
+        path = os.path.join(self.directory, "counts.bin")
+        with open(path, "wb") as fout:
+            fout.write(binary_header(columns))
+            for chunk in chunks:
+                write_binary_rows(fout, chunk)
+        return path
+
+    def test_round_trip_against_tsv(self):
+        rng = np.random.default_rng(1)
+        for columns in [["bookid", "wordid", "count"], ["bookid", "word1", "word2", "count"]]:
+            chunks = [random_counts(rng, rows, len(columns)) for rows in [0, 1, 1000]]
+            tsv = os.path.join(self.directory, "counts.txt")
+            with open(tsv, "w") as fout:
+                for chunk in chunks:
+                    fout.write(format_rows(chunk))
+            expected = pd.read_csv(tsv, sep="\t", header=None).to_numpy()
+
+            path = self.write(columns, chunks)
+            names, array = read_binary_counts(path)
+            self.assertEqual(names, columns)
+            np.testing.assert_array_equal(array, expected)
+            streamed = np.concatenate(list(binary_chunks(path, chunksize=300)))
+            np.testing.assert_array_equal(streamed, expected)
+
+    def test_truncated_row_ignored(self):
+        rows = np.array([[1, 2, 3], [4, 5, 6]], dtype=np.uint32)
+        path = self.write(["bookid", "wordid", "count"], [rows])
+        with open(path, "ab") as fout:
+            fout.write(b"\x07\x00\x00\x00\x08")
+        names, array = read_binary_counts(path)
+        np.testing.assert_array_equal(array, rows)
+
+    def test_empty(self):
+        path = self.write(["bookid", "wordid", "count"], [])
+        names, array = read_binary_counts(path)
+        self.assertEqual(array.shape, (0, 3))
+        self.assertEqual(list(binary_chunks(path)), [])
+
+    def test_not_a_count_file(self):
+        path = os.path.join(self.directory, "counts.bin")
+        with open(path, "wb") as fout:
+            fout.write(b"1\t2\t3\n" * 10)
+        with self.assertRaises(IOError):
+            read_binary_counts(path)
+
+
+if __name__=="__main__":
+    unittest.main()
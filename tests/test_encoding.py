@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+from collections import Counter
+from bookwormDB.tokenizer import (tokenBatches, Tokenizer, removeUncommittedBatches,
+                                  getCompletedFilenames, committedBatches, buildDictionaryTable)
+from bookwormDB.sqliteKV import KV
+from bookwormDB.encodedCounts import read_binary_counts
+from bookwormDB.countManager import extend_wordlist, encode_oov, oov_paths, read_oov_words
+
+"""
+Encoding is checked against itself: however the work is broken up, the
+encoded files should add up to what one clean run over the same texts
+writes. These tests encode the first texts of the federalist bookworm
+in a temporary directory, with a deliberately small wordlist.
+"""
+
+input_path = os.path.join(os.path.dirname(__file__), "test_bookworm_files", "input.txt")
+
+folders = ["texts/wordlist", "metadata", "texts/encoded/unigrams", "texts/encoded/bigrams",
+           "texts/encoded/completed", "texts/encoded/nwords", "texts/encoded/oov/unigrams",
+           "texts/encoded/oov/bigrams", "texts/encoded/oov/words"]
+
+
+def read_input(n=200):
+    lines = []
+    for line in open(input_path, encoding="utf-8"):
+        filename, text = line.rstrip("\n").split("\t", 1)
+        lines.append((filename, text))
+        if len(lines) == n:
+            break
+    return lines
+
+
+def make_bookworm(lines, vocabulary=300):
+    """
+    Set up the current directory to encode `lines` with a wordlist of
+    their `vocabulary` most common words.
+    """
+    for folder in folders:
+        os.makedirs(".bookworm/" + folder)
+    counts = Counter()
+    for filename, text in lines:
+        counts.update(Tokenizer(text).counts("words"))
+    top = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:vocabulary]
+    with open(".bookworm/texts/wordlist/wordlist.txt", "w") as fout:
+        for i, (word, count) in enumerate(top):
+            fout.write("{}\t{}\t{}\n".format(i, word, count))
+    ids = KV(".bookworm/metadata/textids.sqlite")
+    ids.register_many([filename for filename, text in lines])
+    ids.close()
+
+
+def clear_encoded():
+    shutil.rmtree(".bookworm/texts/encoded")
+    for folder in folders:
+        if folder.startswith("texts/encoded"):
+            os.makedirs(".bookworm/" + folder)
+
+
+def encode(lines, **kwargs):
+    batch = tokenBatches(["unigrams", "bigrams"], "binary", **kwargs)
+    for filename, text in lines:
+        batch.encodeRow(filename, Tokenizer(text))
+    return batch
+
+
+def load(level):
+    """
+    The total count of every ngram for every book in a level's files.
+    """
+    folder = ".bookworm/texts/encoded/" + level
+    counts = Counter()
+    for filename in os.listdir(folder):
+        _, array = read_binary_counts(os.path.join(folder, filename))
+        for row in array.tolist():
+            counts[tuple(row[:-1])] += row[-1]
+    return counts
+
+
+def load_nwords():
+    """
+    Every row of every nwords file, as (bookid, total) pairs.
+    """
+    folder = ".bookworm/texts/encoded/nwords"
+    rows = []
+    for filename in os.listdir(folder):
+        for line in open(os.path.join(folder, filename)):
+            bookid, total = line.rstrip("\n").split("\t")
+            rows.append((int(bookid), int(total)))
+    return rows
+
+
+def book_totals(unigrams):
+    totals = Counter()
+    for (bookid, wordid), count in unigrams.items():
+        totals[bookid] += count
+    return totals
+
+
+class Encoding(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.lines = read_input()
+        make_bookworm(self.lines)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def clean_run(self):
+        clear_encoded()
+        encode(self.lines).close()
+        return load("unigrams"), load("bigrams")
+
+    def test_resume_after_crash(self):
+        # The first batch commits; the second dies after moving one of
+        # its files into place, before its list of filenames.
+        crashed = encode(self.lines[:70], docs_per_batch=50)
+        unigrams = crashed.outputFiles["unigrams"]
+        unigrams.flush()
+        os.replace(unigrams.name, crashed.paths[unigrams])
+        self.assertEqual(len(committedBatches()), 1)
+
+        removeUncommittedBatches(["unigrams", "bigrams"])
+        for folder in ["unigrams", "bigrams", "nwords", "completed"]:
+            self.assertEqual(set(f.split(".")[0] for f in os.listdir(".bookworm/texts/encoded/" + folder)),
+                             committedBatches(), folder)
+        skip = getCompletedFilenames("unigrams")
+        self.assertEqual(skip, set([filename for filename, text in self.lines[:50]]))
+
+        encode([line for line in self.lines if line[0] not in skip], docs_per_batch=50).close()
+        resumed = load("unigrams"), load("bigrams")
+        self.assertEqual(resumed, self.clean_run())
+
+    def test_oov_side_files(self):
+        encode(self.lines, docs_per_batch=50, keep_oov=True).close()
+        wordlist = set(line.split("\t")[1] for line in open(".bookworm/texts/wordlist/wordlist.txt"))
+        ids = KV(".bookworm/metadata/textids.sqlite")
+        for level, n in [("unigrams", 1), ("bigrams", 2)]:
+            expected = Counter()
+            for filename, text in self.lines:
+                for gram, count in Tokenizer(text).counts(level).items():
+                    if not all(word in wordlist for word in gram):
+                        expected[(ids[filename], ) + gram] += count
+            kept = Counter()
+            for path in oov_paths(level):
+                batch = os.path.basename(path).split(".")[0]
+                words, counts = read_oov_words(".bookworm/texts/encoded/oov/words/{}.txt".format(batch))
+                totals = Counter()
+                _, array = read_binary_counts(path)
+                for row in array.tolist():
+                    kept[(row[0], ) + tuple(words[i] for i in row[1:n + 1])] += row[-1]
+                    totals[row[1]] += row[-1]
+                if level == "unigrams":
+                    # The word files hold each batch's unigram totals.
+                    self.assertEqual(dict(totals), dict((i, count) for i, count in enumerate(counts) if count > 0))
+            self.assertEqual(kept, expected, level)
+        ids.close()
+
+    def test_oov_off_by_default(self):
+        encode(self.lines).close()
+        for folder in ["unigrams", "bigrams", "words"]:
+            self.assertEqual(os.listdir(".bookworm/texts/encoded/oov/" + folder), [])
+
+    def test_vocab_extend_matches_reencode(self):
+        encode(self.lines, docs_per_batch=50, keep_oov=True).close()
+        added = extend_wordlist(".bookworm/texts/wordlist/wordlist.txt", min_count=2, max_words=200)
+        self.assertEqual(len(added), 200)
+        self.assertEqual([wordid for wordid, word, count in added], list(range(300, 500)))
+        encode_oov(added, "binary")
+        extended = load("unigrams"), load("bigrams")
+
+        # Encoding everything again with the longer wordlist.
+        buildDictionaryTable()
+        self.assertEqual(extended, self.clean_run())
+
+    def test_nwords_side_files(self):
+        encode(self.lines, docs_per_batch=50, keep_oov=True).close()
+        rows = load_nwords()
+        # One row for every text, even those with no words in the wordlist.
+        self.assertEqual(len(rows), len(self.lines))
+        totals = book_totals(load("unigrams"))
+        self.assertEqual(dict((bookid, total) for bookid, total in rows if total > 0), dict(totals))
+
+        # The counts a vocab extend adds come with what they add to each total.
+        encode_oov(extend_wordlist(".bookworm/texts/wordlist/wordlist.txt", max_words=200), "binary")
+        extended = Counter()
+        for bookid, total in load_nwords():
+            extended[bookid] += total
+        self.assertEqual(dict((bookid, total) for bookid, total in extended.items() if total > 0),
+                         dict(book_totals(load("unigrams"))))
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+import time
+from copy import deepcopy
+import pandas as pd
+from bookwormDB.general_API import APIcall, prefs
+from bookwormDB.resultCache import ResultCache
+
+"""
+How an APIcall gets its frames, with the backend replaced by a stub that
+makes up a frame for each call and records the calls it was asked for.
+"""
+
+query = {"database": "federalist_bookworm", "method": "data", "format": "json",
+         "search_limits": {"word": ["the"]}, "counttype": ["WordCount"], "groups": ["author"]}
+
+
+class StubCall(APIcall):
+
+    built = "1"
+
+    def __init__(self, APIcall):
+        super(StubCall, self).__init__(APIcall)
+        self.calls = []
+
+    def build_time(self):
+        return self.built
+
+    def generate_pandas_frame(self, call = None):
+        """
+        Searches for a word of n letters count n and 2n words for the two
+        authors; without a word, 1000 and 2000. Longer words come back
+        sooner.
+        """
+        if call is None:
+            call = self.query
+        self.calls.append(deepcopy(call))
+        words = call['search_limits'].get('word', [])
+        if "broken" in words:
+            raise Exception("Unknown column 'broken' in 'field list'")
+        n = len(words[0]) if len(words) > 0 else 1000
+        time.sleep(0.02 / n)
+        frame = pd.DataFrame({"author": ["HAMILTON", "MADISON"]})
+        for counttype in call['counttype']:
+            frame[counttype] = [n, 2 * n]
+        return frame
+
+
+class Result_Cache_Use(unittest.TestCase):
+
+    def setUp(self):
+        prefs['result_cache'] = ResultCache()
+
+    def tearDown(self):
+        del prefs['result_cache']
+
+    def fetches(self, built):
+        total = 0
+        for i in range(2):
+            call = StubCall(deepcopy(query))
+            call.built = built
+            call.data()
+            total += len(call.calls)
+        return total
+
+    def test_cached_with_build_time(self):
+        self.assertEqual(self.fetches("1"), 1)
+
+    def test_not_cached_without_build_time(self):
+        self.assertEqual(self.fetches(None), 2)
+        self.assertEqual(prefs['result_cache'].bytes, 0)
+
+
+class Comparison_Query(unittest.TestCase):
+
+    def query(self, **kwargs):
+        return dict(deepcopy(query), counttype=["WordsPerMillion"], **kwargs)
+
+    def test_frames_kept_apart(self):
+        call = StubCall(self.query())
+        data = call.data()
+        # 3 and 6 of every 1000 and 2000 words.
+        self.assertEqual(data["WordsPerMillion"].tolist(), [3000, 3000])
+        self.assertEqual(len(call.calls), 2)
+
+    def test_error_in_one_frame(self):
+        data = StubCall(self.query(compare_limits={"word": ["broken"]})).data()
+        self.assertIsInstance(data, pd.Series)
+        self.assertEqual(data["status"], "error")
+        self.assertIn("broken", data["message"])
+
+
+class SharedCall(StubCall):
+    """
+    Records the calls every search of a multi_execute makes.
+    """
+    lock = threading.Lock()
+    made = []
+
+    def generate_pandas_frame(self, call = None):
+        with self.lock:
+            self.made.append(deepcopy(call))
+        return super(SharedCall, self).generate_pandas_frame(call)
+
+
+class Multi_Execute(unittest.TestCase):
+
+    words = ["a", "bb", "ccc", "dddd", "eeeee"]
+
+    def setUp(self):
+        SharedCall.made = []
+
+    def multi_execute(self):
+        limits = [{"word": [word]} for word in self.words]
+        call = SharedCall(dict(deepcopy(query), counttype=["WordsPerMillion"], search_limits=limits))
+        return call.multi_execute(version=3)
+
+    def test_order_kept(self):
+        # The later searches finish first.
+        frame = self.multi_execute()
+        for i, word in enumerate(self.words):
+            self.assertEqual(frame[frame["Search"] == i]["WordsPerMillion"].tolist(),
+                             [len(word) * 1000] * 2)
+
+    def test_comparison_shared(self):
+        self.multi_execute()
+        searched = [call['search_limits'] for call in SharedCall.made]
+        self.assertEqual(sorted(limits["word"][0] for limits in searched if "word" in limits),
+                         self.words)
+        # The searches differ only in their words, so they have one comparison.
+        self.assertEqual(len([limits for limits in searched if "word" not in limits]), 1)
+
+
+if __name__=="__main__":
+    unittest.main()
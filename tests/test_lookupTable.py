@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import random
+import os
+import time
+from bookwormDB.lookupTable import LookupTable, build_lookup_table
+from bookwormDB.sqliteKV import KV
+from bookwormDB.tokenizer import buildIDTable, readIDfile
+
+"""
+A LookupTable should answer exactly as the dict it was built from does,
+for keys it holds and keys it doesn't; and encoding should only use the
+table of bookids while it's as new as the textids DB.
+"""
+
+keys = ["the", "The", "THE", "", "naïve", "日本語", "tab\there", "a" * 300, "ſt", "0", "12.50"]
+
+
+class Lookup_Table(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "table.lookup")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, items, **kwargs):
+        build_lookup_table(items, self.path)
+        return LookupTable(self.path, **kwargs)
+
+    def test_lookups(self):
+        rng = random.Random(1)
+        words = keys + ["word%d" % i for i in range(5000)]
+        expected = dict((word, rng.randrange(2**32)) for word in words)
+        # With and without the preloaded and cached keys.
+        for kwargs in [{}, {"preload": 0, "cache_size": 0}]:
+            table = self.build(expected.items(), **kwargs)
+            self.assertEqual(len(table), len(expected))
+            for word, value in expected.items():
+                self.assertEqual(table[word], value, word)
+                self.assertIn(word, table)
+            table.close()
+
+    def test_misses(self):
+        table = self.build([(word, i) for i, word in enumerate(keys)])
+        for word in ["them", "tHe", " the", "word", "日本"]:
+            self.assertNotIn(word, table)
+            self.assertIsNone(table.get(word))
+            with self.assertRaises(KeyError):
+                table[word]
+        table.close()
+
+    def test_vectorized(self):
+        table = self.build([(word, i) for i, word in enumerate(keys)])
+        query = ["THE", "missing", "", "日本語", "also missing"]
+        self.assertEqual(list(table.lookup(query)), [2, -1, 3, 5, -1])
+        table.close()
+
+    def test_first_value_kept(self):
+        table = self.build([("a", 1), ("b", 2), ("a", 3)])
+        self.assertEqual((table["a"], table["b"], len(table)), (1, 2, 2))
+        table.close()
+
+    def test_empty(self):
+        table = self.build([])
+        self.assertEqual(len(table), 0)
+        self.assertIsNone(table.get("anything"))
+        table.close()
+
+
+class ID_Table(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.makedirs(".bookworm/metadata")
+        self.ids = KV(".bookworm/metadata/textids.sqlite")
+        self.ids.register_many(["file%d" % i for i in range(100)])
+        self.ids.conn.commit()
+
+    def tearDown(self):
+        self.ids.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_matches_textids(self):
+        buildIDTable()
+        table = readIDfile()
+        self.assertIsInstance(table, LookupTable)
+        for i in range(100):
+            self.assertEqual(table["file%d" % i], self.ids["file%d" % i])
+        with self.assertRaises(KeyError):
+            table["file100"]
+        table.close()
+
+    def test_stale_table_not_used(self):
+        buildIDTable()
+        # Make sure the DB's modification time moves past the table's.
+        time.sleep(0.01)
+        self.ids.register_many(["file100"])
+        self.ids.conn.commit()
+        os.utime(".bookworm/metadata/textids.sqlite")
+        table = readIDfile()
+        self.assertNotIsInstance(table, LookupTable)
+        self.assertEqual(table["file100"], 101)
+        table.close()
+
+
+if __name__=="__main__":
+    unittest.main()
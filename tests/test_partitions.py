@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+from bookwormDB.mariaDB import Query, databaseSchema
+from bookwormDB.CreateDatabase import BookwormSQLDatabase
+
+"""
+When master_bookcounts is split into tables by wordid, a search for words
+that all lie in one table should read that table alone, and anything
+else the whole MERGE table. The partition lists here are written by
+hand instead of read from MySQL.
+"""
+
+partitions = [("master_bookcounts_p0", 0, 9), ("master_bookcounts_p1", 10, 99),
+              ("master_bookcounts_p2", 100, 2**24 - 1)]
+
+bigram_partitions = [("master_bigrams_p0", 0, 49), ("master_bigrams_p1", 50, 2**24 - 1)]
+
+
+class Schema(object):
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+
+
+def unigram_table(partitions, wordids):
+    query = Query.__new__(Query)
+    query.databaseScheme = Schema(partitions)
+    query.searched_wordids = wordids
+    return query.unigram_table()
+
+
+class Unigram_Table(unittest.TestCase):
+
+    def test_one_part(self):
+        self.assertEqual(unigram_table(partitions, [3]), "master_bookcounts_p0")
+        self.assertEqual(unigram_table(partitions, [10, 99]), "master_bookcounts_p1")
+        self.assertEqual(unigram_table(partitions, [2**24 - 1]), "master_bookcounts_p2")
+
+    def test_words_in_several_parts(self):
+        self.assertEqual(unigram_table(partitions, [9, 10]), "master_bookcounts")
+
+    def test_wordid_outside_every_part(self):
+        gapped = [("master_bookcounts_p0", 0, 9), ("master_bookcounts_p1", 20, 99)]
+        self.assertEqual(unigram_table(gapped, [15]), "master_bookcounts")
+
+    def test_not_partitioned(self):
+        self.assertEqual(unigram_table([], [3]), "master_bookcounts")
+        self.assertEqual(unigram_table(partitions, []), "master_bookcounts")
+
+    def test_bigram_parts_ignored(self):
+        self.assertEqual(unigram_table(bigram_partitions, [3]), "master_bookcounts")
+        self.assertEqual(unigram_table(partitions + bigram_partitions, [60]), "master_bookcounts_p1")
+
+
+class Cursor(object):
+    """
+    Answers the two queries load_partitions makes.
+    """
+    def __init__(self, rows, union):
+        self.rows = rows
+        self.union = union
+
+    def execute(self, sql):
+        self.last = sql
+
+    def fetchall(self):
+        if self.last.startswith("SHOW CREATE TABLE"):
+            return [("master_bookcounts", "CREATE TABLE `master_bookcounts` (...) ENGINE=MRG_MyISAM "
+                     "INSERT_METHOD=LAST UNION=({})".format(",".join("`%s`" % t for t in self.union)))]
+        return self.rows
+
+
+def load_partitions(rows, union):
+    schema = databaseSchema.__new__(databaseSchema)
+    schema.db = Schema(None)
+    schema.db.cursor = Cursor(rows, union)
+    return schema.load_partitions()
+
+
+class Load_Partitions(unittest.TestCase):
+
+    def test_cover_merge_table(self):
+        rows = partitions + bigram_partitions
+        union = [tablename for tablename, first, last in partitions]
+        self.assertEqual(load_partitions(rows, union), rows)
+
+    def test_merge_table_has_more_parts(self):
+        # A part added by an append, with every wordid in it.
+        union = [tablename for tablename, first, last in partitions] + ["master_bookcounts_3"]
+        self.assertEqual(load_partitions(partitions + bigram_partitions, union), bigram_partitions)
+
+
+class Wordid_Partitions(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.makedirs(".bookworm/texts/wordlist")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def partitions(self, counts, table_count):
+        with open(".bookworm/texts/wordlist/wordlist.txt", "w") as fout:
+            for wordid, count in enumerate(counts):
+                fout.write("{}\tword{}\t{}\n".format(wordid, wordid, count))
+        return BookwormSQLDatabase.__new__(BookwormSQLDatabase).wordid_partitions(table_count)
+
+    def assertCover(self, ranges, words):
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 2**24 - 1)
+        for (first, last), (next_first, next_last) in zip(ranges, ranges[1:]):
+            self.assertEqual(next_first, last + 1)
+        for first, last in ranges:
+            self.assertLessEqual(first, last)
+            self.assertLess(first, words)
+
+    def test_zipfian(self):
+        counts = [1000 // (rank + 1) for rank in range(200)]
+        for table_count in [1, 2, 3, 8]:
+            ranges = self.partitions(counts, table_count)
+            self.assertEqual(len(ranges), table_count)
+            self.assertCover(ranges, len(counts))
+
+    def test_one_word_dominates(self):
+        ranges = self.partitions([10**6, 1, 1, 1, 1], 3)
+        self.assertEqual(ranges, [(0, 0), (1, 1), (2, 2**24 - 1)])
+        self.assertCover(ranges, 5)
+
+
+if __name__=="__main__":
+    unittest.main()
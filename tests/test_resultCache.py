@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+import pandas as pd
+from bookwormDB.resultCache import ResultCache, cache_key
+
+
+def frame(n):
+    return pd.DataFrame({"date_year": range(n), "WordCount": [1.0] * n})
+
+
+class Result_Cache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_ignores_formatting(self):
+        query = {"database": "federalist_bookworm", "search_limits": {"word": ["the"]},
+                 "counttype": ["WordCount"], "groups": ["author"], "method": "data"}
+        reordered = dict(reversed(list(query.items())), format="csv", ip="127.0.0.1")
+        self.assertEqual(cache_key(query), cache_key(reordered))
+        self.assertNotEqual(cache_key(query), cache_key(dict(query, groups=["date_year"])))
+        self.assertNotEqual(cache_key(query, "SQLAPIcall", "1"), cache_key(query, "SQLAPIcall", "2"))
+
+    def test_copies(self):
+        cache = ResultCache()
+        cache.put("a", frame(3))
+        got = cache.get("a")
+        got["WordCount"] = 0
+        self.assertEqual(cache.get("a")["WordCount"].sum(), 3)
+        self.assertIsNone(cache.get("b"))
+
+    def test_evicts_least_recently_used(self):
+        size = int(frame(100).memory_usage(index=True, deep=True).sum())
+        cache = ResultCache(max_bytes=size * 2)
+        cache.put("a", frame(100))
+        cache.put("b", frame(100))
+        cache.get("a")
+        cache.put("c", frame(100))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertLessEqual(cache.bytes, size * 2)
+
+    def test_shared_on_disk(self):
+        path = os.path.join(self.directory, "cache.sqlite")
+        ResultCache(path=path).put("a", frame(5))
+        # A second cache, as in another worker, finds it on disk.
+        other = ResultCache(path=path)
+        self.assertEqual(len(other.get("a")), 5)
+
+    def test_disk_limit(self):
+        path = os.path.join(self.directory, "cache.sqlite")
+        cache = ResultCache(max_bytes=1, path=path, max_disk_bytes=20000)
+        for i in range(20):
+            cache.put(str(i), frame(100))
+        total = cache.connection().execute("SELECT SUM(size) FROM results").fetchone()[0]
+        self.assertLessEqual(total, 20000)
+        self.assertIsNotNone(cache.get("19"))
+        self.assertIsNone(cache.get("0"))
+
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+import os
+from bookwormDB.sqliteKV import KV
+
+"""
+Bookids come from the order filenames are registered in, so batched
+registration has to give the same ids one-at-a-time registration does.
+"""
+
+
+class Register_Many(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "textids.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_ids_as_register(self):
+        keys = ["file%d" % i for i in range(1000)]
+        one = KV(os.path.join(self.directory, "one.sqlite"))
+        for key in keys:
+            one.register(key)
+        many = KV(self.path)
+        self.assertEqual(many.register_many(keys), 0)
+        for key in keys:
+            self.assertEqual(many[key], one[key])
+        one.close()
+        many.close()
+
+    def test_duplicates_skipped(self):
+        ids = KV(self.path)
+        self.assertEqual(ids.register_many(["a", "b", "a"]), 1)
+        self.assertEqual(ids.register_many(["c", "b", "d"]), 1)
+        self.assertEqual([ids[key] for key in "abcd"], [1, 2, 3, 4])
+        self.assertEqual(ids.last_id(), 4)
+        with self.assertRaises(KeyError):
+            ids["e"]
+        ids.close()
+
+    def test_persisted(self):
+        ids = KV(self.path)
+        ids.register_many(["a", "b"])
+        ids.close()
+        ids = KV(self.path)
+        self.assertEqual(ids.register_many(["b", "c"]), 1)
+        self.assertEqual((ids["a"], ids["c"], ids.last_id()), (1, 3, 3))
+        ids.close()
+
+    def test_empty(self):
+        ids = KV(self.path)
+        self.assertEqual(ids.register_many([]), 0)
+        self.assertEqual(ids.last_id(), 0)
+        ids.close()
+
+
+if __name__=="__main__":
+    unittest.main()
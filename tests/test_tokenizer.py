@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import random
+import os
+from bookwormDB.tokenizer import Tokenizer, wordRegex, fast_tokenize
+
+"""
+The default tokenizer takes a shortcut around the big regex from
+`wordRegex`: these tests check that the two always agree.
+"""
+
+examples = [
+    "",
+    " ",
+    "   leading and trailing   ",
+    "The quick brown fox.",
+    "John's dog and the Smiths' cat; JOHN'S DOG.",
+    "1990's 12's 12abc's 123abc abc123",
+    "$12.50, $12, $.50, 12.5.3, 3.14159 and 12.",
+    "Mr. Smith, mrs. Jones, DR. Who, St. Louis, etc. and mr.x, mrsx.",
+    "C# and F# and c#minor and h# and ab#",
+    "tab\there, newline\nhere, carriage\rreturn",
+    "non\xa0breaking\u2003em\u3000ideographic\u2028line",
+    "Ærøskøbing, naïve café, Straße, ſt. ſ's",
+    "日本語のテキスト、句読点。",
+    "Ελληνικά κείμενα; русский текст!",
+    "combining e\u0301 marks and \u00b2 superscripts and \u0663\u0664 digits",
+    "under_scores and _leading and trailing_",
+    "emoji 🙂 and symbols © ® ™ §",
+    "'s alone and ' s and 's's",
+]
+
+# Characters chosen to exercise every branch of the regex.
+alphabet = list("abcmrsdtx'#.$_ 019,-") + ["\xa0", "\t", "\u2003", "é", "\u0301", "\u0663", "Ж", "日", "S", "M"]
+
+
+class Tokenizer_Conformance(unittest.TestCase):
+
+    def assertConforms(self, string):
+        expected = wordRegex().findall(string)
+        self.assertEqual(fast_tokenize(string), expected, repr(string))
+        self.assertEqual(Tokenizer(string).tokenize(), expected, repr(string))
+
+    def test_examples(self):
+        for string in examples:
+            self.assertConforms(string)
+
+    def test_random_strings(self):
+        rng = random.Random(1)
+        for i in range(5000):
+            length = rng.randrange(40)
+            self.assertConforms("".join(rng.choice(alphabet) for _ in range(length)))
+
+    def test_bookworm_files(self):
+        for folder in ["test_bookworm_files", "test_bookworm_files_unicode"]:
+            path = os.path.join(os.path.dirname(__file__), folder, "input.txt")
+            for line in open(path, encoding="utf-8"):
+                self.assertConforms(line.rstrip("\n").split("\t", 1)[1])
+
+    def test_custom_regex(self):
+        # A user-supplied regex still bypasses the fast path.
+        tokenizer = Tokenizer("one two, three", tokenization_regex=r"\w+,?")
+        self.assertEqual(tokenizer.tokenize(), ["one", "two,", "three"])
+
+    def test_ngrams(self):
+        tokenizer = Tokenizer("the cat's hat. the cat")
+        self.assertEqual(tokenizer.counts("bigrams")[("the", "cat")], 1)
+        self.assertEqual(tokenizer.counts("unigrams")[("the",)], 2)
+
+
+if __name__=="__main__":
+    unittest.main()